@@ -20,8 +20,10 @@ and SQL database
 """
 import sys
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 from service import config
-from service.common import log_handlers
+from service.common import log_handlers, admission, changefeed, leaderboard, profiling, tracing, memory
+from service.common import retries, suggest, responsecache, negotiation, singleflight
 
 
 ############################################################
@@ -33,16 +35,40 @@ def create_app():
     app = Flask(__name__)
     app.config.from_object(config)
 
+    # jsonify() answers in MessagePack for clients that Accept it
+    app.json = negotiation.NegotiatingJSONProvider(app)
+
+    # Trust X-Forwarded-For only as far as our own proxies appended to it
+    if app.config["TRUSTED_PROXIES"]:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["TRUSTED_PROXIES"])
+
     # Initialize Plugins
     # pylint: disable=import-outside-toplevel
-    from service.models import db
+    from service.models import db, ChangeCounter
     db.init_app(app)
 
+    # Transient database errors are retried before they reach a client
+    app.extensions["db_retry"] = retries.RetryPolicy(app.config)
+
+    # Concurrent writes may share one commit when GROUP_COMMIT is on; each
+    # commit locks the change counter before any Product row
+    app.extensions["group_commit"] = None
+    if app.config["GROUP_COMMIT"]:
+        from service.common import groupcommit
+
+        app.extensions["group_commit"] = groupcommit.GroupCommit(
+            app.extensions["db_retry"], db.session, app.config, begin=ChangeCounter.lock
+        )
+
     with app.app_context():
         # Dependencies require we import the routes AFTER the Flask app is created
         # pylint: disable=wrong-import-position, wrong-import-order, unused-import
         from service import routes, models  # noqa: F401 E402
-        from service.common import error_handlers, cli_commands  # noqa: F401, E402
+        from service.common import error_handlers  # noqa: F401, E402
+
+        # gunicorn workers never run CLI commands, so they skip loading them
+        if "gunicorn" not in sys.modules:
+            from service.common import cli_commands  # noqa: F401, E402
 
         try:
             db.create_all()
@@ -51,9 +77,53 @@ def create_app():
             # gunicorn requires exit code 4 to stop spawning workers when they die
             sys.exit(4)
 
+        # Spread the Products over DATABASE_SHARDS when it lists any
+        app.extensions["shards"] = None
+        if app.config["DATABASE_SHARDS"]:
+            from service.common import sharding
+
+            app.extensions["shards"] = sharding.ShardSet(app.config["DATABASE_SHARDS"], app.config)
+            app.extensions["shards"].start_relay()
+
         # Set up logging for production
         log_handlers.init_logging(app, "gunicorn.error")
 
+        # Trace sampled requests through the routes, the Product model and SQL
+        tracing.init_tracing(app, db.engine, classes=[models.Product])
+        for index, engine in enumerate(app.extensions["shards"].engines if app.extensions["shards"] else []):
+            tracing.instrument_engine(engine, **{"db.shard": index})
+
+        # Shed load before it reaches the database
+        admission.init_admission(app, db.engine)
+
+        # Profile requests that ask for it with X-Profile: 1
+        profiling.init_profiling(app)
+
+        # Recycle a worker that grew past its memory budget
+        memory.init_memory_budget(app)
+
+        # One change feed listener per worker, started by the first subscriber
+        app.extensions["changefeed"] = changefeed.ChangeFeed(db.engine, app.config)
+
+        # Most liked Products, loaded on first use and kept current from the event log
+        app.extensions["leaderboard"] = leaderboard.Leaderboard(db.engine, app.config["LEADERBOARD_SIZE"])
+
+        # Product names for prefix suggestions, kept current the same way
+        app.extensions["suggest"] = suggest.NameIndex(db.engine, app.config)
+
+        # Concurrent reads of one Product share a query, until a write in this worker
+        app.extensions["product_reads"] = singleflight.SingleFlight("product")
+
+        # Serialized listings, valid for as long as the change counter stands still
+        app.extensions["list_cache"] = responsecache.ResponseCache(app, app.config)
+
+        # Run background jobs here too unless a `flask jobs-worker` does
+        if app.config["JOB_IN_PROCESS"]:
+            from service.common import jobs
+
+            app.extensions["jobs"] = jobs.JobWorker(app)
+            app.extensions["jobs"].start()
+
         app.logger.info(70 * "*")
         app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
         app.logger.info(70 * "*")
@@ -0,0 +1,150 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Admission Control
+
+This module decides, before a request touches the database, whether the
+worker can afford to serve it. Clients over their rate limit get a 429,
+and when the worker or its connection pool is saturated new requests are
+shed with a 503. Writes are shed before reads because they hold
+connections longer, and the health check is never shed.
+"""
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request
+from werkzeug.exceptions import TooManyRequests, ServiceUnavailable
+from service.common import metrics
+
+# Endpoints that are always admitted (event streams are long-lived and
+# capped separately by the change feed)
+EXEMPT_ENDPOINTS = {"health", "index", "static", "get_metrics", "product_events"}
+
+# Methods that only read and are admitted for longer under pressure
+READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+# Endpoints that only read although clients POST to them
+READ_ENDPOINTS = {"batch_get_products"}
+
+# Most client buckets remembered before the least recently used is dropped
+MAX_BUCKETS = 10000
+
+
+class TokenBucket:  # pylint: disable=too-few-public-methods
+    """Refills at rate tokens per second up to burst tokens"""
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """Takes a token and returns 0, or returns the seconds until one is available"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """Tracks in-flight requests and per-client rate limits for one worker"""
+
+    def __init__(self, config: dict, pool_usage=None):
+        self.max_in_flight = config["ADMISSION_MAX_IN_FLIGHT"]
+        self.write_share = config["ADMISSION_WRITE_SHARE"]
+        self.pool_threshold = config["ADMISSION_POOL_THRESHOLD"]
+        self.rate = config["RATE_LIMIT_PER_SECOND"]
+        self.burst = config["RATE_LIMIT_BURST"]
+        self.retry_after = config["ADMISSION_RETRY_AFTER"]
+        self.pool_usage = pool_usage or (lambda: 0.0)
+        self.in_flight = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def admit(self, client: str, is_write: bool):
+        """Admits a request or raises TooManyRequests / ServiceUnavailable"""
+        self._check_rate(client)
+        usage = self.pool_usage()
+        metrics.set_gauge("db.pool.usage", usage)
+        with self._lock:
+            limit = self.max_in_flight * (self.write_share if is_write else 1)
+            pool_limit = self.pool_threshold if is_write else 1.0
+            if (self.max_in_flight and self.in_flight >= limit) or usage >= pool_limit:
+                metrics.increment("admission.shed.writes" if is_write else "admission.shed.reads")
+                raise ServiceUnavailable(
+                    "Service is overloaded, please retry later", retry_after=self.retry_after
+                )
+            self.in_flight += 1
+            metrics.set_gauge("admission.in_flight", self.in_flight)
+        metrics.increment("admission.admitted")
+
+    def release(self):
+        """Records that an admitted request has finished"""
+        with self._lock:
+            self.in_flight -= 1
+            metrics.set_gauge("admission.in_flight", self.in_flight)
+
+    def _check_rate(self, client: str):
+        """Raises TooManyRequests if the client has run out of tokens"""
+        if not self.rate:
+            return
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(client, None) or TokenBucket(self.rate, self.burst, now)
+            self._buckets[client] = bucket
+            if len(self._buckets) > MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+            wait = bucket.take(now)
+        if wait:
+            metrics.increment("admission.rate_limited")
+            raise TooManyRequests("Rate limit exceeded", retry_after=max(1, round(wait)))
+
+
+def pool_usage(engine) -> float:
+    """Returns the share of the connection pool that is checked out"""
+    pool = engine.pool
+    # pools without a size limit (or with unlimited overflow) never queue
+    if not hasattr(pool, "size") or pool._max_overflow < 0:
+        return 0.0
+    capacity = pool.size() + pool._max_overflow
+    return pool.checkedout() / capacity if capacity else 0.0
+
+
+def init_admission(app, engine):
+    """Installs admission control on every request to the app"""
+    controller = AdmissionController(app.config, lambda: pool_usage(engine))
+    app.extensions["admission"] = controller
+
+    @app.before_request
+    def admit_request():
+        if request.endpoint in EXEMPT_ENDPOINTS:
+            return
+        # behind TRUSTED_PROXIES, ProxyFix has already set the client address
+        client = request.remote_addr or "unknown"
+        is_write = request.method not in READ_METHODS and request.endpoint not in READ_ENDPOINTS
+        controller.admit(client, is_write)
+        g.admitted = True
+
+    @app.teardown_request
+    def release_request(_exc):
+        if g.pop("admitted", False):
+            controller.release()
+
+    return controller
@@ -0,0 +1,38 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Admin Access
+
+This module guards the debugging features that only operators may use
+"""
+import hmac
+from flask import abort, request
+from flask import current_app as app
+from service.common import status
+
+
+def is_admin() -> bool:
+    """Returns True if the request carries the configured admin token"""
+    token = app.config["ADMIN_TOKEN"]
+    supplied = request.headers.get("X-Admin-Token", "")
+    return bool(token) and hmac.compare_digest(supplied.encode(), token.encode())
+
+
+def check_admin():
+    """Aborts with 403 unless the request carries the admin token"""
+    if not is_admin():
+        abort(status.HTTP_403_FORBIDDEN, "This requires a valid X-Admin-Token")
@@ -0,0 +1,217 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Change Feed
+
+This module pushes Product changes to Server-Sent Events subscribers.
+Each worker runs one background listener for all of its subscribers. On
+PostgreSQL it waits on LISTEN for the NOTIFY sent by every new
+ProductEvent, and on other databases it polls the event table. Whenever
+it wakes up it reads the new events once and hands them to every
+subscriber. If the listener fails every open stream is closed so its
+client reconnects with Last-Event-ID, which starts a new listener.
+"""
+import logging
+import queue
+import threading
+import time
+from werkzeug.exceptions import ServiceUnavailable
+from service.models import ProductEvent
+from service.common import metrics
+
+logger = logging.getLogger("flask.app")
+
+# Events read from the table per query
+BATCH_SIZE = 1000
+
+
+class Subscription:
+    """The queue of events waiting to be sent to one client"""
+
+    def __init__(self, size: int):
+        self.queue = queue.Queue(maxsize=size)
+        self.lagged = False
+        self.closed = False
+
+    def offer(self, event: dict):
+        """Queues an event, remembering if the client fell too far behind"""
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.lagged = True
+
+    def get(self, timeout: float):
+        """Returns the next event, or None if none arrived within timeout"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        """Ends the stream, waking it if it is waiting for an event"""
+        self.closed = True
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass  # a full queue never blocks the reader
+
+
+class ChangeFeed:
+    """Shares one database listener between all subscribers of a worker"""
+
+    def __init__(self, engine, config: dict):
+        self.engine = engine
+        self.poll_interval = config["EVENT_POLL_INTERVAL"]
+        self.max_subscribers = config["EVENT_MAX_SUBSCRIBERS"]
+        self.queue_size = config["EVENT_QUEUE_SIZE"]
+        self.subscribers = set()
+        self.last_seq = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self) -> Subscription:
+        """Registers a new subscriber and makes sure the listener is running"""
+        with self._lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                raise ServiceUnavailable("Too many change feed subscribers", retry_after=5)
+            subscription = Subscription(self.queue_size)
+            self.subscribers.add(subscription)
+            metrics.set_gauge("changefeed.subscribers", len(self.subscribers))
+            if self._thread is None:
+                self.last_seq = ProductEvent.latest_seq(self.engine)
+                self._thread = threading.Thread(target=self.run, name="changefeed", daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """Removes a subscriber, the listener stops once there are none"""
+        with self._lock:
+            self.subscribers.discard(subscription)
+            metrics.set_gauge("changefeed.subscribers", len(self.subscribers))
+
+    def dispatch(self):
+        """Reads the events since the last dispatch and fans them out"""
+        count = 0
+        while True:
+            events = ProductEvent.since(self.last_seq, limit=BATCH_SIZE, engine=self.engine)
+            with self._lock:
+                for event in events:
+                    for subscription in self.subscribers:
+                        subscription.offer(event)
+                    self.last_seq = event["seq"]
+            count += len(events)
+            if len(events) < BATCH_SIZE:
+                break
+        metrics.increment("changefeed.events", count)
+        return count
+
+    def run(self):
+        """Waits for changes and dispatches them until nobody is subscribed"""
+        close = None
+        try:
+            wait, close = self._waiter()
+            while self._has_subscribers():
+                wait()
+                self.dispatch()
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error("Change feed listener stopped: %s", error)
+            metrics.increment("changefeed.failures")
+            with self._lock:
+                self._thread = None
+                # nobody would hear about new events, so send them all to reconnect
+                for subscription in self.subscribers:
+                    subscription.close()
+                self.subscribers.clear()
+                metrics.set_gauge("changefeed.subscribers", 0)
+        finally:
+            if close:
+                close()
+
+    def _has_subscribers(self) -> bool:
+        """Returns True while anyone is subscribed, otherwise retires the listener"""
+        with self._lock:
+            if self.subscribers:
+                return True
+            self._thread = None
+            return False
+
+    def _waiter(self):
+        """Returns functions that block until the next change and clean up"""
+        if self.engine.dialect.name != "postgresql":
+            return (lambda: time.sleep(self.poll_interval)), (lambda: None)
+
+        # a dedicated connection outside the pool, in autocommit for LISTEN
+        raw = self.engine.raw_connection()
+        raw.detach()
+        conn = raw.driver_connection
+        conn.autocommit = True
+        conn.execute(f"LISTEN {ProductEvent.CHANNEL}")
+
+        def wait():
+            for _ in conn.notifies(timeout=self.poll_interval, stop_after=1):
+                pass
+
+        return wait, conn.close
+
+
+def format_event(event: dict) -> str:
+    """Renders a ProductEvent as a Server-Sent Event"""
+    return f"id: {event['seq']}\nevent: {event['action']}\ndata: {event['data']}\n\n"
+
+
+def stream(feed: ChangeFeed, last_seq: int, config: dict):
+    """
+    Yields Server-Sent Events for every change after last_seq
+
+    The subscription is taken before the backlog is read from the event
+    table so nothing falls in between, and anything already sent is
+    skipped. The stream ends after EVENT_STREAM_TIMEOUT seconds so worker
+    threads are recycled, or as soon as the listener fails, and clients
+    resume with Last-Event-ID.
+    """
+    subscription = feed.subscribe()
+    deadline = time.monotonic() + config["EVENT_STREAM_TIMEOUT"]
+    try:
+        yield f"retry: {config['EVENT_RETRY_MS']}\n\n"
+        pending = ProductEvent.since(last_seq, engine=feed.engine)
+        while time.monotonic() < deadline and not subscription.closed:
+            for event in pending:
+                if event["seq"] > last_seq:
+                    last_seq = event["seq"]
+                    yield format_event(event)
+            timeout = min(config["EVENT_HEARTBEAT"], max(deadline - time.monotonic(), 0))
+            pending = _next_events(feed, subscription, last_seq, timeout)
+            if pending is None:
+                yield ": keep-alive\n\n"
+                pending = []
+    finally:
+        feed.unsubscribe(subscription)
+
+
+def _next_events(feed: ChangeFeed, subscription: Subscription, last_seq: int, timeout: float):
+    """Returns the next events to send, or None if nothing happened in time"""
+    if not subscription.lagged:
+        event = subscription.get(timeout)
+        if subscription.closed:
+            return []
+        if event is None:
+            return None
+        # sequence numbers are dense, so a jump means events were missed
+        if event["seq"] <= last_seq + 1:
+            return [event]
+    subscription.lagged = False
+    return ProductEvent.since(last_seq, engine=feed.engine)
@@ -16,8 +16,11 @@
 """
 Flask CLI Command Extensions
 """
+import signal
+import click
 from flask import current_app as app  # Import Flask application
-from service.models import db
+from service.models import db, Product, ProductEvent, IdempotencyKey
+from service.common import export, profiling, memory, jobs
 
 
 ######################################################################
@@ -34,3 +37,114 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+
+
+######################################################################
+# Command to stream the products table to a file
+# Usage:
+#   flask products-export --format jsonl --output products.jsonl
+######################################################################
+@app.cli.command("products-export")
+@click.option(
+    "--format",
+    "export_format",
+    type=click.Choice(sorted(export.EXPORT_FORMATS)),
+    default="csv",
+    show_default=True,
+    help="Output format",
+)
+@click.option(
+    "--output", type=click.File("w"), default="-", help="Output file (default stdout)"
+)
+@click.option("--name", default=None, help="Only export names containing this text")
+@click.option(
+    "--description", default=None, help="Only export descriptions containing this text"
+)
+@click.option("--price-lt", type=float, default=None, help="Only export cheaper products")
+def products_export(export_format, output, name, description, price_lt):
+    """
+    Streams all of the products to a file from a consistent snapshot
+    """
+    rows = Product.export_rows(name=name, description=description, price_lt=price_lt)
+    for chunk in export.generate(export_format, rows):
+        output.write(chunk)
+
+
+######################################################################
+# Command to forget expired idempotency keys
+# Usage:
+#   flask idempotency-purge
+######################################################################
+@app.cli.command("idempotency-purge")
+def idempotency_purge():
+    """
+    Deletes idempotency keys older than IDEMPOTENCY_TTL seconds
+    """
+    count = IdempotencyKey.purge_expired(app.config["IDEMPOTENCY_TTL"])
+    click.echo(f"Purged {count} expired idempotency keys")
+
+
+######################################################################
+# Command to trim the change event log
+# Usage:
+#   flask events-prune
+######################################################################
+@app.cli.command("events-prune")
+def events_prune():
+    """
+    Deletes change events older than EVENT_RETENTION seconds
+    """
+    count = ProductEvent.prune(app.config["EVENT_RETENTION"])
+    click.echo(f"Pruned {count} change events")
+
+
+######################################################################
+# Command to list the stored request profiles
+# Usage:
+#   flask profiles-list
+######################################################################
+@app.cli.command("profiles-list")
+def profiles_list():
+    """
+    Lists the request profiles kept in PROFILE_DIR, newest first
+    """
+    for profile in profiling.list_profiles(app.config["PROFILE_DIR"]):
+        click.echo(f"{profile['created_at']}  {profile['duration_ms']:>6} ms  {profile['id']}")
+
+
+######################################################################
+# Command to show the memory footprint of a freshly loaded app
+# Usage:
+#   PYTHONTRACEMALLOC=10 flask memory-report --top 20
+######################################################################
+@app.cli.command("memory-report")
+@click.option("--top", type=int, default=10, show_default=True, help="Allocation sites to list")
+def memory_report(top):
+    """
+    Shows the baseline RSS of a worker and, with tracemalloc on, where it goes
+    """
+    usage = memory.report(top)
+    click.echo(f"RSS: {usage['rss_bytes'] / memory.MEGABYTE:.1f} MB")
+    for site in usage["tracemalloc"].get("top", []):
+        click.echo(f"{site['size_bytes'] / 1024:>10.1f} KiB  {site['count']:>7}  {site['site']}")
+
+
+######################################################################
+# Command to run background jobs
+# Usage:
+#   flask jobs-worker --concurrency 4
+######################################################################
+@app.cli.command("jobs-worker")
+@click.option("--concurrency", type=int, default=None, help="Jobs run at once (default JOB_CONCURRENCY)")
+def jobs_worker(concurrency):
+    """
+    Runs queued jobs until interrupted, letting the running ones finish
+    """
+    worker = jobs.JobWorker(app._get_current_object(), concurrency)  # pylint: disable=protected-access
+    signal.signal(signal.SIGTERM, lambda *_: worker.stopping.set())
+    worker.start()
+    try:
+        worker.stopping.wait()
+    except KeyboardInterrupt:
+        click.echo("Stopping, waiting for running jobs")
+    worker.stop()
@@ -18,8 +18,10 @@ Module: error_handlers
 """
 from flask import jsonify
 from flask import current_app as app  # Import Flask application
-from service.models import DataValidationError
+from service.models import DataValidationError, VersionConflictError
 from service.common import status
+from service.common.retries import DatabaseUnavailable
+from service.common.validation import ValidationError
 
 
 ######################################################################
@@ -28,9 +30,34 @@ from service.common import status
 @app.errorhandler(DataValidationError)
 def request_validation_error(error):
     """Handles Value Errors from bad data"""
+    # a write that ran out of retries failed on our side, not the client's
+    if isinstance(error.__cause__, DatabaseUnavailable):
+        return service_unavailable(error.__cause__)
     return bad_request(error)
 
 
+@app.errorhandler(ValidationError)
+def schema_validation_error(error):
+    """Handles payloads that break the schema, listing every bad field"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_400_BAD_REQUEST,
+            error="Bad Request",
+            message=message,
+            errors=error.errors,
+        ),
+        status.HTTP_400_BAD_REQUEST,
+    )
+
+
+@app.errorhandler(VersionConflictError)
+def version_conflict_error(error):
+    """Handles lost updates detected by the version check"""
+    return precondition_failed(error)
+
+
 @app.errorhandler(status.HTTP_400_BAD_REQUEST)
 def bad_request(error):
     """Handles bad requests with 400_BAD_REQUEST"""
@@ -44,6 +71,17 @@ def bad_request(error):
     )
 
 
+@app.errorhandler(status.HTTP_403_FORBIDDEN)
+def forbidden(error):
+    """Handles requests that lack the required authority with 403_FORBIDDEN"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_403_FORBIDDEN, error="Forbidden", message=message),
+        status.HTTP_403_FORBIDDEN,
+    )
+
+
 @app.errorhandler(status.HTTP_404_NOT_FOUND)
 def not_found(error):
     """Handles resources not found with 404_NOT_FOUND"""
@@ -70,6 +108,43 @@ def method_not_supported(error):
     )
 
 
+@app.errorhandler(status.HTTP_409_CONFLICT)
+def resource_conflict(error):
+    """Handles conflicting requests with 409_CONFLICT"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_409_CONFLICT, error="Conflict", message=message),
+        status.HTTP_409_CONFLICT,
+    )
+
+
+@app.errorhandler(status.HTTP_410_GONE)
+def gone(error):
+    """Handles requests for history that is no longer kept with 410_GONE"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_410_GONE, error="Gone", message=message),
+        status.HTTP_410_GONE,
+    )
+
+
+@app.errorhandler(status.HTTP_412_PRECONDITION_FAILED)
+def precondition_failed(error):
+    """Handles failed If-Match preconditions with 412_PRECONDITION_FAILED"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_412_PRECONDITION_FAILED,
+            error="Precondition Failed",
+            message=message,
+        ),
+        status.HTTP_412_PRECONDITION_FAILED,
+    )
+
+
 @app.errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 def mediatype_not_supported(error):
     """Handles unsupported media requests with 415_UNSUPPORTED_MEDIA_TYPE"""
@@ -85,6 +160,44 @@ def mediatype_not_supported(error):
     )
 
 
+def retry_after_header(error):
+    """Returns the Retry-After header carried by an error, if any"""
+    retry_after = getattr(error, "retry_after", None)
+    return {"Retry-After": str(retry_after)} if retry_after else {}
+
+
+@app.errorhandler(status.HTTP_429_TOO_MANY_REQUESTS)
+def too_many_requests(error):
+    """Handles rate limited clients with 429_TOO_MANY_REQUESTS"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_429_TOO_MANY_REQUESTS,
+            error="Too Many Requests",
+            message=message,
+        ),
+        status.HTTP_429_TOO_MANY_REQUESTS,
+        retry_after_header(error),
+    )
+
+
+@app.errorhandler(status.HTTP_503_SERVICE_UNAVAILABLE)
+def service_unavailable(error):
+    """Handles shed requests with 503_SERVICE_UNAVAILABLE"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            error="Service Unavailable",
+            message=message,
+        ),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        retry_after_header(error),
+    )
+
+
 @app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 def internal_server_error(error):
     """Handles unexpected server error with 500_SERVER_ERROR"""
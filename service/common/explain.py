@@ -0,0 +1,82 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Query Plans
+
+This module records the SQL a request runs and asks the database how it
+ran it. On PostgreSQL every SELECT is run again under
+EXPLAIN (ANALYZE, BUFFERS), other databases only report the plan they
+would use. It is a debugging aid for admins and costs nothing until a
+request asks for it.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import event
+
+
+@contextmanager
+def capture(engine):
+    """Yields the list of statements this thread runs on engine, with timings"""
+    queries = []
+    thread = threading.get_ident()
+
+    def before(_conn, _cursor, _statement, _parameters, context, _executemany):
+        context.explain_started = time.perf_counter()
+
+    def after(_conn, _cursor, statement, parameters, context, _executemany):
+        if threading.get_ident() == thread:
+            elapsed = time.perf_counter() - context.explain_started
+            queries.append(
+                {"sql": statement, "parameters": parameters, "duration_ms": round(elapsed * 1000, 3)}
+            )
+
+    event.listen(engine, "before_cursor_execute", before)
+    event.listen(engine, "after_cursor_execute", after)
+    try:
+        yield queries
+    finally:
+        event.remove(engine, "before_cursor_execute", before)
+        event.remove(engine, "after_cursor_execute", after)
+
+
+def plan(conn, statement, parameters):
+    """Returns the plan of one statement, or None for anything but a SELECT"""
+    if not statement.lstrip().upper().startswith("SELECT"):
+        return None
+    if conn.dialect.name == "postgresql":
+        prefix = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) "
+        return conn.exec_driver_sql(prefix + statement, parameters).scalar()
+    rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)
+    return [row[-1] for row in rows]
+
+
+def report(conn, queries, total_seconds):
+    """Adds plans to the captured queries and breaks down where the time went"""
+    for query in queries:
+        query["plan"] = plan(conn, query["sql"], query["parameters"])
+        query["parameters"] = repr(query["parameters"])
+    sql_ms = sum(query["duration_ms"] for query in queries)
+    total_ms = round(total_seconds * 1000, 3)
+    return {
+        "timing": {
+            "total_ms": total_ms,
+            "sql_ms": round(sql_ms, 3),
+            "app_ms": round(max(total_ms - sql_ms, 0), 3),
+        },
+        "queries": queries,
+    }
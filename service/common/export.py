@@ -0,0 +1,90 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Bulk Export
+
+This module turns a stream of Product rows into CSV or JSON Lines text
+without ever holding more than one output chunk in memory
+"""
+import csv
+import io
+import json
+from datetime import datetime
+from service.models import isoformat
+
+EXPORT_COLUMNS = ["id", "name", "description", "price", "likes", "created_at", "updated_at"]
+
+# Media type for each supported export format
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+}
+
+# Approximate size of each chunk handed to the response or output file
+CHUNK_SIZE = 64 * 1024
+
+
+def _encode_value(value):
+    """Renders a column value the same way the JSON API does"""
+    if value is None or isinstance(value, (int, str)):
+        return value
+    if isinstance(value, datetime):
+        return isoformat(value)
+    return str(value)
+
+
+def _csv_rows(rows):
+    """Yields one CSV line per row, starting with the header"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        writer.writerow([_encode_value(row[column]) for column in EXPORT_COLUMNS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _jsonl_rows(rows):
+    """Yields one JSON document per line for each row"""
+    for row in rows:
+        record = {column: _encode_value(row[column]) for column in EXPORT_COLUMNS}
+        yield json.dumps(record) + "\n"
+
+
+def generate(export_format, rows):
+    """
+    Converts an iterable of Product rows into text chunks
+
+    Lines are coalesced into chunks of roughly CHUNK_SIZE characters so
+    that streaming does not pay a write per row.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format '{export_format}'")
+    lines = _csv_rows(rows) if export_format == "csv" else _jsonl_rows(rows)
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield "".join(chunk)
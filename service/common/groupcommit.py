@@ -0,0 +1,190 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Group Commit
+
+This module commits the writes of concurrent requests within a worker
+together. The first thread to submit a write becomes the leader: it waits
+up to GROUP_COMMIT_WINDOW_MS for other writes to arrive, or until
+GROUP_COMMIT_MAX_BATCH have, then runs all of them in its own session and
+commits once. Every other thread waits for its own result or error, for
+up to GROUP_COMMIT_WAIT_MS. A write still waiting after that is withdrawn
+from its batch, unless the batch is already committing, and committed
+alone, so a stalled leader never holds up its followers for good.
+
+Each write runs against whichever thread leads its batch, so it may only
+execute statements on the session and must return plain data, never ORM
+instances. A write that fails is dropped from the batch and the others
+are run again without it, so one bad request never fails its neighbours.
+
+A batch takes row locks in the order its writes run, so with more than
+one write it could wait on a row a lone write holds while holding the
+row that write wants next. Every transaction the GroupCommit runs, batch
+or lone, therefore starts with begin(session), which should lock the one
+row all the writes go on to touch, so they queue there before locking
+anything else.
+"""
+import threading
+from service.common import metrics
+from service.common.retries import classify
+
+
+class _Write:  # pylint: disable=too-few-public-methods
+    """A submitted write and, once committed, its outcome"""
+
+    __slots__ = ("name", "work", "done", "result", "error", "sealed", "withdrawn")
+
+    def __init__(self, name: str, work):
+        self.name = name
+        self.work = work
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # both are guarded by the GroupCommit's condition
+        self.sealed = False
+        self.withdrawn = False
+
+    def outcome(self):
+        """Returns the result of the write or raises its error"""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class _Failed(Exception):
+    """Raised inside a batch to roll it back when one of its writes fails"""
+
+    def __init__(self, write: _Write, error: Exception):
+        super().__init__(str(error))
+        self.write = write
+        self.error = error
+
+
+class GroupCommit:
+    """Batches concurrent writes into one transaction per window"""
+
+    def __init__(self, policy, session, config: dict, begin=None):
+        self.policy = policy
+        self.session = session
+        self.begin = begin
+        self.window = config["GROUP_COMMIT_WINDOW_MS"] / 1000
+        self.max_batch = config["GROUP_COMMIT_MAX_BATCH"]
+        self.wait = config["GROUP_COMMIT_WAIT_MS"] / 1000
+        self._cond = threading.Condition()
+        self._pending = []
+        self._leading = False
+
+    def submit(self, name: str, work):
+        """
+        Returns work() once it has been committed, possibly with other writes
+
+        work runs the statements of one write and, like the work given to
+        RetryPolicy.run, must be safe to run again after a rollback.
+        """
+        write = _Write(name, work)
+        with self._cond:
+            self._pending.append(write)
+            leader = not self._leading
+            self._leading = True
+            if len(self._pending) >= self.max_batch:
+                self._cond.notify_all()
+        if not leader:
+            if write.done.wait(self.wait) or not self._withdraw(write):
+                return write.outcome()
+            metrics.increment("groupcommit.withdrawn")
+            return self.policy.run(write.name, self.session, lambda: self._run_alone(write))
+
+        with self._cond:
+            self._cond.wait_for(lambda: len(self._pending) >= self.max_batch, timeout=self.window)
+            # the next write to arrive leads a new batch
+            batch, self._pending = self._pending, []
+            self._leading = False
+        try:
+            self._commit(batch)
+        finally:
+            for other in batch:
+                other.done.set()
+        return write.outcome()
+
+    def _withdraw(self, write: _Write) -> bool:
+        """Takes a write back from its batch unless it is already being committed"""
+        with self._cond:
+            if write in self._pending:
+                self._pending.remove(write)
+                return True
+            if write.sealed:
+                return False
+            write.withdrawn = True
+            return True
+
+    def _seal(self, writes: list):
+        """Fails a withdrawn write out of the batch, or marks every write as committing"""
+        with self._cond:
+            for write in writes:
+                if write.withdrawn:
+                    raise _Failed(write, TimeoutError("withdrawn from the batch"))
+            for write in writes:
+                write.sealed = True
+
+    def _commit(self, batch: list):
+        """Commits the batch, dropping and re-running around writes that fail"""
+        metrics.increment("groupcommit.batches")
+        metrics.increment("groupcommit.writes", len(batch))
+        metrics.set_gauge("groupcommit.last_batch_size", len(batch))
+        remaining = list(batch)
+        while remaining:
+            try:
+                results = self.policy.run("group", self.session, lambda: self._run_all(remaining))
+            except _Failed as failed:
+                failed.write.error = failed.error
+                remaining.remove(failed.write)
+                if remaining:
+                    metrics.increment("groupcommit.reruns")
+                continue
+            except Exception as error:  # pylint: disable=broad-except
+                for write in remaining:
+                    write.error = error
+                return
+            for write, result in zip(remaining, results):
+                write.result = result
+            return
+
+    def _run_alone(self, write: _Write):
+        """Runs a write withdrawn from its batch in a transaction of its own"""
+        if self.begin is not None:
+            self.begin(self.session)
+        return write.work()
+
+    def _run_all(self, writes: list) -> list:
+        """Runs every write of a batch and seals it for the COMMIT that follows"""
+        if self.begin is not None:
+            self.begin(self.session)
+        results = [_run(write) for write in writes]
+        self._seal(writes)
+        return results
+
+
+def _run(write: _Write):
+    """Runs one write of a batch, turning its own errors into _Failed"""
+    try:
+        return write.work()
+    except Exception as error:
+        if classify(error):
+            # transient errors fail the whole batch and are retried
+            raise
+        raise _Failed(write, error) from error
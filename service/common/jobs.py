@@ -0,0 +1,387 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+
+"""
+Background Jobs
+
+This module runs long catalog operations (exports, bulk price changes,
+imports and reindexing) outside of request threads. POST /jobs only
+queues a row in the job table. A job worker, started with
+`flask jobs-worker` or inside each app process with JOB_IN_PROCESS,
+claims queued jobs from that table and runs up to JOB_CONCURRENCY of
+them at once, so there is no broker to operate.
+
+Params are checked when the job is queued, so a job does not fail
+halfway through for input the client could have been told about. Bulky
+params, such as the items of an import, are stored apart from the job's
+status and never sent back to clients polling it.
+
+A handler receives the job's params and a JobContext. It reports its
+progress through the context, which also renews the job's lease, and
+stops with JobCancelled at the first report after a client cancelled
+the job, or with JobLost if another worker took the job over. Handlers
+must report at least once every JOB_LEASE seconds, or run steps that
+cannot report under JobContext.keepalive(), or the job is considered
+abandoned and claimed by another worker.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from decimal import Decimal, InvalidOperation
+from flask import current_app
+from sqlalchemy import text
+from service.models import db, Job, Product, DataValidationError, VersionConflictError
+from service.models import product_schema, product_shards
+from service.common import export, metrics
+from service.common.validation import ValidationError
+
+logger = logging.getLogger("flask.app")
+
+# Product filters a job may be limited to, as for GET /products
+FILTERS = ("name", "description", "price_lt")
+
+# Most per-item errors kept in the result of an import
+MAX_ERRORS = 100
+
+# Products read per query by jobs that walk the catalog
+PAGE_SIZE = 1000
+
+# How each kind of job is run: its handler, the params it requires, a
+# function returning the errors in its params and the params kept as payload
+Kind = namedtuple("Kind", ["handler", "required", "validate", "payload"])
+
+# The kinds of job by name
+HANDLERS = {}
+
+
+class JobCancelled(Exception):
+    """Raised inside a handler when its job was cancelled"""
+
+
+class JobLost(Exception):
+    """Raised inside a handler when another worker took its job over"""
+
+
+def job_kind(kind, required=(), validate=None, payload=()):
+    """Registers the decorated function as the handler of a kind of job"""
+
+    def register(handler):
+        HANDLERS[kind] = Kind(handler, required, validate, payload)
+        return handler
+
+    return register
+
+
+def check(kind, params):
+    """Raises ValidationError unless kind names a job and params fit it"""
+    if kind not in HANDLERS:
+        raise ValidationError({"kind": f"must be one of {', '.join(sorted(HANDLERS))}"}, "Invalid job")
+    if not isinstance(params, dict):
+        raise ValidationError({"params": "must be an object"}, "Invalid job")
+    errors = {name: "is required" for name in HANDLERS[kind].required if name not in params}
+    if not errors and HANDLERS[kind].validate:
+        errors = HANDLERS[kind].validate(params)
+    if errors:
+        raise ValidationError(errors, "Invalid job")
+
+
+def split(kind, params):
+    """Returns the params of a job apart from its payload, and the payload or None"""
+    names = HANDLERS[kind].payload
+    payload = {name: params[name] for name in names if name in params}
+    return {name: value for name, value in params.items() if name not in names}, payload or None
+
+
+class JobContext:
+    """What a running handler knows about its job"""
+
+    def __init__(self, job: Job, config: dict):
+        self.id = job.id
+        self.worker = job.worker
+        self.directory = config["JOB_DIR"]
+        self.interval = config["JOB_PROGRESS_INTERVAL"]
+        self.lease = config["JOB_LEASE"]
+        self.done = 0
+        self.total = None
+        self._reported = 0.0
+
+    def progress(self, done: int, total: int = None):
+        """Records progress, at most every JOB_PROGRESS_INTERVAL, and stops a cancelled or lost job"""
+        self.done, self.total = done, total
+        now = time.monotonic()
+        if now - self._reported < self.interval and done != total:
+            return
+        self._reported = now
+        cancel = Job.heartbeat(self.id, self.worker, done, total)
+        if cancel is None:
+            raise JobLost(f"Job {self.id} was taken over by another worker")
+        if cancel:
+            raise JobCancelled(f"Job {self.id} was cancelled")
+
+    @contextmanager
+    def keepalive(self):
+        """Renews the lease from another thread while a step that cannot report progress runs"""
+        app = current_app._get_current_object()  # pylint: disable=protected-access
+        stopped = threading.Event()
+
+        def renew():
+            with app.app_context():
+                while not stopped.wait(self.lease / 3):
+                    Job.heartbeat(self.id, self.worker, self.done, self.total)
+                    db.session.remove()
+
+        thread = threading.Thread(target=renew, name=f"job-{self.id}-keepalive", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+
+def execute(job: Job, config: dict):
+    """Runs a claimed job to the end and records its outcome"""
+    handler = HANDLERS[job.kind].handler
+    context = JobContext(job, config)
+    params = job.serialize()["params"]
+    if job.payload is not None:
+        params.update(json.loads(job.payload))
+    logger.info("Running %s job %s", job.kind, job.id)
+    try:
+        result = handler(params, context)
+    except JobLost as lost:
+        db.session.rollback()
+        logger.warning("%s", lost)
+        return
+    except JobCancelled:
+        db.session.rollback()
+        Job.finish(job.id, job.worker, Job.CANCELLED)
+    except Exception as error:  # pylint: disable=broad-except
+        db.session.rollback()
+        logger.error("%s job %s failed: %s", job.kind, job.id, error)
+        Job.finish(job.id, job.worker, Job.FAILED, error=str(error))
+    else:
+        Job.finish(job.id, job.worker, Job.SUCCEEDED, result=result)
+    metrics.increment(f"jobs.{job.kind}.finished")
+
+
+class JobWorker:
+    """Claims jobs from the job table and runs them on a few threads"""
+
+    def __init__(self, app, concurrency: int = None):
+        self.app = app
+        self.concurrency = concurrency or app.config["JOB_CONCURRENCY"]
+        self.poll_interval = app.config["JOB_POLL_INTERVAL"]
+        self.lease = app.config["JOB_LEASE"]
+        self.max_attempts = app.config["JOB_MAX_ATTEMPTS"]
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.stopping = threading.Event()
+        self._threads = []
+
+    def run_next(self) -> bool:
+        """Claims and runs one job, returns False if none was waiting"""
+        job = Job.claim(self.name, self.lease, self.max_attempts)
+        if job is None:
+            return False
+        execute(job, self.app.config)
+        return True
+
+    def start(self):
+        """Starts the threads that run jobs"""
+        for number in range(self.concurrency):
+            thread = threading.Thread(target=self._run, name=f"jobs-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info("Job worker %s running %d jobs at a time", self.name, self.concurrency)
+
+    def stop(self, timeout: float = None):
+        """Lets the running jobs finish and stops claiming new ones"""
+        self.stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self):
+        """Runs jobs until stopped, waiting for new ones when there are none"""
+        with self.app.app_context():
+            while not self.stopping.is_set():
+                try:
+                    ran = self.run_next()
+                except Exception as error:  # pylint: disable=broad-except
+                    logger.error("Job worker error: %s", error)
+                    db.session.rollback()
+                    ran = False
+                finally:
+                    db.session.remove()
+                if not ran:
+                    self.stopping.wait(self.poll_interval)
+
+
+def _filters(params: dict) -> dict:
+    """Returns the Product filters given in a job's params"""
+    return {key: params.get(key) for key in FILTERS}
+
+
+def _number(value):
+    """Returns value as a Decimal, or None if it is not a finite number"""
+    if isinstance(value, bool) or not isinstance(value, (int, float, str, Decimal)):
+        return None
+    try:
+        number = Decimal(str(value))
+    except InvalidOperation:
+        return None
+    return number if number.is_finite() else None
+
+
+######################################################################
+# J O B   P A R A M   C H E C K S
+######################################################################
+def check_filters(params: dict) -> dict:
+    """Returns the errors in the Product filters of a job's params"""
+    errors = {
+        key: "must be a string"
+        for key in ("name", "description")
+        if params.get(key) is not None and not isinstance(params[key], str)
+    }
+    if params.get("price_lt") is not None and _number(params["price_lt"]) is None:
+        errors["price_lt"] = "must be a number"
+    return errors
+
+
+def check_export(params: dict) -> dict:
+    """Returns the errors in the params of an export"""
+    errors = check_filters(params)
+    if params.get("format", "csv") not in export.EXPORT_FORMATS:
+        errors["format"] = f"must be one of {', '.join(export.EXPORT_FORMATS)}"
+    return errors
+
+
+def check_reprice(params: dict) -> dict:
+    """Returns the errors in the params of a price change"""
+    errors = check_filters(params)
+    percent = _number(params["percent"])
+    if percent is None or percent < -100:
+        errors["percent"] = "must be a number of at least -100"
+    return errors
+
+
+def check_import(params: dict) -> dict:
+    """Returns the errors in the params of an import"""
+    items = params["products"]
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return {"products": "must be a list of objects"}
+    return {}
+
+
+######################################################################
+# J O B   H A N D L E R S
+######################################################################
+@job_kind("export", validate=check_export)
+def export_products(params: dict, job: JobContext) -> dict:
+    """Writes the Products to a CSV or JSON Lines file in JOB_DIR"""
+    export_format = params.get("format", "csv")
+
+    def counted(rows):
+        for count, row in enumerate(rows, 1):
+            yield row
+            job.progress(count)
+
+    os.makedirs(job.directory, exist_ok=True)
+    name = f"job-{job.id}.{export_format}"
+    with open(os.path.join(job.directory, name), "w", encoding="utf-8") as output:
+        for chunk in export.generate(export_format, counted(Product.export_rows(**_filters(params)))):
+            output.write(chunk)
+    job.progress(job.done, job.done)
+    return {"file": name, "rows": job.done}
+
+
+def _reprice(row, factor: Decimal) -> str:
+    """Changes the price of one Product row and returns what became of it"""
+    try:
+        data = product_schema.validate({"price": (row["price"] * factor).quantize(Decimal("0.01"))}, partial=True)
+        return "updated" if Product.patch(row["id"], data, row["version"]) else "deleted"
+    except VersionConflictError:
+        return "conflicts"
+    except ValidationError:
+        return "failed"
+
+
+@job_kind("reprice", required=("percent",), validate=check_reprice)
+def reprice_products(params: dict, job: JobContext) -> dict:
+    """
+    Changes the price of the Products by a percentage, skipping any changed
+    meanwhile and any whose new price would not fit the price column
+
+    The Products are read a page at a time by id, so memory stays bounded
+    however many there are.
+    """
+    factor = 1 + _number(params["percent"]) / 100
+    result = {"updated": 0, "conflicts": 0, "failed": 0}
+    done = after_id = 0
+    while True:
+        rows = Product.page(after_id, PAGE_SIZE, **_filters(params))
+        for row in rows:
+            if row["price"] is not None:
+                outcome = _reprice(row, factor)
+                if outcome in result:
+                    result[outcome] += 1
+            done += 1
+            job.progress(done)
+        if len(rows) < PAGE_SIZE:
+            break
+        after_id = rows[-1]["id"]
+    job.progress(done, done)
+    return result
+
+
+@job_kind("import", required=("products",), validate=check_import, payload=("products",))
+def import_products(params: dict, job: JobContext) -> dict:
+    """Creates a Product for each item of params["products"]"""
+    items = params["products"]
+    created = 0
+    errors = []
+    for count, data in enumerate(items, 1):
+        try:
+            Product().deserialize(product_schema.validate(data)).create()
+            created += 1
+        except (ValidationError, DataValidationError) as error:
+            if len(errors) < MAX_ERRORS:
+                errors.append({"index": count - 1, "error": str(error)})
+        job.progress(count, len(items))
+    return {"created": created, "failed": len(items) - created, "errors": errors}
+
+
+@job_kind("reindex")
+def reindex_products(_params: dict, job: JobContext) -> dict:
+    """Rebuilds the indexes of the product table and refreshes its statistics"""
+    shards = product_shards()
+    engines = shards.engines if shards is not None else [db.engine]
+    db.session.commit()
+    for count, engine in enumerate(engines, 1):
+        # CONCURRENTLY keeps the table writable but cannot run in a transaction
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn, job.keepalive():
+            if conn.dialect.name == "postgresql":
+                conn.execute(text("REINDEX TABLE CONCURRENTLY product"))
+            else:
+                conn.execute(text("REINDEX product"))
+            conn.execute(text("ANALYZE product"))
+        job.progress(count, len(engines))
+    return {"databases": len(engines)}
@@ -0,0 +1,121 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Leaderboard
+
+This module keeps the most liked Products of a worker in memory. It is
+loaded once from the likes index and then kept current by replaying the
+change events written by every like, update, create and delete, so
+serving the top n costs a query for the latest events and a slice of an
+already sorted list, however large the catalog is.
+"""
+import bisect
+import threading
+from service.models import Product, ProductEvent
+from service.common import metrics
+
+# Events replayed per catch up, a leaderboard further behind is reloaded
+BATCH_SIZE = 1000
+
+
+def rank(product: dict) -> tuple:
+    """Returns the sort key of a Product, most likes first and then by id"""
+    return (-product["likes"], product["id"])
+
+
+class Leaderboard:
+    """The top Products by likes, maintained incrementally from the event log"""
+
+    def __init__(self, engine, size: int):
+        self.engine = engine
+        self.size = size
+        self.last_seq = None
+        # Every Product missing from the list ranks below its last entry,
+        # and complete means there is no Product missing at all
+        self.complete = False
+        self._keys = []
+        self._entries = []
+        self._lock = threading.Lock()
+
+    def top(self, count: int) -> list:
+        """Returns the count most liked Products as dictionaries"""
+        self.catch_up()
+        with self._lock:
+            ready = self.complete or count <= len(self._entries)
+            entries = self._entries[:count]
+        if ready:
+            metrics.increment("leaderboard.hits")
+            return entries
+        self.load()
+        with self._lock:
+            return self._entries[:count]
+
+    def load(self):
+        """Reloads the leaderboard from the database"""
+        metrics.increment("leaderboard.loads")
+        # read the event position first so nothing written meanwhile is lost
+        seq = ProductEvent.latest_seq(self.engine)
+        products = [product.serialize() for product in Product.most_liked(self.size)]
+        with self._lock:
+            self._entries = products
+            self._keys = [rank(product) for product in products]
+            self.complete = len(products) < self.size
+            self.last_seq = seq
+
+    def catch_up(self):
+        """Applies the changes made since the leaderboard was last current"""
+        with self._lock:
+            last_seq = self.last_seq
+        if last_seq is None:
+            self.load()
+            return
+        events = ProductEvent.since(last_seq, limit=BATCH_SIZE, engine=self.engine)
+        # sequence numbers are dense, so a gap means events were pruned
+        if len(events) == BATCH_SIZE or (events and events[0]["seq"] != last_seq + 1):
+            self.load()
+            return
+        with self._lock:
+            for event in events:
+                if event["seq"] > self.last_seq:
+                    self._apply(event)
+                    self.last_seq = event["seq"]
+
+    def _apply(self, event: dict):
+        """Moves, adds or removes the Product an event is about"""
+        self._remove(event["product_id"])
+        if event["action"] == "deleted":
+            return
+        product = Product.parse_serialized(event["data"])
+        key = rank(product)
+        # below the last entry it may be outranked by Products not in the list
+        if not self.complete and (not self._keys or key > self._keys[-1]):
+            return
+        index = bisect.bisect(self._keys, key)
+        self._keys.insert(index, key)
+        self._entries.insert(index, product)
+        if len(self._entries) > self.size:
+            self._keys.pop()
+            self._entries.pop()
+            self.complete = False
+
+    def _remove(self, product_id: int):
+        """Drops a Product from the list if it is there"""
+        for index, entry in enumerate(self._entries):
+            if entry["id"] == product_id:
+                del self._entries[index]
+                del self._keys[index]
+                return
@@ -0,0 +1,92 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Memory Budget
+
+This module reports how much memory a worker uses and recycles a
+gunicorn worker that grows past MEMORY_SOFT_LIMIT_MB, after it has
+finished the current request, before the pod's hard limit gets it
+OOM-killed. Allocation sites are only reported when Python was started
+with tracemalloc on (PYTHONTRACEMALLOC=<frames>), because tracing every
+allocation costs too much to leave on.
+"""
+import logging
+import os
+import resource
+import signal
+import tracemalloc
+from flask import request
+from service.common import metrics
+
+logger = logging.getLogger("flask.app")
+
+MEGABYTE = 1024 * 1024
+
+
+def rss_bytes() -> int:
+    """Returns the resident set size of this process"""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # without /proc only the peak is known, in kilobytes
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def report(top: int = 10) -> dict:
+    """Returns the RSS of this worker and its largest allocation sites"""
+    usage = {"pid": os.getpid(), "rss_bytes": rss_bytes(), "tracemalloc": {"tracing": tracemalloc.is_tracing()}}
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        statistics = tracemalloc.take_snapshot().statistics("lineno")[:top]
+        usage["tracemalloc"].update(
+            current_bytes=current,
+            peak_bytes=peak,
+            top=[
+                {"site": str(stat.traceback[0]), "size_bytes": stat.size, "count": stat.count}
+                for stat in statistics
+            ],
+        )
+    return usage
+
+
+def init_memory_budget(app):
+    """Recycles the worker after a request that left it over the soft limit"""
+    limit = app.config["MEMORY_SOFT_LIMIT_MB"] * MEGABYTE
+    if not limit:
+        return
+    recycling = []
+
+    @app.teardown_request
+    def check_memory(_exc):
+        rss = rss_bytes()
+        metrics.set_gauge("memory.rss_bytes", rss)
+        if rss <= limit or recycling:
+            return
+        # only a gunicorn worker is replaced by its arbiter once it exits
+        if not request.environ.get("SERVER_SOFTWARE", "").startswith("gunicorn"):
+            return
+        recycling.append(rss)
+        metrics.increment("memory.recycles")
+        logger.warning(
+            "Worker %s uses %d MB, over the %d MB soft limit: recycling",
+            os.getpid(),
+            rss // MEGABYTE,
+            limit // MEGABYTE,
+        )
+        # gunicorn workers finish their current requests and exit on SIGTERM
+        os.kill(os.getpid(), signal.SIGTERM)
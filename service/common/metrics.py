@@ -0,0 +1,58 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Metrics
+
+This module keeps simple per-process counters and gauges that the
+service exposes on GET /metrics
+"""
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+
+
+def increment(name: str, amount: int = 1):
+    """Adds amount to the named counter"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def set_gauge(name: str, value):
+    """Records the latest value of the named gauge"""
+    with _lock:
+        _gauges[name] = value
+
+
+def counter(name: str) -> int:
+    """Returns the current value of the named counter"""
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot() -> dict:
+    """Returns a copy of every counter and gauge"""
+    with _lock:
+        return {"counters": dict(_counters), "gauges": dict(_gauges)}
+
+
+def reset():
+    """Clears every counter and gauge"""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
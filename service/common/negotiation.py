@@ -0,0 +1,123 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+
+"""
+Content Negotiation
+
+This module lets clients trade JSON for MessagePack, a compact binary
+encoding, with Accept: application/msgpack on requests and
+Content-Type: application/msgpack on bodies. Every jsonify() response,
+errors included, is rendered in the media type the client prefers, and
+JSON stays the default.
+
+Prices are decimals, which JSON carries as strings. MessagePack carries
+them as extension type 1 holding the decimal's digits as UTF-8 text, so
+they decode back to the exact same value, never through a float.
+"""
+from decimal import Decimal, InvalidOperation
+import msgpack
+from flask import has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import BadRequest
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+# The unregistered name some clients still send
+MSGPACK_TYPES = {MSGPACK, "application/x-msgpack"}
+
+# MessagePack extension type code of a Decimal
+DECIMAL_EXT = 1
+
+# Added to entity tags so the two representations never share a strong ETag
+TAG_SUFFIXES = {JSON: "", MSGPACK: "-msgpack"}
+
+
+def _default(obj):
+    """Encodes the values MessagePack has no native type for"""
+    if isinstance(obj, Decimal):
+        return msgpack.ExtType(DECIMAL_EXT, str(obj).encode("utf-8"))
+    raise TypeError(f"Object of type {type(obj).__name__} cannot be encoded as MessagePack")
+
+
+def _ext_hook(code, data):
+    """Decodes the extension types written by _default"""
+    if code == DECIMAL_EXT:
+        return Decimal(data.decode("utf-8"))
+    return msgpack.ExtType(code, data)
+
+
+def packb(obj) -> bytes:
+    """Returns obj encoded as MessagePack"""
+    return msgpack.packb(obj, default=_default)
+
+
+def unpackb(data: bytes):
+    """Returns the value encoded in a MessagePack body, or raises BadRequest"""
+    try:
+        return msgpack.unpackb(data, ext_hook=_ext_hook)
+    except (ValueError, InvalidOperation, msgpack.UnpackException) as error:
+        raise BadRequest(f"Invalid MessagePack body: {error}") from error
+
+
+def response_type() -> str:
+    """Returns the media type the current request prefers for its response"""
+    if not has_request_context():
+        return JSON
+    best = request.accept_mimetypes.best_match([JSON, *sorted(MSGPACK_TYPES)], default=JSON)
+    return MSGPACK if best in MSGPACK_TYPES else JSON
+
+
+def representation_tag(tag: str, media_type: str = None) -> str:
+    """Returns the entity tag of the representation of tag sent as media_type"""
+    return tag + TAG_SUFFIXES[media_type or response_type()]
+
+
+def base_tag(tag: str) -> str:
+    """Returns an entity tag without the suffix of its representation"""
+    return tag.removesuffix(TAG_SUFFIXES[MSGPACK])
+
+
+def request_data():
+    """Returns the decoded body of the current request, JSON or MessagePack"""
+    if request.mimetype in MSGPACK_TYPES:
+        return unpackb(request.get_data())
+    return request.get_json()
+
+
+class NegotiatingJSONProvider(DefaultJSONProvider):
+    """Renders jsonify() as MessagePack for clients that prefer it"""
+
+    def response(self, *args, **kwargs):
+        """Returns a response in the media type the request prefers"""
+        media_type = response_type()
+        if media_type == JSON:
+            response = super().response(*args, **kwargs)
+        else:
+            body = self.body(self._prepare_response_obj(args, kwargs), media_type)
+            response = self._app.response_class(body, mimetype=media_type)
+        response.vary.add("Accept")
+        return response
+
+    def body(self, obj, media_type: str) -> bytes:
+        """Returns obj encoded as media_type, without needing a request"""
+        if media_type == MSGPACK:
+            return packb(obj)
+        # laid out as DefaultJSONProvider.response would for this app
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return f"{self.dumps(obj, indent=2)}\n".encode("utf-8")
+        return f"{self.dumps(obj, separators=(',', ':'))}\n".encode("utf-8")
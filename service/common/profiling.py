@@ -0,0 +1,136 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Request Profiling
+
+This module runs chosen requests under cProfile and keeps the result as a
+pstats dump per route, which snakeviz, flameprof or gprof2dot turn into
+flame graphs. A request is profiled when an admin sends X-Profile: 1 or
+when it is picked by PROFILE_SAMPLE_RATE. Every other request only pays
+for a header lookup. With PROFILE_KEEP set to 0 nothing is kept, so no
+request is profiled at all.
+"""
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from flask import g, request
+from service.common import metrics
+from service.common.auth import is_admin
+
+PROFILE_SUFFIX = ".prof"
+
+# cProfile is only imported by the first profiled request, and cannot follow two requests of a worker at once
+_busy = threading.Lock()
+
+
+def wants_profile(config) -> bool:
+    """Returns True if the current request should be profiled"""
+    if config["PROFILE_KEEP"] < 1:
+        return False
+    if request.headers.get("X-Profile") == "1" and is_admin():
+        return True
+    rate = config["PROFILE_SAMPLE_RATE"]
+    return rate > 0 and random.random() < rate
+
+
+def save(profiler, directory, route, seconds, keep):
+    """Writes a profile under the route's directory, keeping the newest keep (at least 1), and returns its id"""
+    folder = os.path.join(directory, route)
+    os.makedirs(folder, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    name = f"{stamp}-{round(seconds * 1000)}ms{PROFILE_SUFFIX}"
+    profiler.dump_stats(os.path.join(folder, name))
+    # keep only the newest profiles of each route
+    for old in sorted(_dumps(folder))[:-keep]:
+        os.remove(os.path.join(folder, old))
+    return f"{route}/{name}"
+
+
+def list_profiles(directory) -> list:
+    """Returns the stored profiles, newest first"""
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for route in sorted(os.listdir(directory)):
+        folder = os.path.join(directory, route)
+        if not os.path.isdir(folder):
+            continue
+        for name in _dumps(folder):
+            stamp, duration = name[: -len(PROFILE_SUFFIX)].rsplit("-", 1)
+            profiles.append(
+                {
+                    "id": f"{route}/{name}",
+                    "route": route,
+                    "created_at": datetime.strptime(stamp, "%Y%m%dT%H%M%S%fZ")
+                    .replace(tzinfo=timezone.utc)
+                    .isoformat(),
+                    "duration_ms": int(duration[:-2]),
+                    "size": os.path.getsize(os.path.join(folder, name)),
+                }
+            )
+    profiles.sort(key=lambda profile: profile["created_at"], reverse=True)
+    return profiles
+
+
+def _dumps(folder):
+    """Returns the names of the profile dumps in a folder"""
+    return [name for name in os.listdir(folder) if name.endswith(PROFILE_SUFFIX)]
+
+
+def init_profiling(app):
+    """Installs the profiling hooks on every request to the app"""
+
+    @app.before_request
+    def start_profile():
+        if not wants_profile(app.config):
+            return
+        if not _busy.acquire(blocking=False):
+            metrics.increment("profiling.skipped")
+            return
+        import cProfile  # pylint: disable=import-outside-toplevel
+
+        profiler = cProfile.Profile()
+        g.profile = (profiler, time.perf_counter())
+        profiler.enable()
+
+    @app.after_request
+    def save_profile(response):
+        profile = g.pop("profile", None)
+        if profile is None:
+            return response
+        profiler, started = profile
+        profiler.disable()
+        _busy.release()
+        response.headers["X-Profile-Id"] = save(
+            profiler,
+            app.config["PROFILE_DIR"],
+            request.endpoint or "unknown",
+            time.perf_counter() - started,
+            app.config["PROFILE_KEEP"],
+        )
+        metrics.increment("profiling.requests")
+        return response
+
+    @app.teardown_request
+    def stop_profile(_exc):
+        # only reached with a profile left when no response was produced
+        profile = g.pop("profile", None)
+        if profile is not None:
+            profile[0].disable()
+            _busy.release()
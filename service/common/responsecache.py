@@ -0,0 +1,151 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+
+"""
+Response Cache
+
+This module keeps the serialized bodies of recent Product listings in
+each worker, keyed by their normalized filters. Every entry remembers the
+ChangeCounter value it was read at, and the counter is bumped in the
+transaction of every Product write by any worker, so an entry is current
+exactly when its generation is still the counter's value. Checking that
+costs one single-row read instead of the listing query and serialization.
+With sharding the generation is the sum of the shards' own counters.
+
+The cache holds at most LIST_CACHE_SIZE bodies and LIST_CACHE_MAX_BYTES
+in all, dropping the least recently used first, and a body larger than
+LIST_CACHE_MAX_ENTRY_BYTES is served without being kept.
+
+With LIST_CACHE_STALE_SECONDS set, an outdated entry keeps being served
+for up to that long while one background thread reloads it, so a busy
+listing never sends a burst of identical queries after a write.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from service.common import metrics
+
+logger = logging.getLogger("flask.app")
+
+
+class _Entry:  # pylint: disable=too-few-public-methods
+    """A cached body, the generation it was read at and its refresh state"""
+
+    __slots__ = ("generation", "body", "stale_since", "refreshing")
+
+    def __init__(self, generation: int, body: bytes):
+        self.generation = generation
+        self.body = body
+        self.stale_since = None
+        self.refreshing = False
+
+
+class ResponseCache:
+    """The latest bodies of up to size listings, validated by generation"""
+
+    def __init__(self, app, config: dict):
+        self.app = app
+        self.size = config["LIST_CACHE_SIZE"]
+        self.max_bytes = config["LIST_CACHE_MAX_BYTES"]
+        self.max_entry_bytes = config["LIST_CACHE_MAX_ENTRY_BYTES"]
+        self.stale_seconds = config["LIST_CACHE_STALE_SECONDS"]
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, generation: int, load):
+        """
+        Returns (generation, body) for key as of generation or later
+
+        load() returns a fresh (generation, body) and is called on a miss,
+        or in the background to revalidate an entry being served stale.
+        """
+        if not self.size:
+            return load()
+        stale = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if entry.generation >= generation:
+                    metrics.increment("listcache.hits")
+                    return entry.generation, entry.body
+                if self._serve_stale(entry):
+                    # only the first request to find it stale reloads it
+                    stale = (entry.generation, entry.body, not entry.refreshing)
+                    entry.refreshing = True
+        if stale is not None:
+            metrics.increment("listcache.stale")
+            if stale[2]:
+                threading.Thread(target=self._refresh, args=(key, load), name="listcache", daemon=True).start()
+            return stale[:2]
+        metrics.increment("listcache.misses")
+        fresh = load()
+        self._store(key, *fresh)
+        return fresh
+
+    def _serve_stale(self, entry: _Entry) -> bool:
+        """Returns True while an outdated entry may still be served"""
+        if not self.stale_seconds:
+            return False
+        now = time.monotonic()
+        if entry.stale_since is None:
+            entry.stale_since = now
+        return now - entry.stale_since < self.stale_seconds
+
+    def _refresh(self, key, load):
+        """Reloads an entry that is being served stale"""
+        metrics.increment("listcache.refreshes")
+        try:
+            with self.app.app_context():
+                self._store(key, *load())
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error("Refreshing a cached listing failed: %s", error)
+        finally:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.refreshing = False
+
+    def _store(self, key, generation: int, body: bytes):
+        """Keeps a body unless a newer one is already cached or it is too large"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.generation <= generation:
+                self._drop(key)
+                if len(body) > self.max_entry_bytes:
+                    metrics.increment("listcache.too_large")
+                else:
+                    self._entries[key] = _Entry(generation, body)
+                    self.bytes += len(body)
+            while len(self._entries) > self.size or self.bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+            metrics.set_gauge("listcache.entries", len(self._entries))
+            metrics.set_gauge("listcache.bytes", self.bytes)
+
+    def _drop(self, key):
+        """Forgets one cached body, if there is one"""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= len(entry.body)
+
+    def clear(self):
+        """Forgets every cached body"""
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
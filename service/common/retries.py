@@ -0,0 +1,137 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Database Retries
+
+This module re-runs a unit of database work that failed for a reason that
+goes away on its own: a dropped connection or failover, a deadlock, a
+serialization failure or a locked SQLite file. Each retry waits longer,
+with jitter so that workers which failed together do not retry together,
+and the retries stop after DB_RETRY_TRIES attempts or once
+DB_RETRY_BUDGET seconds have passed, with DatabaseUnavailable, a 503
+that tells the client when to try again. Constraint violations and other
+errors in the request itself are raised at once.
+
+A connection lost during COMMIT is not retried because the commit may
+have gone through, and running the work again could apply it twice.
+"""
+import logging
+import math
+import time
+from retry.api import retry_call
+from sqlalchemy.exc import DBAPIError
+from werkzeug.exceptions import ServiceUnavailable
+from service.common import metrics
+
+logger = logging.getLogger("flask.app")
+
+# SQLSTATEs of transactions the server rolled back, safe to run again
+ROLLED_BACK = {"40001": "serialization", "40P01": "deadlock"}
+
+# SQLSTATEs of lost or refused connections (class 08, and shutdowns)
+DISCONNECTED = {"57P01", "57P02", "57P03"}
+
+
+class DatabaseUnavailable(ServiceUnavailable):
+    """Raised when a transient database error outlasted every retry"""
+
+    def __init__(self, error, retry_after: int):
+        super().__init__("The database is unavailable, please retry later", retry_after=retry_after)
+        self.error = error
+
+
+class _Retry(Exception):
+    """Carries an error that should be retried through retry_call"""
+
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.error = error
+
+
+def classify(error):
+    """Returns why an error is transient, or None if it is not"""
+    if not isinstance(error, DBAPIError):
+        return None
+    sqlstate = getattr(error.orig, "sqlstate", None) or ""
+    if sqlstate in ROLLED_BACK:
+        return ROLLED_BACK[sqlstate]
+    if error.connection_invalidated or sqlstate.startswith("08") or sqlstate in DISCONNECTED:
+        return "disconnect"
+    if "database is locked" in str(error.orig):
+        return "locked"
+    return None
+
+
+class RetryPolicy:
+    """Runs units of work against a session, retrying transient failures"""
+
+    def __init__(self, config: dict):
+        self.tries = config["DB_RETRY_TRIES"]
+        self.delay = config["DB_RETRY_DELAY"]
+        self.max_delay = config["DB_RETRY_MAX_DELAY"]
+        self.budget = config["DB_RETRY_BUDGET"]
+        # by then the failover or lock that made the retries run out may be over
+        self.retry_after = max(1, math.ceil(self.budget))
+
+    def run(self, name: str, session, work):
+        """
+        Returns work() after committing it, retrying transient failures
+
+        work runs the statements of one transaction and must be safe to run
+        again after a rollback. The session is rolled back after every
+        failure, and DatabaseUnavailable is raised once retrying stops.
+        """
+        deadline = time.monotonic() + self.budget
+        errors = []
+
+        def attempt():
+            if errors:
+                # checked after the sleep, so no attempt starts past the budget
+                if time.monotonic() >= deadline:
+                    metrics.increment(f"db.retry.{name}.out_of_budget")
+                    raise DatabaseUnavailable(errors[-1], self.retry_after) from errors[-1]
+                metrics.increment(f"db.retry.{name}.retries")
+            committing = False
+            try:
+                result = work()
+                committing = True
+                session.commit()
+                return result
+            except Exception as error:
+                session.rollback()
+                reason = classify(error)
+                if reason is None or (committing and reason == "disconnect"):
+                    raise
+                metrics.increment(f"db.retry.errors.{reason}")
+                errors.append(error)
+                raise _Retry(error) from error
+
+        metrics.increment(f"db.retry.{name}.calls")
+        try:
+            return retry_call(
+                attempt,
+                exceptions=_Retry,
+                tries=self.tries,
+                delay=self.delay,
+                max_delay=self.max_delay,
+                backoff=2,
+                jitter=(0, self.delay),
+                logger=logger,
+            )
+        except _Retry as retry:
+            metrics.increment(f"db.retry.{name}.exhausted")
+            raise DatabaseUnavailable(retry.error, self.retry_after) from retry.error
@@ -0,0 +1,200 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+
+"""
+Sharding
+
+This module spreads the Product table over several databases. A Product
+lives on the shard picked by a hash of its id, so reads and writes of one
+Product go to that shard alone, while listings run on every shard at once
+from a thread pool and the sorted results are merged. Ids are handed out
+in blocks reserved from the main database, so they stay unique across
+shards without any coordination between them.
+
+Each shard also has its own change counter, event log and idempotency
+keys, written in the transaction of each write, so a write never touches
+the main database (DATABASE_URI). A relay thread in every worker appends
+the shard logs to the main event log in batches, every
+SHARD_RELAY_INTERVAL seconds or as soon as the worker wrote something.
+"""
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+from service.config import engine_options
+from service.models import db, Product, ProductIdBlock, ChangeCounter, ProductEvent, IdempotencyKey, ShardRelay
+from service.common import metrics
+
+logger = logging.getLogger("flask.app")
+
+# Tables every shard holds, all written in the transaction of a Product write
+SHARD_TABLES = [Product.__table__, ChangeCounter.__table__, ProductEvent.__table__, IdempotencyKey.__table__]
+
+
+def shard_engine(uri: str, config: dict):
+    """Creates the engine of one shard"""
+    if not uri.startswith("sqlite"):
+        options = engine_options(uri, config["DATABASE_PREPARE_THRESHOLD"], config["DATABASE_PGBOUNCER"])
+        return create_engine(uri, **options)
+    # fan-out threads share the connection, and a memory database only
+    # exists for as long as its one connection
+    options = {"connect_args": {"check_same_thread": False}}
+    if uri in ("sqlite://", "sqlite:///:memory:"):
+        options["poolclass"] = StaticPool
+    return create_engine(uri, **options)
+
+
+def merge(results, key, limit=None) -> list:
+    """Merges lists that are each sorted by key into one, keeping the first limit"""
+    return list(itertools.islice(heapq.merge(*results, key=key), limit))
+
+
+class ShardSet:
+    """The databases holding the Products and how ids map to them"""
+
+    def __init__(self, uris: list, config: dict):
+        self.engines = [shard_engine(uri, config) for uri in uris]
+        self.main_engine = db.engine
+        self.block_size = config["SHARD_ID_BLOCK"]
+        self.relay_interval = config["SHARD_RELAY_INTERVAL"]
+        self.relay_batch = config["SHARD_RELAY_BATCH"]
+        # unused ids of the reserved blocks, by the shard they hash to
+        self._free = [deque() for _ in self.engines]
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=len(self.engines), thread_name_prefix="shard")
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._relay_thread = None
+        for engine in self.engines:
+            db.metadata.create_all(engine, tables=SHARD_TABLES)
+
+    def shard_for(self, product_id: int) -> int:
+        """Returns the index of the shard that holds a Product"""
+        return zlib.crc32(str(product_id).encode("ascii")) % len(self.engines)
+
+    def shard_of_key(self, key: str) -> int:
+        """Returns the index of the shard that holds an idempotency key"""
+        return zlib.crc32(key.encode("utf-8")) % len(self.engines)
+
+    def session(self, product_id: int) -> Session:
+        """Returns a new session on the shard that holds a Product"""
+        return Session(self.engines[self.shard_for(product_id)])
+
+    def allocate_id(self, shard=None) -> int:
+        """Returns a Product id no other worker will use, on the given shard or the lowest free one"""
+        with self._lock:
+            while not (self._free[shard] if shard is not None else any(self._free)):
+                start = ProductIdBlock.reserve(self.block_size)
+                for product_id in range(start, start + self.block_size):
+                    self._free[self.shard_for(product_id)].append(product_id)
+                metrics.increment("sharding.id_blocks")
+            if shard is None:
+                shard = min((ids[0], index) for index, ids in enumerate(self._free) if ids)[1]
+            return self._free[shard].popleft()
+
+    def group(self, ids) -> dict:
+        """Returns the given ids by the index of the shard holding them"""
+        groups = {}
+        for product_id in ids:
+            groups.setdefault(self.shard_for(product_id), []).append(product_id)
+        return groups
+
+    def read(self, query, key, limit=None, shards=None) -> list:
+        """
+        Returns the rows of query(session) from every shard, merged by key
+
+        query runs on all shards, or on the given shard indexes, in
+        parallel and must return its rows sorted by key. The sessions are
+        closed before returning, so ORM instances come back detached with
+        their loaded attributes. Each query runs in a copy of the caller's
+        context, so its SQL is traced as part of the caller's span.
+        """
+        shards = range(len(self.engines)) if shards is None else shards
+        metrics.increment("sharding.fanouts")
+
+        def run(index):
+            with Session(self.engines[index]) as session:
+                return query(session)
+
+        contexts = [contextvars.copy_context() for _ in shards]
+        return merge(self._executor.map(lambda context, index: context.run(run, index), contexts, shards), key, limit)
+
+    def relay(self, index: int) -> int:
+        """Appends the next batch of a shard's events to the main log and returns how many"""
+        with Session(self.main_engine) as main:
+            seq = ShardRelay.lock(main, index)
+            events = ProductEvent.since(seq, limit=self.relay_batch, engine=self.engines[index])
+            if not events:
+                return 0
+            last = events[-1]["seq"]
+            ProductEvent.append(main, events)
+            ShardRelay.advance(main, index, last)
+            main.commit()
+        # the shard no longer needs what the main log holds
+        with self.engines[index].begin() as conn:
+            conn.execute(db.delete(ProductEvent.__table__).where(ProductEvent.__table__.c.seq <= last))
+        metrics.increment("sharding.relayed", len(events))
+        return len(events)
+
+    def relay_all(self) -> int:
+        """Appends every waiting event of every shard to the main log and returns how many"""
+        count = 0
+        for index in range(len(self.engines)):
+            while True:
+                relayed = self.relay(index)
+                count += relayed
+                if relayed < self.relay_batch:
+                    break
+        return count
+
+    def wake_relay(self):
+        """Asks the relay thread to run now, after this worker wrote to a shard"""
+        self._wake.set()
+
+    def start_relay(self):
+        """Starts the thread that keeps relaying the shard logs"""
+        self._relay_thread = threading.Thread(target=self._run_relay, name="shard-relay", daemon=True)
+        self._relay_thread.start()
+
+    def _run_relay(self):
+        """Relays whenever woken, or every relay_interval, until disposed"""
+        while not self._stop.is_set():
+            self._wake.wait(self.relay_interval)
+            self._wake.clear()
+            try:
+                self.relay_all()
+            except Exception as error:  # pylint: disable=broad-except
+                # nothing is lost, the events wait on their shard for the next round
+                logger.error("Shard relay failed: %s", error)
+                metrics.increment("sharding.relay_errors")
+
+    def dispose(self):
+        """Stops the relay and the thread pool and closes every shard connection"""
+        self._stop.set()
+        self._wake.set()
+        if self._relay_thread is not None:
+            self._relay_thread.join()
+        self._executor.shutdown()
+        for engine in self.engines:
+            engine.dispose()
@@ -0,0 +1,90 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Single Flight
+
+This module collapses concurrent identical calls within a worker into one.
+The first thread to ask for a key runs the call and every thread that asks
+for the same key while it is running waits for, and shares, its result.
+Results are shared between threads, so they must be plain data that no
+caller modifies, never ORM instances bound to the leader's session. A
+writer forgets the key it changed, so a caller arriving after the write
+starts a new call instead of sharing one that may have read the old data.
+"""
+import threading
+from service.common import metrics
+
+
+class _Call:  # pylint: disable=too-few-public-methods
+    """A call in progress and, once done, its outcome"""
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time and shares its result"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """Returns func(), sharing the result with concurrent callers of key"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            self._record("shared")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as error:  # pylint: disable=broad-except
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+            self._record("leaders")
+        return call.result
+
+    def forget(self, key):
+        """Lets the next caller of key start a new call rather than join the running one"""
+        with self._lock:
+            self._calls.pop(key, None)
+
+    def _record(self, outcome: str):
+        """Counts a call and updates the collapse ratio"""
+        metrics.increment(f"singleflight.{self.name}.{outcome}")
+        leaders = metrics.counter(f"singleflight.{self.name}.leaders")
+        shared = metrics.counter(f"singleflight.{self.name}.shared")
+        if leaders + shared:
+            metrics.set_gauge(f"singleflight.{self.name}.collapse_ratio", shared / (leaders + shared))
@@ -0,0 +1,58 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Statement Cache
+
+This module keeps the SELECT statements built for each shape of query, so
+a request with the same set of filters as an earlier one reuses the same
+statement object with new parameter values. SQLAlchemy remembers the cache
+key of a statement object and the SQL compiled for that key, so reusing
+it skips building the query, generating its key and compiling it. Keys
+must come from a small, fixed set such as the combinations of filters.
+"""
+import threading
+from service.common import metrics
+
+
+class StatementCache:
+    """Statements built once per key and reused, with hit rate metrics"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._statements = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """Returns the statement for key, calling build() the first time"""
+        statement = self._statements.get(key)
+        if statement is None:
+            with self._lock:
+                statement = self._statements.setdefault(key, build())
+            self._record("misses")
+        else:
+            self._record("hits")
+        return statement
+
+    def __len__(self):
+        return len(self._statements)
+
+    def _record(self, outcome: str):
+        """Counts a lookup and updates the hit rate"""
+        metrics.increment(f"statements.{self.name}.{outcome}")
+        hits = metrics.counter(f"statements.{self.name}.hits")
+        misses = metrics.counter(f"statements.{self.name}.misses")
+        metrics.set_gauge(f"statements.{self.name}.hit_rate", hits / (hits + misses))
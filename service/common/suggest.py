@@ -0,0 +1,147 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+
+"""
+Name Suggestions
+
+This module answers prefix searches on Product names from memory. Each
+worker keeps every name, lowercased, in one sorted list and finds the
+names that start with a prefix with a binary search. The list is loaded
+on first use and kept current by replaying the change events of every
+create, update and delete, at most once every SUGGEST_REFRESH_SECONDS.
+A catalog with more than SUGGEST_MAX_NAMES named Products is not loaded,
+and its suggestions come from the lower(name) index instead until
+deletions bring it back under the limit. Products without a name are
+never suggested.
+"""
+import bisect
+import json
+import threading
+import time
+from service.models import Product, ProductEvent
+from service.common import metrics
+
+# Events replayed per catch up, an index further behind is reloaded
+BATCH_SIZE = 1000
+
+
+def sort_key(product_id: int, name: str) -> tuple:
+    """Returns the position of a name in the index, alphabetical and then by id"""
+    return (name.lower(), product_id)
+
+
+class NameIndex:
+    """Product names sorted for prefix search, maintained from the event log"""
+
+    def __init__(self, engine, config: dict):
+        self.engine = engine
+        self.max_names = config["SUGGEST_MAX_NAMES"]
+        self.refresh = config["SUGGEST_REFRESH_SECONDS"]
+        self.last_seq = None
+        self.checked = 0.0
+        # too many Products to hold, suggestions come from the database
+        self.overflow = False
+        self._keys = []
+        self._names = {}
+        self._lock = threading.Lock()
+
+    def suggest(self, prefix: str, limit: int) -> list:
+        """Returns up to limit Products whose name starts with prefix as dictionaries"""
+        self.catch_up()
+        if self.overflow:
+            metrics.increment("suggest.database")
+            return [{"id": row.id, "name": row.name} for row in Product.suggest_names(prefix, limit)]
+        metrics.increment("suggest.memory")
+        prefix = prefix.lower()
+        results = []
+        with self._lock:
+            index = bisect.bisect_left(self._keys, (prefix,))
+            for name, product_id in self._keys[index:index + limit]:
+                if not name.startswith(prefix):
+                    break
+                results.append({"id": product_id, "name": self._names[product_id]})
+        return results
+
+    def load(self):
+        """Reloads every name from the database"""
+        metrics.increment("suggest.loads")
+        # read the event position first so nothing written meanwhile is lost
+        seq = ProductEvent.latest_seq(self.engine)
+        rows = Product.names(self.max_names + 1)
+        with self._lock:
+            self.overflow = len(rows) > self.max_names
+            rows = [] if self.overflow else rows
+            self._names = {row.id: row.name for row in rows}
+            self._keys = sorted(sort_key(row.id, row.name) for row in rows)
+            self.last_seq = seq
+            metrics.set_gauge("suggest.names", len(self._keys))
+
+    def catch_up(self):
+        """Applies the changes made since the index was last current"""
+        now = time.monotonic()
+        with self._lock:
+            last_seq = self.last_seq
+            if last_seq is not None and now - self.checked < self.refresh:
+                return
+            self.checked = now
+        if last_seq is None:
+            self.load()
+            return
+        events = ProductEvent.since(last_seq, limit=BATCH_SIZE, engine=self.engine)
+        # sequence numbers are dense, so a gap means events were pruned
+        complete = len(events) < BATCH_SIZE and not (events and events[0]["seq"] != last_seq + 1)
+        if self.overflow:
+            self._recheck(events, complete)
+            return
+        if not complete:
+            self.load()
+            return
+        with self._lock:
+            for event in events:
+                if event["seq"] > self.last_seq:
+                    self._apply(event)
+                    self.last_seq = event["seq"]
+            metrics.set_gauge("suggest.names", len(self._keys))
+        if len(self._keys) > self.max_names:
+            self.load()
+
+    def _recheck(self, events: list, complete: bool):
+        """Loads an overflowing catalog again once deletions may have made it fit"""
+        shrunk = not complete or any(
+            event["action"] == "deleted" or json.loads(event["data"])["name"] is None for event in events
+        )
+        if shrunk and Product.count_names(self.max_names + 1) <= self.max_names:
+            self.load()
+            return
+        if events:
+            with self._lock:
+                self.last_seq = max(self.last_seq, events[-1]["seq"])
+
+    def _apply(self, event: dict):
+        """Adds, renames or removes the Product an event is about"""
+        product_id = event["product_id"]
+        name = self._names.pop(product_id, None)
+        if name is not None:
+            key = sort_key(product_id, name)
+            del self._keys[bisect.bisect_left(self._keys, key)]
+        if event["action"] == "deleted":
+            return
+        name = json.loads(event["data"])["name"]
+        if name is None:
+            return
+        self._names[product_id] = name
+        bisect.insort(self._keys, sort_key(product_id, name))
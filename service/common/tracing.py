@@ -0,0 +1,272 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Tracing
+
+This module records where the time of a request goes as a tree of spans:
+one for the route, one for every Product method it calls and one for
+every SQL statement. A request is traced when the caller's W3C
+traceparent says it was sampled, or when it is picked by
+TRACE_SAMPLE_RATE. Each finished trace is appended to TRACE_FILE as one
+line of OTLP/JSON, which an OpenTelemetry collector's file receiver can
+read. Requests that are not traced pay for one context variable lookup
+per instrumented call.
+"""
+import contextvars
+import functools
+import json
+import random
+import re
+import secrets
+import threading
+import time
+import types
+from contextlib import contextmanager
+from flask import g, request
+from sqlalchemy import event
+from service.common import metrics
+
+# version-traceid-parentid-flags, https://www.w3.org/TR/trace-context/
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+# OTLP span kinds
+KINDS = {"INTERNAL": 1, "SERVER": 2, "CLIENT": 3}
+
+_current = contextvars.ContextVar("span", default=None)
+_file_lock = threading.Lock()
+
+
+class Trace:  # pylint: disable=too-few-public-methods
+    """The spans recorded for one request"""
+
+    def __init__(self, trace_id: str, max_spans: int):
+        self.trace_id = trace_id
+        self.max_spans = max_spans
+        self.spans = []
+        self.dropped = 0
+        # spans of a request may finish on the threads it fans out to
+        self.lock = threading.Lock()
+
+
+class Span:
+    """A timed operation within a trace"""
+
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start", "end", "attributes", "error")
+
+    def __init__(self, trace, name, kind="INTERNAL", parent_id=None, attributes=None):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    def finish(self):
+        """Ends the span and adds it to its trace"""
+        self.end = time.time_ns()
+        with self.trace.lock:
+            if len(self.trace.spans) < self.trace.max_spans:
+                self.trace.spans.append(self)
+            else:
+                self.trace.dropped += 1
+
+    def to_otlp(self) -> dict:
+        """Returns the span in OTLP/JSON form"""
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": KINDS[self.kind],
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [
+                {"key": key, "value": {"stringValue": str(value)}} for key, value in self.attributes.items()
+            ],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 0},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def start_span(name, kind="INTERNAL", **attributes):
+    """Starts a child of the current span, or returns None when not tracing"""
+    parent = _current.get()
+    if parent is None:
+        return None
+    return Span(parent.trace, name, kind, parent.span_id, attributes)
+
+
+@contextmanager
+def span(name, kind="INTERNAL", **attributes):
+    """Runs the body of the with statement in a child span of the current one"""
+    child = start_span(name, kind, **attributes)
+    if child is None:
+        yield None
+        return
+    token = _current.set(child)
+    try:
+        yield child
+    except Exception as error:
+        child.error = str(error)
+        raise
+    finally:
+        child.finish()
+        _current.reset(token)
+
+
+def traced(func, name):
+    """Wraps func so every call while tracing gets its own span"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _current.get() is None:
+            return func(*args, **kwargs)
+        with span(name):
+            return func(*args, **kwargs)
+
+    wrapper.__traced__ = True
+    return wrapper
+
+
+def instrument(cls):
+    """Traces every public method and classmethod defined on cls"""
+    for attr, value in list(vars(cls).items()):
+        if attr.startswith("_"):
+            continue
+        name = f"{cls.__name__}.{attr}"
+        if isinstance(value, classmethod) and not hasattr(value.__func__, "__traced__"):
+            setattr(cls, attr, classmethod(traced(value.__func__, name)))
+        elif isinstance(value, types.FunctionType) and not hasattr(value, "__traced__"):
+            setattr(cls, attr, traced(value, name))
+
+
+def parse_traceparent(header):
+    """Returns (trace_id, parent_id, sampled) from a traceparent header, or None"""
+    match = TRACEPARENT.match((header or "").strip().lower())
+    if not match:
+        return None
+    trace_id, parent_id, flags = match.groups()
+    if trace_id == "0" * 32 or parent_id == "0" * 16:
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+def to_otlp(trace, service_name) -> dict:
+    """Returns a trace as an OTLP/JSON ExportTraceServiceRequest"""
+    return {
+        "resourceSpans": [
+            {
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+                "scopeSpans": [
+                    {"scope": {"name": "service.common.tracing"}, "spans": [s.to_otlp() for s in trace.spans]}
+                ],
+            }
+        ]
+    }
+
+
+def export(path, trace, service_name):
+    """Appends a finished trace to the trace file"""
+    line = json.dumps(to_otlp(trace, service_name))
+    with _file_lock:
+        with open(path, "a", encoding="utf-8") as output:
+            output.write(line + "\n")
+    metrics.increment("tracing.traces")
+    if trace.dropped:
+        metrics.increment("tracing.dropped_spans", trace.dropped)
+
+
+def start_request_span(config):
+    """Returns the root span of the current request, or None if it is not sampled"""
+    incoming = parse_traceparent(request.headers.get("traceparent"))
+    if incoming:
+        trace_id, parent_id, sampled = incoming
+    else:
+        trace_id, parent_id = secrets.token_hex(16), None
+        sampled = random.random() < config["TRACE_SAMPLE_RATE"]
+    if not sampled:
+        return None
+    rule = request.url_rule.rule if request.url_rule else request.path
+    return Span(
+        Trace(trace_id, config["TRACE_MAX_SPANS"]),
+        f"{request.method} {rule}",
+        "SERVER",
+        parent_id,
+        {"http.method": request.method, "http.target": request.full_path},
+    )
+
+
+def init_tracing(app, engine, classes=()):
+    """Traces requests, the methods of classes and the SQL sent to engine"""
+    for cls in classes:
+        instrument(cls)
+
+    @app.before_request
+    def start_trace():
+        if app.config["TRACE_FILE"]:
+            root = start_request_span(app.config)
+            if root is not None:
+                g.trace = (root, _current.set(root))
+
+    @app.after_request
+    def tag_trace(response):
+        if "trace" in g:
+            root = g.trace[0]
+            root.attributes["http.status_code"] = response.status_code
+            response.headers["traceparent"] = f"00-{root.trace.trace_id}-{root.span_id}-01"
+        return response
+
+    @app.teardown_request
+    def finish_trace(exc):
+        if "trace" not in g:
+            return
+        root, token = g.pop("trace")
+        if exc is not None:
+            root.error = str(exc)
+        root.finish()
+        _current.reset(token)
+        export(app.config["TRACE_FILE"], root.trace, app.name)
+
+    instrument_engine(engine)
+
+
+def instrument_engine(engine, **attributes):
+    """Gives every SQL statement sent to engine while tracing its own span, with the given attributes"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_sql_span(_conn, _cursor, statement, _parameters, context, _executemany):
+        context.trace_span = start_span(
+            "SQL " + statement.lstrip().split(" ", 1)[0].upper(), "CLIENT", **attributes, **{"db.statement": statement}
+        )
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def finish_sql_span(_conn, _cursor, _statement, _parameters, context, _executemany):
+        if getattr(context, "trace_span", None) is not None:
+            context.trace_span.finish()
+            context.trace_span = None
+
+    @event.listens_for(engine, "handle_error")
+    def fail_sql_span(exception_context):
+        context = exception_context.execution_context
+        if getattr(context, "trace_span", None) is not None:
+            context.trace_span.error = str(exception_context.original_exception)
+            context.trace_span.finish()
+            context.trace_span = None
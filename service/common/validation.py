@@ -0,0 +1,153 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Request Validation
+
+This module checks Product payloads against the column definitions of the
+product table before anything is sent to the database. The checks for
+each field are built once, when a Schema is created, from the column's
+type, length, precision and nullability plus any extra rules, so
+validating a request only runs a few prebuilt functions and every bad
+field is reported at once instead of the first one the database trips on.
+"""
+from decimal import Decimal, InvalidOperation
+from sqlalchemy import Integer, Numeric, String
+
+
+class ValidationError(Exception):
+    """Used when a request body breaks the schema, with one message per field"""
+
+    def __init__(self, errors: dict, message: str = "Invalid Product"):
+        details = "; ".join(f"{field} {error}" for field, error in errors.items())
+        super().__init__(f"{message}: {details}" if details else message)
+        self.errors = errors
+
+
+def _string_check(column):
+    """Builds the check for a VARCHAR column"""
+    length = column.type.length
+
+    def check(value):
+        if not isinstance(value, str):
+            return "must be a string"
+        if length is not None and len(value) > length:
+            return f"must be at most {length} characters"
+        return None
+
+    return check
+
+
+def _integer_check(_column):
+    """Builds the check for an INTEGER column"""
+
+    def check(value):
+        if isinstance(value, bool) or not isinstance(value, int):
+            return "must be an integer"
+        return None
+
+    return check
+
+
+def _numeric_check(column):
+    """Builds the check for a NUMERIC(precision, scale) column"""
+    scale = column.type.scale or 0
+    # the largest value that fits, e.g. 99999999.99 for NUMERIC(10, 2)
+    limit = Decimal(10) ** (column.type.precision - scale)
+
+    def check(value):
+        if isinstance(value, bool) or not isinstance(value, (int, float, str, Decimal)):
+            return "must be a number"
+        try:
+            number = Decimal(str(value))
+        except InvalidOperation:
+            return "must be a number"
+        if not number.is_finite():
+            return "must be a finite number"
+        if number.as_tuple().exponent < -scale:
+            return f"must have at most {scale} decimal places"
+        if abs(number) >= limit:
+            return f"must be less than {limit}"
+        return None
+
+    return check
+
+
+def _minimum_check(minimum):
+    """Builds the check for a lower bound"""
+
+    def check(value):
+        if Decimal(str(value)) < minimum:
+            return f"must be at least {minimum}"
+        return None
+
+    return check
+
+
+# The check built for each kind of column type
+TYPE_CHECKS = [
+    (String, _string_check),
+    (Numeric, _numeric_check),
+    (Integer, _integer_check),
+]
+
+
+class Schema:
+    """The compiled checks for a set of columns of a table"""
+
+    def __init__(self, table, fields, minimums=None):
+        self.fields = tuple(fields)
+        self._nullable = {field: table.c[field].nullable for field in self.fields}
+        self._checks = {}
+        for field in self.fields:
+            column = table.c[field]
+            checks = [build(column) for kind, build in TYPE_CHECKS if isinstance(column.type, kind)][:1]
+            if minimums and field in minimums:
+                checks.append(_minimum_check(minimums[field]))
+            self._checks[field] = checks
+
+    def validate(self, data, partial=False):
+        """
+        Raises ValidationError unless data is a valid payload
+
+        Every field is required unless partial is True, in which case only
+        the fields present are checked. Fields outside the schema are
+        left alone.
+        """
+        if not isinstance(data, dict):
+            raise ValidationError({}, "Invalid Product: body of request must be a JSON object")
+        errors = {}
+        for field in self.fields:
+            if field not in data:
+                if not partial:
+                    errors[field] = "is required"
+                continue
+            error = self._check(field, data[field])
+            if error:
+                errors[field] = error
+        if errors:
+            raise ValidationError(errors)
+        return data
+
+    def _check(self, field, value):
+        """Returns what is wrong with one value, or None if nothing is"""
+        if value is None:
+            return None if self._nullable[field] else "may not be null"
+        for check in self._checks[field]:
+            error = check(value)
+            if error:
+                return error
+        return None
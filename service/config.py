@@ -2,7 +2,9 @@
 Global Configuration for Application
 """
 import os
+import tempfile
 import logging
+from urllib.parse import urlsplit
 
 # Get configuration from environment
 DATABASE_URI = os.getenv(
@@ -15,6 +17,163 @@ SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 # SQLALCHEMY_POOL_SIZE = 2
 
+# psycopg prepares a statement on the server once a connection has run it
+# this many times, so PostgreSQL plans it only once (empty = never).
+# PgBouncer in transaction pooling mode hands each transaction a different
+# server connection, so preparing is turned off behind it: when
+# DATABASE_PGBOUNCER is true, or "auto" and the URI uses PgBouncer's 6432.
+DATABASE_PREPARE_THRESHOLD = os.getenv("DATABASE_PREPARE_THRESHOLD", "5")
+DATABASE_PGBOUNCER = os.getenv("DATABASE_PGBOUNCER", "auto").lower()
+
+
+def engine_options(uri, threshold, pgbouncer):
+    """Returns the SQLAlchemy engine options for the database URI"""
+    if not uri.startswith("postgresql+psycopg"):
+        return {}
+    if pgbouncer == "auto":
+        behind_pgbouncer = urlsplit(uri).port == 6432
+    else:
+        behind_pgbouncer = pgbouncer in ("true", "1", "yes")
+    prepare = int(threshold) if threshold and not behind_pgbouncer else None
+    return {"connect_args": {"prepare_threshold": prepare}}
+
+
+SQLALCHEMY_ENGINE_OPTIONS = engine_options(DATABASE_URI, DATABASE_PREPARE_THRESHOLD, DATABASE_PGBOUNCER)
+
+# Sharding: comma separated URIs of the databases the Products are spread
+# over by a hash of their id (empty keeps them in DATABASE_URI), how many
+# ids a worker reserves at a time, and how often and how many events at a
+# time each worker moves from the shard logs to the main event log
+DATABASE_SHARDS = [uri.strip() for uri in os.getenv("DATABASE_SHARDS", "").split(",") if uri.strip()]
+SHARD_ID_BLOCK = int(os.getenv("SHARD_ID_BLOCK", "100"))
+SHARD_RELAY_INTERVAL = float(os.getenv("SHARD_RELAY_INTERVAL", "1"))
+SHARD_RELAY_BATCH = int(os.getenv("SHARD_RELAY_BATCH", "1000"))
+
+# Retries of database writes that failed for a transient reason: attempts,
+# the first delay and the longest delay in seconds (doubled each time, with
+# jitter), and the seconds after which no new attempt is started
+DB_RETRY_TRIES = int(os.getenv("DB_RETRY_TRIES", "4"))
+DB_RETRY_DELAY = float(os.getenv("DB_RETRY_DELAY", "0.01"))
+DB_RETRY_MAX_DELAY = float(os.getenv("DB_RETRY_MAX_DELAY", "0.2"))
+DB_RETRY_BUDGET = float(os.getenv("DB_RETRY_BUDGET", "1"))
+
+# Group commit: when on, concurrent Product writes within a worker wait up
+# to GROUP_COMMIT_WINDOW_MS milliseconds, or until GROUP_COMMIT_MAX_BATCH
+# have arrived, and are committed together in one transaction. A write whose
+# batch has not started committing after GROUP_COMMIT_WAIT_MS commits alone
+GROUP_COMMIT = os.getenv("GROUP_COMMIT", "false").lower() in ("true", "1", "yes")
+GROUP_COMMIT_WINDOW_MS = float(os.getenv("GROUP_COMMIT_WINDOW_MS", "2"))
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "32"))
+GROUP_COMMIT_WAIT_MS = float(os.getenv("GROUP_COMMIT_WAIT_MS", "1000"))
+
+# Cache-Control sent with Product representations. The default makes
+# clients and proxies revalidate with If-None-Match on every use.
+CACHE_CONTROL = os.getenv("CACHE_CONTROL", "no-cache")
+
+# Seconds an Idempotency-Key is remembered before it may be reused
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+
+# Admission control: most requests a worker serves at once (0 = no limit),
+# the share of those that may be writes, and the share of the connection
+# pool in use above which writes are shed. Shed requests get a 503 with
+# Retry-After seconds.
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "64"))
+ADMISSION_WRITE_SHARE = float(os.getenv("ADMISSION_WRITE_SHARE", "0.75"))
+ADMISSION_POOL_THRESHOLD = float(os.getenv("ADMISSION_POOL_THRESHOLD", "0.9"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+
+# Per-client token bucket (0 = no rate limit). Clients are told apart by
+# their address, taken from X-Forwarded-For only for the TRUSTED_PROXIES
+# proxies (load balancer, ingress) known to sit in front of the service
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", "0"))
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "0"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "20"))
+
+# Serialized GET /products listings each worker keeps (0 turns the cache
+# off), the most bytes they may take together and one of them may take
+# (larger listings are never cached), and the seconds an outdated listing
+# may still be served while it is reloaded in the background (0 always
+# waits for the current one)
+LIST_CACHE_SIZE = int(os.getenv("LIST_CACHE_SIZE", "256"))
+LIST_CACHE_MAX_BYTES = int(os.getenv("LIST_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+LIST_CACHE_MAX_ENTRY_BYTES = int(os.getenv("LIST_CACHE_MAX_ENTRY_BYTES", str(1024 * 1024)))
+LIST_CACHE_STALE_SECONDS = float(os.getenv("LIST_CACHE_STALE_SECONDS", "0"))
+
+# Share one database query between concurrent identical reads
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "true").lower() in ("true", "1", "yes")
+
+# Change feed (GET /products/events): seconds between polls when LISTEN is
+# not available (and the longest a LISTEN waits), seconds between
+# keep-alives, seconds before a stream is closed for the client to resume,
+# the reconnect delay suggested to clients, subscribers per worker (each
+# holds one of its 8 gthread threads, so some are left for other requests)
+# and events buffered per subscriber
+EVENT_POLL_INTERVAL = float(os.getenv("EVENT_POLL_INTERVAL", "1"))
+EVENT_HEARTBEAT = float(os.getenv("EVENT_HEARTBEAT", "15"))
+EVENT_STREAM_TIMEOUT = float(os.getenv("EVENT_STREAM_TIMEOUT", "300"))
+EVENT_RETRY_MS = int(os.getenv("EVENT_RETRY_MS", "3000"))
+EVENT_MAX_SUBSCRIBERS = int(os.getenv("EVENT_MAX_SUBSCRIBERS", "4"))
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "1000"))
+
+# Seconds change events are kept for resuming feeds and delta syncs
+EVENT_RETENTION = int(os.getenv("EVENT_RETENTION", "604800"))
+
+# Most change events a single delta sync reads, the rest are left for the next
+SYNC_BATCH_SIZE = int(os.getenv("SYNC_BATCH_SIZE", "1000"))
+
+# Most ids a single batch get may ask for
+BATCH_GET_MAX_IDS = int(os.getenv("BATCH_GET_MAX_IDS", "1000"))
+
+# Most liked Products each worker keeps in memory for GET /products/top,
+# which is also the largest n a client may ask for
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", "100"))
+
+# Name suggestions: most Product names each worker keeps in memory (larger
+# catalogs are searched in the database), seconds between checks for
+# changes, and the most suggestions a client may ask for. A name costs
+# about 250 bytes, so the default index takes about 5 MB of a worker's
+# MEMORY_SOFT_LIMIT_MB
+SUGGEST_MAX_NAMES = int(os.getenv("SUGGEST_MAX_NAMES", "20000"))
+SUGGEST_REFRESH_SECONDS = float(os.getenv("SUGGEST_REFRESH_SECONDS", "1"))
+SUGGEST_MAX_LIMIT = int(os.getenv("SUGGEST_MAX_LIMIT", "50"))
+
+# Token admins send as X-Admin-Token to use debugging features such as
+# ?explain=1 (empty disables them)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# Background jobs: where job output files are written, how many jobs a
+# worker runs at once, whether each app process also runs a worker (the
+# alternative being `flask jobs-worker`), the seconds between looks for
+# new jobs and between progress reports, the seconds without a report
+# after which a job is taken over, how often it may be taken over, and
+# the most jobs that may wait before POST /jobs answers 503
+JOB_DIR = os.getenv("JOB_DIR", os.path.join(tempfile.gettempdir(), "product-jobs"))
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "2"))
+JOB_IN_PROCESS = os.getenv("JOB_IN_PROCESS", "false").lower() in ("true", "1", "yes")
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+JOB_PROGRESS_INTERVAL = float(os.getenv("JOB_PROGRESS_INTERVAL", "1"))
+JOB_LEASE = int(os.getenv("JOB_LEASE", "300"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "100"))
+
+# Request profiling: where the cProfile dumps are kept, how many are kept
+# per route (0 turns profiling off), and the share of all requests profiled
+# without X-Profile: 1
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "product-profiles"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+
+# Tracing: the file finished traces are appended to as OTLP/JSON lines
+# (empty disables tracing), the share of requests without a sampled
+# traceparent that are traced, and the most spans kept per trace
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "1000"))
+
+# RSS in MB above which a gunicorn worker is recycled once its current
+# request is done (0 = never). Keep it below the container memory limit.
+MEMORY_SOFT_LIMIT_MB = int(os.getenv("MEMORY_SOFT_LIMIT_MB", "0"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
 LOGGING_LEVEL = logging.INFO
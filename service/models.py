@@ -3,25 +3,659 @@ Models for Product
 
 All of the models are stored in this module
 """
+# pylint: disable=too-many-lines
 
+import hashlib
+import heapq
+import json
 import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, any_, bindparam, inspect
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, make_transient, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from service.common.statements import StatementCache
+from service.common.validation import Schema
 
 logger = logging.getLogger("flask.app")
 
+# Number of rows fetched per round-trip when streaming an export
+EXPORT_BATCH_SIZE = 1000
+
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
 
+# Product SELECTs by filter shape, shared by every request
+product_selects = StatementCache("product")
+
 
 class DataValidationError(Exception):
     """Used for data validation errors when deserializing"""
 
 
-class Product(db.Model):
+class VersionConflictError(Exception):
+    """Used when a Product was changed since the caller last read it"""
+
+
+def utcnow():
+    """Returns the current time as an aware UTC datetime"""
+    return datetime.now(timezone.utc)
+
+
+def commit_with_retries(name, work):
+    """
+    Runs work() and commits it, retrying transient database errors
+
+    With GROUP_COMMIT on, the work is handed to the worker's GroupCommit
+    and may be committed in one transaction with concurrent writes, so it
+    must only run statements and return plain data.
+    """
+    group = current_app.extensions.get("group_commit")
+    if group is not None:
+        return group.submit(name, work)
+    return current_app.extensions["db_retry"].run(name, db.session, work)
+
+
+def product_shards():
+    """Returns the ShardSet holding the Products when sharding is on, otherwise None"""
+    return current_app.extensions.get("shards")
+
+
+def write_product(name, product_id, execute, record):
+    """
+    Runs a write to one Product and logs it, returning what execute returned
+
+    execute(session) runs the statement on the database holding the
+    Product and record(session, result) logs the change in the same
+    transaction. With sharding that is the shard's own event log, an
+    outbox the ShardSet relays to the main log after the commit, so the
+    write, its event and its idempotency key commit or fail together and
+    no two shards ever wait on the same row. Reads of the Product already
+    in flight in this worker are forgotten, so later readers see the write.
+    """
+    shards = product_shards()
+    if shards is None:
+
+        def work():
+            result = execute(db.session)
+            record(db.session, result)
+            return result
+
+        result = commit_with_retries(name, work)
+    else:
+        with shards.session(product_id) as session:
+
+            def shard_work():
+                result = execute(session)
+                record(session, result)
+                return result
+
+            result = current_app.extensions["db_retry"].run(name, session, shard_work)
+        shards.wake_relay()
+    # reads of the Product that started before the commit may have missed it
+    reads = current_app.extensions.get("product_reads")
+    if reads is not None and product_id is not None:
+        reads.forget(product_id)
+    return result
+
+
+def write_generation(product_id=None):
+    """
+    Returns a number that grows with every write to the Products, or to
+    the one Product given
+
+    It is the ChangeCounter, or with sharding the sum of the counters of
+    every shard (of the Product's shard alone when product_id is given),
+    which each grow in the transaction of every write to their shard.
+    """
+    shards = product_shards()
+    if shards is None:
+        return ChangeCounter.current()
+    if product_id is not None:
+        with shards.session(product_id) as session:
+            return ChangeCounter.current(session)
+    return sum(shards.read(lambda session: [ChangeCounter.current(session)], key=int))
+
+
+@contextmanager
+def product_session(product_id):
+    """Yields the session to read a Product with, its shard's when sharding"""
+    shards = product_shards()
+    if shards is None:
+        yield db.session
+        return
+    with shards.session(product_id) as session:
+        yield session
+
+
+@contextmanager
+def key_session(key):
+    """Yields the session to read an IdempotencyKey with, its shard's when sharding"""
+    shards = product_shards()
+    if shards is None:
+        yield db.session
+        return
+    with Session(shards.engines[shards.shard_of_key(key)]) as session:
+        yield session
+
+
+def stream_rows(engine, statement, batch_size):
+    """Yields the rows of a SELECT as dictionaries, batch_size at a time from a read-only snapshot"""
+    with engine.connect() as conn:
+        if conn.dialect.name == "postgresql":
+            conn = conn.execution_options(
+                isolation_level="REPEATABLE READ", postgresql_readonly=True
+            )
+        result = conn.execution_options(yield_per=batch_size).execute(statement)
+        for row in result.mappings():
+            yield dict(row)
+
+
+def updated_row(statement):
+    """Returns an execute function for write_product that runs an UPDATE ... RETURNING"""
+    return lambda session: session.execute(statement).mappings().first()
+
+
+def record_update(session, row):
+    """Logs the Product an UPDATE ... RETURNING changed, if it found one"""
+    if row:
+        ProductEvent.record("updated", row["id"], Product(**row).serialize(), session)
+
+
+def as_utc(value):
+    """Attaches UTC to datetimes read back from databases that drop the zone"""
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def isoformat(value):
+    """Renders a stored datetime as an ISO 8601 string in UTC"""
+    return as_utc(value).isoformat() if value is not None else None
+
+
+class IdempotencyKey(db.Model):
+    """
+    Remembers the response to a request sent with an Idempotency-Key
+
+    The key is written in the same transaction as the resource it created,
+    so a retried request either finds the original response or creates
+    the resource exactly once. With sharding a key lives on the shard its
+    key hashes to, and the Product it creates is given an id on that shard.
+    """
+
+    scope = db.Column(db.String(63), primary_key=True)
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    product_id = db.Column(db.Integer)
+    body = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=utcnow)
+
+    def __repr__(self):
+        return f"<IdempotencyKey {self.scope} {self.key}>"
+
+    @staticmethod
+    def fingerprint_of(data):
+        """Returns a stable hash of a request body"""
+        canonical = json.dumps(data, sort_keys=True, default=str)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def find(cls, scope, key, ttl):
+        """Returns the unexpired record for a key, removing it if it has expired"""
+        with key_session(key) as session:
+            record = session.get(cls, (scope, key))
+            if record is None:
+                return None
+            if as_utc(record.created_at) + timedelta(seconds=ttl) < utcnow():
+                logger.info("Idempotency key %s has expired", key)
+                session.delete(record)
+                session.commit()
+                return None
+            return record
+
+    @classmethod
+    def purge_expired(cls, ttl):
+        """Deletes every record older than ttl seconds and returns how many"""
+        cutoff = utcnow() - timedelta(seconds=ttl)
+        statement = db.delete(cls).where(cls.created_at < cutoff)
+        shards = product_shards()
+        if shards is None:
+            result = db.session.execute(statement)
+            db.session.commit()
+            return result.rowcount
+        count = 0
+        for engine in shards.engines:
+            with engine.begin() as conn:
+                count += conn.execute(statement).rowcount
+        return count
+
+
+class ChangeCounter(db.Model):
+    """
+    Single-row table counting every write made to the Products table
+
+    The counter is bumped in the same transaction as the write, so it can
+    serve as a cheap, strong validator for any listing of Products. With
+    sharding every shard has its own, counting the writes to that shard,
+    and the main one counts the events relayed from the shards.
+    """
+
+    COUNTER_ID = 1
+
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @classmethod
+    def bump(cls, session=None, count=1):
+        """Adds count to the counter as part of the session's transaction and returns it"""
+        session = session or db.session
+        value = session.execute(
+            db.update(cls)
+            .where(cls.id == cls.COUNTER_ID)
+            .values(value=cls.value + count)
+            .returning(cls.value)
+        ).scalar()
+        if value is None:
+            value = count
+            session.execute(db.insert(cls).values(id=cls.COUNTER_ID, value=value))
+        return value
+
+    @classmethod
+    def lock(cls, session=None):
+        """Locks the counter's row for the rest of the session's transaction"""
+        cls.bump(session, 0)
+
+    @classmethod
+    def current(cls, session=None):
+        """Returns the current value of the counter"""
+        value = (session or db.session).execute(
+            db.select(cls.value).where(cls.id == cls.COUNTER_ID)
+        ).scalar()
+        return value or 0
+
+
+class ProductIdBlock(db.Model):  # pylint: disable=too-few-public-methods
+    """
+    Single-row table handing out blocks of Product ids when sharding
+
+    Each worker reserves a block of ids at a time and assigns them on its
+    own, so ids stay unique across shards for one UPDATE per block.
+    """
+
+    BLOCK_ID = 1
+
+    id = db.Column(db.Integer, primary_key=True)
+    next_id = db.Column(db.BigInteger, nullable=False)
+
+    @classmethod
+    def reserve(cls, size):
+        """Returns the first id of a new block of size ids, committed at once"""
+        table = cls.__table__
+        statement = (
+            db.update(table)
+            .where(table.c.id == cls.BLOCK_ID)
+            .values(next_id=table.c.next_id + size)
+            .returning(table.c.next_id)
+        )
+        try:
+            with db.engine.begin() as conn:
+                end = conn.execute(statement).scalar()
+                if end is None:
+                    end = 1 + size
+                    conn.execute(db.insert(table).values(id=cls.BLOCK_ID, next_id=end))
+        except IntegrityError:
+            # another worker reserved the first block at the same time
+            return cls.reserve(size)
+        return end - size
+
+
+class ShardRelay(db.Model):  # pylint: disable=too-few-public-methods
+    """
+    How far the event log of each shard has been appended to the main log
+
+    The row of a shard is locked by the relay that moves its events, so
+    two workers never append the same events twice.
+    """
+
+    shard = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    seq = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @classmethod
+    def lock(cls, session, shard):
+        """Returns the last seq relayed from a shard, holding its row until the transaction ends"""
+        table = cls.__table__
+        seq = session.execute(
+            db.update(table).where(table.c.shard == shard).values(seq=table.c.seq).returning(table.c.seq)
+        ).scalar()
+        if seq is None:
+            # a racing worker makes this fail, and the relay tries again later
+            session.execute(db.insert(table).values(shard=shard, seq=0))
+            seq = 0
+        return seq
+
+    @classmethod
+    def advance(cls, session, shard, seq):
+        """Records that a shard's events up to seq are in the main log"""
+        session.execute(db.update(cls.__table__).where(cls.__table__.c.shard == shard).values(seq=seq))
+
+
+class ProductEvent(db.Model):
+    """
+    A change made to a Product, kept so a change feed can be resumed
+
+    Events are numbered with the ChangeCounter. Its row lock is held from
+    the bump until the commit, so sequence numbers become visible in
+    order and a reader that has seen event n has seen every event before it.
+    With sharding each shard keeps its own log the same way, and the
+    ShardSet appends it to the main log in order.
+    """
+
+    # PostgreSQL channel that carries the seq of every new event
+    CHANNEL = "product_events"
+
+    seq = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    action = db.Column(db.String(16), nullable=False)
+    product_id = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=utcnow, index=True)
+
+    @classmethod
+    def record(cls, action, product_id, data=None, session=None):
+        """Logs a change to a Product as part of the session's transaction"""
+        session = session or db.session
+        seq = ChangeCounter.bump(session)
+        session.execute(
+            db.insert(cls).values(
+                seq=seq,
+                action=action,
+                product_id=product_id,
+                data=json.dumps(data or {"id": product_id}, default=str),
+                created_at=utcnow(),
+            )
+        )
+        return seq
+
+    @classmethod
+    def append(cls, session, events):
+        """Logs events read from another log, renumbered in the same order, and returns the last seq"""
+        last = ChangeCounter.bump(session, len(events))
+        first = last - len(events) + 1
+        session.execute(
+            db.insert(cls),
+            [
+                {key: event[key] for key in ("action", "product_id", "data", "created_at")} | {"seq": first + offset}
+                for offset, event in enumerate(events)
+            ],
+        )
+        return last
+
+    @classmethod
+    def since(cls, seq, limit=1000, engine=None):
+        """
+        Returns up to limit events after seq as dictionaries
+
+        A short-lived connection is used so long-running readers such as
+        event streams never pin a session or a pooled connection.
+        """
+        statement = (
+            db.select(cls.__table__).where(cls.seq > seq).order_by(cls.seq).limit(limit)
+        )
+        with (engine or db.engine).connect() as conn:
+            return [dict(row) for row in conn.execute(statement).mappings()]
+
+    @classmethod
+    def changes_since(cls, seq, limit):
+        """
+        Returns the seq, action and product_id of up to limit events after
+        seq, oldest first, without their data
+        """
+        statement = (
+            db.select(cls.seq, cls.action, cls.product_id).where(cls.seq > seq).order_by(cls.seq).limit(limit)
+        )
+        return db.session.execute(statement).all()
+
+    @classmethod
+    def seq_at(cls, timestamp):
+        """Returns the seq of the last event logged at or before the given time"""
+        first_after = db.session.execute(
+            db.select(db.func.min(cls.seq)).where(cls.created_at > timestamp)
+        ).scalar()
+        return first_after - 1 if first_after is not None else ChangeCounter.current()
+
+    @classmethod
+    def oldest_seq(cls):
+        """Returns the sequence number of the oldest event still kept, or None"""
+        return db.session.execute(db.select(db.func.min(cls.seq))).scalar()
+
+    @classmethod
+    def latest_seq(cls, engine=None):
+        """Returns the sequence number of the newest event"""
+        with (engine or db.engine).connect() as conn:
+            return conn.execute(db.select(db.func.max(cls.seq))).scalar() or 0
+
+    @classmethod
+    def prune(cls, older_than):
+        """Deletes events older than the given number of seconds"""
+        cutoff = utcnow() - timedelta(seconds=older_than)
+        result = db.session.execute(db.delete(cls).where(cls.created_at < cutoff))
+        db.session.commit()
+        return result.rowcount
+
+
+# Have PostgreSQL announce every new event to LISTENers on commit
+event.listen(
+    ProductEvent.__table__,
+    "after_create",
+    DDL(
+        "CREATE OR REPLACE FUNCTION notify_product_event() RETURNS trigger AS $$ "
+        f"BEGIN PERFORM pg_notify('{ProductEvent.CHANNEL}', NEW.seq::text); RETURN NEW; END; "
+        "$$ LANGUAGE plpgsql"
+    ).execute_if(dialect="postgresql"),
+)
+event.listen(
+    ProductEvent.__table__,
+    "after_create",
+    DDL(
+        "CREATE TRIGGER product_event_notify AFTER INSERT ON product_event "
+        "FOR EACH ROW EXECUTE FUNCTION notify_product_event()"
+    ).execute_if(dialect="postgresql"),
+)
+
+
+class Job(db.Model):
+    """
+    A long-running catalog operation queued for a job worker
+
+    A job is queued, then running once a worker claims it, and finally
+    succeeded, failed or cancelled. The worker renews heartbeat_at as it
+    reports progress, and a running job whose heartbeat is older than the
+    lease is claimed again by another worker, up to max_attempts times.
+    Only the worker holding the lease may report on the job. Bulky input
+    such as the items of an import is kept in payload, which is only
+    loaded by the worker and never sent back to clients.
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    params = db.Column(db.Text, nullable=False)
+    payload = db.deferred(db.Column(db.Text))
+    status = db.Column(db.String(16), nullable=False, default=QUEUED, index=True)
+    done = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    worker = db.Column(db.String(255))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=utcnow)
+    started_at = db.Column(db.DateTime(timezone=True))
+    heartbeat_at = db.Column(db.DateTime(timezone=True))
+    finished_at = db.Column(db.DateTime(timezone=True))
+
+    def __repr__(self):
+        return f"<Job {self.kind} id=[{self.id}] {self.status}>"
+
+    def serialize(self):
+        """Serializes a Job into a dictionary"""
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "params": json.loads(self.params),
+            "status": self.status,
+            "done": self.done,
+            "total": self.total,
+            "result": json.loads(self.result) if self.result is not None else None,
+            "error": self.error,
+            "cancel_requested": self.cancel_requested,
+            "attempts": self.attempts,
+            "created_at": isoformat(self.created_at),
+            "started_at": isoformat(self.started_at),
+            "finished_at": isoformat(self.finished_at),
+        }
+
+    @classmethod
+    def enqueue(cls, kind, params, payload=None):
+        """Queues a new job and returns it"""
+        logger.info("Queueing %s job", kind)
+        job = cls(
+            kind=kind,
+            params=json.dumps(params, default=str),
+            payload=json.dumps(payload, default=str) if payload is not None else None,
+        )
+        db.session.add(job)
+        db.session.commit()
+        return job
+
+    @classmethod
+    def find(cls, job_id):
+        """Finds a Job by its ID"""
+        return db.session.get(cls, job_id)
+
+    @classmethod
+    def count_queued(cls):
+        """Returns how many jobs are waiting for a worker"""
+        return db.session.execute(
+            db.select(db.func.count()).select_from(cls).where(cls.status == cls.QUEUED)
+        ).scalar()
+
+    @classmethod
+    def claim(cls, worker, lease, max_attempts):
+        """
+        Marks the oldest runnable job as running for worker and returns it
+
+        A job is runnable while queued, or while running with a heartbeat
+        older than lease seconds because its worker died. Such a job that
+        already had max_attempts is failed instead. PostgreSQL skips the
+        rows other workers are claiming, so each job goes to one worker.
+        Returns None when there is nothing to run.
+        """
+        table = cls.__table__
+        now = utcnow()
+        abandoned = (table.c.status == cls.RUNNING) & (table.c.heartbeat_at < now - timedelta(seconds=lease))
+        db.session.execute(
+            db.update(table)
+            .where(abandoned, table.c.attempts >= max_attempts)
+            .values(status=cls.FAILED, error="The worker running the job stopped", finished_at=now)
+        )
+        candidate = (
+            db.select(table.c.id)
+            .where((table.c.status == cls.QUEUED) | abandoned)
+            .order_by(table.c.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        row = db.session.execute(
+            db.update(table)
+            .where(table.c.id == candidate)
+            .values(
+                status=cls.RUNNING,
+                worker=worker,
+                attempts=table.c.attempts + 1,
+                started_at=now,
+                heartbeat_at=now,
+            )
+            .returning(*table.columns)
+        ).mappings().first()
+        db.session.commit()
+        return cls(**row) if row else None
+
+    @classmethod
+    def heartbeat(cls, job_id, worker, done, total=None):
+        """
+        Records the progress of a job running on worker and renews its lease
+
+        Returns True if the job should stop because it was cancelled, or
+        None if worker no longer holds the job because another claimed it.
+        """
+        table = cls.__table__
+        cancel = db.session.execute(
+            db.update(table)
+            .where(table.c.id == job_id, table.c.worker == worker, table.c.status == cls.RUNNING)
+            .values(done=done, total=total, heartbeat_at=utcnow())
+            .returning(table.c.cancel_requested)
+        ).scalar()
+        db.session.commit()
+        return None if cancel is None else bool(cancel)
+
+    @classmethod
+    def finish(cls, job_id, worker, status, *, result=None, error=None):  # pylint: disable=too-many-arguments
+        """Records how a job running on worker ended, returns False if worker had lost it"""
+        table = cls.__table__
+        values = {"status": status, "error": error, "finished_at": utcnow()}
+        if result is not None:
+            values["result"] = json.dumps(result, default=str)
+        rowcount = db.session.execute(
+            db.update(table)
+            .where(table.c.id == job_id, table.c.worker == worker, table.c.status == cls.RUNNING)
+            .values(**values)
+        ).rowcount
+        db.session.commit()
+        return bool(rowcount)
+
+    @classmethod
+    def cancel(cls, job_id):
+        """
+        Cancels a job and returns it, or None if there is no such job
+
+        A queued job is cancelled at once. A running one is flagged and
+        stops the next time it reports progress.
+        """
+        table = cls.__table__
+        db.session.execute(
+            db.update(table)
+            .where(table.c.id == job_id, table.c.status == cls.QUEUED)
+            .values(status=cls.CANCELLED, cancel_requested=True, finished_at=utcnow())
+        )
+        db.session.execute(
+            db.update(table)
+            .where(table.c.id == job_id, table.c.status == cls.RUNNING)
+            .values(cancel_requested=True)
+        )
+        db.session.commit()
+        return cls.find(job_id)
+
+
+class Product(db.Model):  # pylint: disable=too-many-public-methods
     """
     Class that represents a Product
     """
 
+    # Attributes a client may change with a partial update
+    PATCHABLE_FIELDS = ("name", "description", "price")
+
     ##################################################
     # Table Schema
     ##################################################
@@ -30,6 +664,30 @@ class Product(db.Model):
     description = db.Column(db.String(256))
     price = db.Column(db.Numeric(10, 2))
     likes = db.Column(db.Integer, nullable=False, default=0)
+    version = db.Column(db.Integer, nullable=False)
+    # Set on INSERT and refreshed on every UPDATE, whether it goes through
+    # the ORM or a Core statement, so replicas can sync only what changed
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=utcnow)
+    updated_at = db.Column(
+        db.DateTime(timezone=True), nullable=False, default=utcnow, onupdate=utcnow, index=True
+    )
+
+    # Every UPDATE is guarded by "WHERE version = <loaded version>" and
+    # bumps the counter, so concurrent writers cannot silently clobber
+    # each other (optimistic concurrency control)
+    __mapper_args__ = {"version_id_col": version}
+
+    # Serves the most liked Products without sorting the table
+    __table_args__ = (
+        db.Index("ix_product_likes_id", likes.desc(), id),
+        # text_pattern_ops lets PostgreSQL use the index for LIKE 'prefix%'
+        # whatever the collation of the database
+        db.Index(
+            "ix_product_name_prefix",
+            db.func.lower(name).label("name_lower"),
+            postgresql_ops={"name_lower": "text_pattern_ops"},
+        ),
+    )
 
     ##################################################
     # INSTANCE METHODS
@@ -39,38 +697,111 @@ class Product(db.Model):
         """Returns a string representation of the Product"""
         return f"<Product {self.name} id=[{self.id}]>"
 
-    def create(self):
-        """Creates a Product in the database"""
+    def create(self, idempotency_key=None):
+        """
+        Creates a Product in the database
+
+        The row is written with a single INSERT ... RETURNING and the
+        returned values are copied back onto this instance, which is then
+        attached to the session as already loaded, so serializing it after
+        the commit does not issue another SELECT. An IdempotencyKey given
+        here is saved with the new Product in the same transaction.
+        """
         logger.info("Creating %s", self.name)
+        make_transient(self)
         self.id = None
+        table = self.__table__
+        values = {
+            key: getattr(self, key)
+            for key in ("name", "description", "price", "likes")
+            if getattr(self, key) is not None
+        }
+        now = utcnow()
+        shards = product_shards()
+        product_id = None
+        if shards is not None:
+            # the Product goes to the shard that will hold its idempotency key
+            shard = shards.shard_of_key(idempotency_key.key) if idempotency_key is not None else None
+            product_id = values["id"] = shards.allocate_id(shard)
+
+        def execute(session):
+            return session.execute(
+                db.insert(table)
+                .values(**values, version=1, created_at=now, updated_at=now)
+                .returning(*table.columns)
+            ).mappings().one()
+
+        def record(session, row):
+            message = Product(**row).serialize()
+            if idempotency_key is not None:
+                session.execute(
+                    db.insert(IdempotencyKey.__table__).values(
+                        scope=idempotency_key.scope,
+                        key=idempotency_key.key,
+                        fingerprint=idempotency_key.fingerprint,
+                        product_id=row["id"],
+                        body=json.dumps(message, default=str),
+                    )
+                )
+            ProductEvent.record("created", row["id"], message, session)
+
         try:
-            db.session.add(self)
-            db.session.commit()
+            row = write_product("create", product_id, execute, record)
         except Exception as e:
             db.session.rollback()
+            self.id = None
             logger.error("Error creating record: %s", self)
             raise DataValidationError(e) from e
+        for key, value in row.items():
+            setattr(self, key, value)
+        make_transient_to_detached(self)
+        if shards is None:
+            db.session.add(self)
 
     def update(self):
-        """Updates a Product in the database"""
+        """
+        Updates a Product in the database
+
+        The row is written with one UPDATE ... RETURNING that only applies
+        if the Product still has the version this instance was loaded
+        with, and the returned values are copied back onto the instance.
+        Returns False if the Product no longer exists.
+        """
         logger.info("Saving %s", self.name)
+        table = self.__table__
+        values = {key: getattr(self, key) for key in ("name", "description", "price", "likes")}
+        version = self.version
+        if inspect(self).persistent:
+            # the UPDATE below replaces the ORM's own flush of these changes
+            db.session.expire(self)
+        statement = (
+            db.update(table)
+            .where(table.c.id == self.id, table.c.version == version)
+            .values(**values, version=table.c.version + 1)
+            .returning(*table.columns)
+        )
+
         try:
-            db.session.commit()
+            row = write_product("update", self.id, updated_row(statement), record_update)
         except Exception as e:
             db.session.rollback()
             logger.error("Error updating record: %s", self)
             raise DataValidationError(e) from e
+        if row is None:
+            if not Product.exists(self.id):
+                logger.warning("Product with id '%s' was deleted before the update", self.id)
+                return False
+            logger.warning("Version conflict updating record: %s", self)
+            raise VersionConflictError(
+                f"Product with id '{self.id}' was modified by another request"
+            )
+        for key, value in row.items():
+            set_committed_value(self, key, value)
+        return True
 
     def delete(self):
         """Deletes a Product from the database"""
-        logger.info("Deleting %s", self.name)
-        try:
-            db.session.delete(self)
-            db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            logger.error("Error deleting record: %s", self)
-            raise DataValidationError(e) from e
+        Product.delete_by_id(self.id)
 
     def serialize(self):
         """Serializes a Product into a dictionary"""
@@ -80,8 +811,18 @@ class Product(db.Model):
             "description": self.description,
             "price": self.price,
             "likes": self.likes,
+            "created_at": isoformat(self.created_at),
+            "updated_at": isoformat(self.updated_at),
         }
 
+    @staticmethod
+    def parse_serialized(text):
+        """Returns a serialized Product stored as JSON, with its price a Decimal again"""
+        product = json.loads(text)
+        if product.get("price") is not None:
+            product["price"] = Decimal(product["price"])
+        return product
+
     def deserialize(self, data):
         """Deserializes a Product from a dictionary"""
         try:
@@ -105,54 +846,367 @@ class Product(db.Model):
     # CLASS METHODS (Queries)
     ##################################################
 
+    @classmethod
+    def delete_by_id(cls, product_id):
+        """
+        Deletes a Product with a single DELETE ... WHERE id = :id
+
+        Returns the number of Products deleted (0 or 1)
+        """
+        logger.info("Deleting Product id %s", product_id)
+
+        def execute(session):
+            statement = db.delete(cls.__table__).where(cls.__table__.c.id == product_id)
+            return session.execute(statement).rowcount
+
+        def record(session, rowcount):
+            if rowcount:
+                ProductEvent.record("deleted", product_id, session=session)
+
+        try:
+            rowcount = write_product("delete", product_id, execute, record)
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error deleting record: %s", product_id)
+            raise DataValidationError(e) from e
+        # forget any copy of the row the session is still holding on to
+        loaded = db.session.identity_map.get(db.session.identity_key(cls, product_id))
+        if loaded is not None:
+            db.session.expunge(loaded)
+        return rowcount
+
+    @classmethod
+    def patch(cls, product_id, data, version=None):
+        """
+        Applies a partial update to a Product in a single statement
+
+        The new values are written with one UPDATE ... RETURNING, so there
+        is no read before the write and no reload after the commit. When a
+        version is given the update only applies if it is still current.
+        Returns an unattached Product holding the updated row, or None if
+        no Product has the given id.
+        """
+        logger.info("Patching Product id %s", product_id)
+        if not isinstance(data, dict):
+            raise DataValidationError("Invalid Product: body of request contained bad or no data")
+        fields = {key: data[key] for key in cls.PATCHABLE_FIELDS if key in data}
+        if not fields:
+            raise DataValidationError(
+                "Invalid Product: expected at least one of " + ", ".join(cls.PATCHABLE_FIELDS)
+            )
+
+        table = cls.__table__
+        statement = (
+            db.update(table)
+            .where(table.c.id == product_id)
+            .values(**fields, version=table.c.version + 1)
+            .returning(*table.columns)
+        )
+        if version is not None:
+            statement = statement.where(table.c.version == version)
+
+        try:
+            row = write_product("patch", product_id, updated_row(statement), record_update)
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error patching record: %s", product_id)
+            raise DataValidationError(e) from e
+        product = cls(**row) if row else None
+
+        if product is None and version is not None and cls.exists(product_id):
+            raise VersionConflictError(
+                f"Product with id '{product_id}' was modified by another request"
+            )
+        return product
+
+    @classmethod
+    def like(cls, product_id):
+        """
+        Adds one like to a Product with a single UPDATE ... RETURNING
+
+        The increment happens in the database, so concurrent likes never
+        conflict with each other. Returns an unattached Product holding the
+        updated row, or None if no Product has the given id.
+        """
+        logger.info("Liking Product id %s", product_id)
+        table = cls.__table__
+        statement = (
+            db.update(table)
+            .where(table.c.id == product_id)
+            .values(likes=table.c.likes + 1, version=table.c.version + 1)
+            .returning(*table.columns)
+        )
+
+        try:
+            row = write_product("like", product_id, updated_row(statement), record_update)
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error liking record: %s", product_id)
+            raise DataValidationError(e) from e
+        return cls(**row) if row else None
+
+    @classmethod
+    def exists(cls, product_id):
+        """Returns True if a Product with the given id is in the database"""
+        statement = db.select(cls.__table__.c.id).where(cls.__table__.c.id == product_id)
+        with product_session(product_id) as session:
+            return session.execute(statement).first() is not None
+
     @classmethod
     def all(cls):
         """Returns all of the Products in the database"""
         logger.info("Processing all Products")
+        shards = product_shards()
+        if shards is not None:
+            statement = db.select(cls).order_by(cls.id)
+            return shards.read(lambda session: session.scalars(statement).all(), key=lambda product: product.id)
         return cls.query.all()
 
     @classmethod
     def find(cls, by_id):
         """Finds a Product by its ID"""
         logger.info("Processing lookup for id %s ...", by_id)
-        return cls.query.session.get(cls, by_id)
+        with product_session(by_id) as session:
+            return session.get(cls, by_id)
+
+    @classmethod
+    def find_many(cls, ids):
+        """
+        Returns the Products with any of the given ids, in no particular order
+
+        PostgreSQL gets the ids as one array parameter (id = ANY(:ids)), so
+        the statement text is the same however many ids are asked for.
+        """
+        logger.info("Processing lookup for %d ids ...", len(ids))
+        shards = product_shards()
+        if shards is not None:
+            # only the shards holding one of the ids are asked
+            statement = db.select(cls).where(cls.id.in_(ids)).order_by(cls.id)
+            return shards.read(
+                lambda session: session.scalars(statement).all(),
+                key=lambda product: product.id,
+                shards=shards.group(ids),
+            )
+        if db.engine.dialect.name == "postgresql":
+            clause = cls.id == any_(bindparam("ids", list(ids), type_=ARRAY(db.Integer)))
+        else:
+            clause = cls.id.in_(ids)
+        return cls.query.filter(clause).all()
+
+    @classmethod
+    def most_liked(cls, limit):
+        """Returns the limit Products with the most likes, ties by id"""
+        logger.info("Processing most liked query for %s ...", limit)
+        shards = product_shards()
+        if shards is not None:
+            statement = db.select(cls).order_by(cls.likes.desc(), cls.id).limit(limit)
+            return shards.read(
+                lambda session: session.scalars(statement).all(),
+                key=lambda product: (-product.likes, product.id),
+                limit=limit,
+            )
+        return cls.query.order_by(cls.likes.desc(), cls.id).limit(limit).all()
+
+    @classmethod
+    def names(cls, limit):
+        """Returns the id and name of up to limit named Products as (id, name) rows"""
+        logger.info("Processing names query for %s ...", limit)
+        statement = db.select(cls.id, cls.name).where(cls.name.isnot(None)).order_by(cls.id).limit(limit)
+        shards = product_shards()
+        if shards is not None:
+            return shards.read(lambda session: session.execute(statement).all(), key=lambda row: row.id, limit=limit)
+        return db.session.execute(statement).all()
+
+    @classmethod
+    def count_names(cls, limit):
+        """Returns how many Products have a name, counting no further than limit"""
+        logger.info("Processing names count up to %s ...", limit)
+        named = db.select(cls.id).where(cls.name.isnot(None)).limit(limit).subquery()
+        statement = db.select(db.func.count()).select_from(named)
+        shards = product_shards()
+        if shards is not None:
+            counts = shards.read(lambda session: [session.execute(statement).scalar()], key=int)
+            return min(sum(counts), limit)
+        return db.session.execute(statement).scalar()
+
+    @classmethod
+    def suggest_names(cls, prefix, limit):
+        """
+        Returns the id and name of up to limit Products whose name starts
+        with prefix, ignoring case, in alphabetical order
+
+        The pattern is bound as a literal prefix so PostgreSQL can answer
+        it from the lower(name) text_pattern_ops index.
+        """
+        logger.info("Processing name suggestions for %s ...", prefix)
+        escaped = prefix.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        lowered = db.func.lower(cls.name)
+        statement = (
+            db.select(cls.id, cls.name)
+            .where(lowered.like(escaped + "%", escape="\\"))
+            .order_by(lowered, cls.id)
+            .limit(limit)
+        )
+        shards = product_shards()
+        if shards is not None:
+            return shards.read(
+                lambda session: session.execute(statement).all(),
+                key=lambda row: ((row.name or "").lower(), row.id),
+                limit=limit,
+            )
+        return db.session.execute(statement).all()
+
+    @classmethod
+    def find_where(cls, *clauses):
+        """Returns the Products matching every clause, by id, from every shard when sharding"""
+        statement = db.select(cls).where(*clauses).order_by(cls.id)
+        shards = product_shards()
+        if shards is not None:
+            return shards.read(lambda session: session.scalars(statement).all(), key=lambda product: product.id)
+        return db.session.scalars(statement).all()
 
     @classmethod
     def find_by_name(cls, name):
         """Returns all Products with the given name"""
         logger.info("Processing name query for %s ...", name)
-        return cls.query.filter(cls.name == name)
+        return cls.find_where(cls.name == name)
 
     @classmethod
     def find_by_description(cls, description):
         """Returns all Products with the given description"""
         logger.info("Processing description query for %s", description)
-        return cls.query.filter(cls.description == description).all()
+        return cls.find_where(cls.description == description)
 
     @classmethod
     def find_by_price(cls, price):
         """Returns all Products with the given price"""
         logger.info("Processing price query for %s", price)
-        return cls.query.filter(cls.price == price).all()
+        return cls.find_where(cls.price == price)
 
     @classmethod
     def find_by_price_less_than(cls, price):
         """Returns all Products with a price less than given value"""
         logger.info("Processing price less than query for %s ...", price)
-        return cls.query.filter(cls.price < price)
+        return cls.find_where(cls.price < price)
 
     @classmethod
-    def find_by_attributes(
-        cls, product_id=None, name=None, description=None, price=None
+    def filter_clauses(  # pylint: disable=too-many-arguments
+        cls,
+        *,
+        product_id=None,
+        name=None,
+        description=None,
+        price=None,
+        price_lt=None,
     ):
-        """Finds Products using optional filters"""
-        query = cls.query
+        """Builds the WHERE clauses for the optional Product filters"""
+        clauses = []
         if product_id is not None:
-            query = query.filter(cls.id == product_id)
+            clauses.append(cls.id == product_id)
         if name is not None:
-            query = query.filter(cls.name.ilike(f"%{name}%"))
+            clauses.append(cls.name.ilike(f"%{name}%"))
         if description is not None:
-            query = query.filter(cls.description.ilike(f"%{description}%"))
+            clauses.append(cls.description.ilike(f"%{description}%"))
         if price is not None:
-            query = query.filter(cls.price == price)
-        return query.all()
+            clauses.append(cls.price == price)
+        if price_lt is not None:
+            clauses.append(cls.price < price_lt)
+        return clauses
+
+    @classmethod
+    def _filter_clause(cls, name):
+        """Returns the WHERE clause of one optional filter, with its value as a parameter"""
+        return {
+            "product_id": lambda: cls.id == bindparam("product_id"),
+            "name": lambda: cls.name.ilike(bindparam("name")),
+            "description": lambda: cls.description.ilike(bindparam("description")),
+            "price": lambda: cls.price == bindparam("price"),
+            "price_lt": lambda: cls.price < bindparam("price_lt"),
+            "ids": lambda: cls.id.in_(bindparam("ids", expanding=True)),
+        }[name]()
+
+    @classmethod
+    def find_filtered(cls, order_by=(), **filters):
+        """
+        Returns the Products matching the filters that are not None
+
+        The SELECT is built once for each combination of filters and order
+        and then reused with the new values. With sharding it runs on every
+        shard and the results are merged in order, by id unless another
+        order is given.
+        """
+        shards = product_shards()
+        if shards is not None and not order_by:
+            order_by = ("id",)
+        params = {key: value for key, value in filters.items() if value is not None}
+        for key in ("name", "description"):
+            if key in params:
+                params[key] = f"%{params[key]}%"
+        shape = (tuple(sorted(params)), tuple(order_by))
+
+        def build():
+            statement = db.select(cls).where(*(cls._filter_clause(key) for key in shape[0]))
+            return statement.order_by(*(getattr(cls, column) for column in shape[1]))
+
+        statement = product_selects.get(shape, build)
+        if shards is not None:
+            return shards.read(
+                lambda session: session.execute(statement, params).scalars().all(),
+                key=lambda product: tuple(getattr(product, column) for column in shape[1]),
+            )
+        return db.session.execute(statement, params).scalars().all()
+
+    @classmethod
+    def find_by_attributes(  # pylint: disable=too-many-arguments
+        cls, product_id=None, name=None, description=None, price=None, *, price_lt=None
+    ):
+        """Finds Products using optional filters"""
+        return cls.find_filtered(
+            product_id=product_id, name=name, description=description, price=price, price_lt=price_lt
+        )
+
+    @classmethod
+    def page(cls, after_id, limit, **filters):
+        """
+        Returns up to limit Product rows as dictionaries, by id, with ids
+        above after_id, so a caller can walk the table a page at a time
+        """
+        logger.info("Processing page after id %s with filters %s", after_id, filters)
+        statement = (
+            db.select(cls.__table__)
+            .where(cls.id > after_id, *cls.filter_clauses(**filters))
+            .order_by(cls.id)
+            .limit(limit)
+        )
+        shards = product_shards()
+        if shards is not None:
+            return shards.read(
+                lambda session: session.execute(statement).mappings().all(), key=lambda row: row["id"], limit=limit
+            )
+        return db.session.execute(statement).mappings().all()
+
+    @classmethod
+    def export_rows(cls, batch_size=EXPORT_BATCH_SIZE, **filters):
+        """
+        Streams Product rows as dictionaries from a single consistent snapshot
+
+        Rows are read through a server-side cursor in batches of batch_size
+        on a dedicated connection, so memory stays bounded no matter how
+        large the table is and the caller may keep iterating after the
+        request that started the export has finished. With sharding every
+        shard is streamed from its own snapshot and the rows are merged by id.
+        """
+        logger.info("Processing export with filters %s", filters)
+        statement = (
+            db.select(cls.__table__)
+            .where(*cls.filter_clauses(**filters))
+            .order_by(cls.id)
+        )
+        shards = product_shards()
+        engines = shards.engines if shards is not None else [db.engine]
+        streams = [stream_rows(engine, statement, batch_size) for engine in engines]
+        yield from heapq.merge(*streams, key=lambda row: row["id"])
+
+
+# Checks run on Product payloads before they reach the database
+product_schema = Schema(Product.__table__, Product.PATCHABLE_FIELDS, minimums={"price": 0})
@@ -21,10 +21,69 @@ This service implements a REST API that allows you to Create, Read, Update
 and Delete Product
 """
 
-from flask import jsonify, request, url_for, abort
+import functools
+import time
+from datetime import datetime, timedelta, timezone
+from flask import jsonify, request, url_for, abort, g, Response, send_from_directory, stream_with_context
 from flask import current_app as app  # Import Flask application
-from service.models import Product
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.http import quote_etag, unquote_etag
+from service.models import db, Product, ProductEvent, ChangeCounter, IdempotencyKey, DataValidationError, utcnow
+from service.models import VersionConflictError
+from service.models import write_generation
+from service.models import Job, product_schema
 from service.common import status  # HTTP Status Codes
+from service.common import metrics, changefeed, profiling, memory, negotiation
+from service.common.auth import check_admin
+from service.common.singleflight import SingleFlight
+
+
+# Idempotency-Key namespace for POST /products
+CREATE_SCOPE = "create_product"
+
+# Collapse concurrent identical listings within this worker, keyed by
+# generation (single Product reads use app.extensions["product_reads"])
+list_reads = SingleFlight("list")
+
+# Times a PUT reads and writes a Product that keeps changing under it
+# before answering 409
+PUT_ATTEMPTS = 3
+
+
+######################################################################
+# QUERY PLAN DEBUG MODE
+######################################################################
+def explainable(view):
+    """
+    Lets an admin add ?explain=1 to see how the database ran a request
+
+    Instead of the usual body the response reports every statement the
+    request ran with its plan and timing, and how much of the request
+    time was spent in SQL.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.args.get("explain", "").lower() not in ("1", "true", "yes"):
+            return view(*args, **kwargs)
+        check_admin()
+        from service.common import explain  # pylint: disable=import-outside-toplevel
+
+        # g outlives the request when an app context was already pushed
+        g.explain = True
+        started = time.perf_counter()
+        try:
+            with explain.capture(db.engine) as queries:
+                response = app.make_response(view(*args, **kwargs))
+        finally:
+            g.pop("explain", None)
+        elapsed = time.perf_counter() - started
+        app.logger.info("Explaining %d statements for %s", len(queries), request.full_path)
+        body = explain.report(db.session.connection(), queries, elapsed)
+        db.session.rollback()
+        return jsonify(status=response.status_code, **body), status.HTTP_200_OK
+
+    return wrapper
 
 
 ######################################################################
@@ -46,13 +105,35 @@ def index():
 ######################################################################
 @app.route("/products", methods=["POST"])
 def create_product():
-    """Create a product"""
+    """
+    Create a product
+    A request carrying an Idempotency-Key header is only executed once;
+    retries with the same key get the original response back
+    """
     app.logger.info("Request to create a product")
-    check_content_type("application/json")
+    check_content_type("application/json", negotiation.MSGPACK)
+    data = product_schema.validate(negotiation.request_data())
+
+    idempotency_key = None
+    key = request.headers.get("Idempotency-Key")
+    if key:
+        replay = replay_idempotent_request(key, data)
+        if replay:
+            return replay
+        idempotency_key = IdempotencyKey(
+            scope=CREATE_SCOPE, key=key, fingerprint=IdempotencyKey.fingerprint_of(data)
+        )
 
     product = Product()
-    product.deserialize(request.get_json())
-    product.create()
+    product.deserialize(data)
+    try:
+        product.create(idempotency_key)
+    except DataValidationError:
+        # a concurrent request with the same key may have won the race
+        replay = key and replay_idempotent_request(key, data)
+        if replay:
+            return replay
+        raise
 
     message = product.serialize()
     location_url = url_for("get_product", product_id=product.id, _external=True)
@@ -61,6 +142,22 @@ def create_product():
     return jsonify(message), status.HTTP_201_CREATED, {"Location": location_url}
 
 
+def replay_idempotent_request(key, data):
+    """Returns the original response for a repeated Idempotency-Key, if any"""
+    record = IdempotencyKey.find(CREATE_SCOPE, key, app.config["IDEMPOTENCY_TTL"])
+    if record is None:
+        return None
+    if record.fingerprint != IdempotencyKey.fingerprint_of(data):
+        abort(
+            status.HTTP_409_CONFLICT,
+            f"Idempotency-Key '{key}' was already used with a different request",
+        )
+    app.logger.info("Replaying response for Idempotency-Key %s", key)
+    location_url = url_for("get_product", product_id=record.product_id, _external=True)
+    headers = {"Location": location_url, "Idempotent-Replayed": "true"}
+    return jsonify(Product.parse_serialized(record.body)), status.HTTP_201_CREATED, headers
+
+
 ######################################################################
 # Helper functions for list_products
 ######################################################################
@@ -85,48 +182,245 @@ def find_products_by_query_params(product_id, name, description, price, price_lt
             price=price
         )
     if price_lt:
-        return Product.query.filter(Product.price < price_lt).all()
+        return Product.find_by_attributes(price_lt=price_lt)
     return Product.all()
 
 
+def parse_filter_parameters():
+    """Parses the optional Product filters from the query string"""
+    return {
+        "product_id": parse_query_parameter(
+            request.args.get("id"), int, "Invalid product ID format"
+        ),
+        "name": request.args.get("name"),
+        "description": request.args.get("description"),
+        "price": parse_query_parameter(
+            request.args.get("price"), float, "Invalid price format"
+        ),
+        "price_lt": parse_query_parameter(
+            request.args.get("price_lt"), float, "Invalid price_lt format"
+        ),
+    }
+
+
 ######################################################################
 # LIST ALL PRODUCTS
 ######################################################################
 @app.route("/products", methods=["GET"])
+@explainable
 def list_products():
     """Returns all of the Products"""
     app.logger.info("Request for product list")
-
-    # Process query parameters
-    product_id = parse_query_parameter(
-        request.args.get("id"),
-        int,
-        "Invalid product ID format"
+    filters = parse_filter_parameters()
+    ids = parse_query_parameter(request.args.get("ids"), parse_ids, "Invalid ids, expected e.g. ids=1,2,3")
+    if ids is not None:
+        return batch_get(ids)
+    since = parse_query_parameter(request.args.get("since"), int, "Invalid since, expected an event sequence number")
+    updated_since = parse_query_parameter(
+        request.args.get("updated_since"), parse_timestamp, "Invalid updated_since timestamp"
     )
+    if updated_since is not None and since is None:
+        since = start_of_sync(updated_since)
+    if since is not None:
+        return sync_products(since, filters)
+
+    # Read the change counters before the rows so the ETag is never newer
+    # than the data it describes
+    generation = write_generation()
+    headers = cache_headers(str(generation))
+    if is_not_modified(headers["ETag"]):
+        return "", status.HTTP_304_NOT_MODIFIED, headers
+
+    # Find products by the provided attributes and serialize them, sharing
+    # the work with concurrent requests for the same listing at the same
+    # change counter. It may run again later to revalidate a cached body,
+    # so it reads the counter again itself.
+    media_type = negotiation.response_type()
+    filter_key = (media_type, tuple(sorted(filters.items())))
+
+    def load():
+        current = write_generation()
+        products = find_products_by_query_params(**filters)
+        return current, app.json.body([product.serialize() for product in products], media_type)
+
+    def shared_load():
+        return shared_read(list_reads, (generation, filter_key), load)
+
+    if g.get("explain"):
+        generation, body = load()
+    else:
+        generation, body = app.extensions["list_cache"].get(filter_key, generation, shared_load)
+    headers = cache_headers(str(generation))
+    app.logger.info("Returning %d bytes of products", len(body))
+    return Response(body, status.HTTP_200_OK, headers, mimetype=media_type)
+
+
+def parse_timestamp(value):
+    """Parses an ISO 8601 timestamp, assuming UTC when no offset is given"""
+    # an unencoded "+00:00" offset arrives as " 00:00"
+    timestamp = datetime.fromisoformat(value.replace(" ", "+"))
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc)
+
+
+def start_of_sync(updated_since):
+    """Returns the event sequence number a first sync from a point in time starts after"""
+    if updated_since < utcnow() - timedelta(seconds=app.config["EVENT_RETENTION"]):
+        abort(
+            status.HTTP_410_GONE,
+            "Deletions that old are no longer kept, a full sync is required",
+        )
+    return ProductEvent.seq_at(updated_since)
 
-    price = parse_query_parameter(
-        request.args.get("price"),
-        float,
-        "Invalid price format"
-    )
 
-    price_lt = parse_query_parameter(
-        request.args.get("price_lt"),
-        float,
-        "Invalid price_lt format"
+def require_events_after(since, message):
+    """Aborts with 410 Gone when some of the events after since were pruned"""
+    oldest = ProductEvent.oldest_seq()
+    if (oldest if oldest is not None else ChangeCounter.current() + 1) > since + 1:
+        abort(status.HTTP_410_GONE, message)
+
+
+def sync_products(since, filters):
+    """
+    Returns what changed after event since for incremental replicas
+
+    The body lists the Products created or updated by the next
+    SYNC_BATCH_SIZE events, the ids of the Products they deleted or
+    changed to no longer match the filters (tombstones) and the seq of the last of them as the cursor to send as
+    since next time, with more set when further events are waiting. Event
+    numbers become visible in order, so a cursor never skips a change
+    that commits later.
+    """
+    app.logger.info("Request for product changes since event %s", since)
+    require_events_after(since, "Events that old are no longer kept, a full sync is required")
+    limit = app.config["SYNC_BATCH_SIZE"]
+    events = ProductEvent.changes_since(since, limit)
+    latest = {event.product_id: event.action for event in events}
+    ids = sorted(product_id for product_id, action in latest.items() if action != "deleted")
+    changed = Product.find_filtered(ids=ids, **filters) if ids else []
+    # a replica of the filtered listing must drop what has left it
+    deleted = sorted(set(latest) - {product.id for product in changed})
+    app.logger.info("Returning %d changed and %d deleted products", len(changed), len(deleted))
+    return (
+        jsonify(
+            products=[product.serialize() for product in changed],
+            deleted=deleted,
+            cursor=events[-1].seq if events else since,
+            more=len(events) == limit,
+        ),
+        status.HTTP_200_OK,
     )
 
-    name = request.args.get("name")
-    description = request.args.get("description")
 
-    # Find products by the provided attributes
-    products = find_products_by_query_params(
-        product_id, name, description, price, price_lt
+######################################################################
+# BATCH GET PRODUCTS
+######################################################################
+@app.route("/products/batch-get", methods=["POST"])
+def batch_get_products():
+    """
+    Returns many Products by id
+    This endpoint takes {"ids": [...]} for id lists too long for a query string
+    """
+    check_content_type("application/json", negotiation.MSGPACK)
+    body = request.get_json(silent=True) if request.is_json else negotiation.request_data()
+    ids = body.get("ids") if isinstance(body, dict) else None
+    if not isinstance(ids, list) or not all(isinstance(item, int) for item in ids):
+        abort(status.HTTP_400_BAD_REQUEST, "Request body must be {\"ids\": [<integer>, ...]}")
+    return batch_get(ids)
+
+
+def parse_ids(value):
+    """Parses a comma separated list of Product ids"""
+    return [int(item) for item in value.split(",")]
+
+
+def batch_get(ids):
+    """
+    Looks up many Products with one query
+
+    The Products come back in the order their ids were asked for, each
+    once, and the ids that do not exist are listed under missing.
+    Concurrent identical batches at the same change counter share a query.
+    """
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > app.config["BATCH_GET_MAX_IDS"]:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"At most {app.config['BATCH_GET_MAX_IDS']} ids may be asked for at once",
+        )
+    app.logger.info("Request for %d products by id", len(ids))
+
+    def load():
+        found = {product.id: product.serialize() for product in Product.find_many(ids)}
+        return (
+            [found[product_id] for product_id in ids if product_id in found],
+            [product_id for product_id in ids if product_id not in found],
+        )
+
+    key = ("ids", write_generation(), tuple(ids))
+    products, missing = shared_read(list_reads, key, load)
+    app.logger.info("Returning %d products, %d missing", len(products), len(missing))
+    return jsonify(products=products, missing=missing), status.HTTP_200_OK
+
+
+######################################################################
+# EXPORT PRODUCTS
+######################################################################
+@app.route("/products/export", methods=["GET"])
+def export_products():
+    """
+    Export Products
+    This endpoint streams the (optionally filtered) Products as CSV or
+    JSON Lines from a single database snapshot
+    """
+    from service.common import export  # pylint: disable=import-outside-toplevel
+
+    export_format = request.args.get("format", "csv")
+    app.logger.info("Request to export products as %s", export_format)
+    if export_format not in export.EXPORT_FORMATS:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"Unsupported export format '{export_format}'",
+        )
+
+    rows = Product.export_rows(**parse_filter_parameters())
+    body = stream_with_context(export.generate(export_format, rows))
+    headers = {
+        "Content-Disposition": f"attachment; filename=products.{export_format}"
+    }
+    return Response(
+        body,
+        status=status.HTTP_200_OK,
+        mimetype=export.EXPORT_FORMATS[export_format],
+        headers=headers,
     )
 
-    results = [product.serialize() for product in products]
-    app.logger.info("Returning %d products", len(results))
-    return jsonify(results), status.HTTP_200_OK
+
+######################################################################
+# STREAM PRODUCT CHANGES
+######################################################################
+@app.route("/products/events", methods=["GET"])
+def product_events():
+    """
+    Stream Product changes
+    This endpoint pushes every create, update, like and delete as a
+    Server-Sent Event. Clients resume after a disconnect by sending the
+    id of the last event they saw in the Last-Event-ID header, and are
+    told 410 Gone when the events after it are no longer kept.
+    """
+    last_event_id = request.headers.get("Last-Event-ID", request.args.get("last_event_id"))
+    last_seq = parse_query_parameter(last_event_id, int, "Invalid Last-Event-ID")
+    if last_seq is None:
+        last_seq = ProductEvent.latest_seq()
+    else:
+        require_events_after(last_seq, "Events after Last-Event-ID are no longer kept, reload and stream from now")
+    app.logger.info("Request for product events after %s", last_seq)
+
+    feed = app.extensions["changefeed"]
+    body = stream_with_context(changefeed.stream(feed, last_seq, app.config))
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(body, status=status.HTTP_200_OK, mimetype="text/event-stream", headers=headers)
 
 
 ######################################################################
@@ -140,12 +434,22 @@ def get_product(product_id):
     """
     app.logger.info("Request for product with id: %s", product_id)
 
-    product = Product.find(product_id)
-    if not product:
+    def load():
+        product = Product.find(product_id)
+        return (str(product.version), product.serialize()) if product else None
+
+    # writes in this worker forget the id, so a read that began before them is never shared
+    found = shared_read(app.extensions["product_reads"], product_id, load)
+    if not found:
         abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
 
-    app.logger.info("Returning product: %s", product.name)
-    return jsonify(product.serialize()), status.HTTP_200_OK
+    version, result = found
+    headers = cache_headers(version)
+    if is_not_modified(headers["ETag"]):
+        return "", status.HTTP_304_NOT_MODIFIED, headers
+
+    app.logger.info("Returning product: %s", result["name"])
+    return jsonify(result), status.HTTP_200_OK, headers
 
 
 ######################################################################
@@ -158,18 +462,65 @@ def update_product(product_id):
     This endpoint will update a Product based on the body that is posted
     """
     app.logger.info("Request to update product with id: %s", product_id)
-    check_content_type("application/json")
+    check_content_type("application/json", negotiation.MSGPACK)
+    data = product_schema.validate(negotiation.request_data())
+    product = replace_product(product_id, data)
+
+    app.logger.info("Product with ID [%s] updated.", product.id)
+    return jsonify(product.serialize()), status.HTTP_200_OK, {"ETag": product_etag(product)}
+
+
+def replace_product(product_id, data):
+    """
+    Writes data over the current version of a Product and returns it
 
-    product = Product.find(product_id)
+    A write that lands between the read and the UPDATE makes the read
+    and the If-Match check run again, so a conditional PUT then fails
+    with 412 while an unconditional one replaces the newer version. A
+    Product that keeps changing is answered with 409 after PUT_ATTEMPTS.
+    """
+    for _ in range(PUT_ATTEMPTS):
+        product = Product.find(product_id)
+        if not product:
+            abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+        check_if_match(product)
+        product.deserialize(data)
+        product.id = product_id
+        try:
+            updated = product.update()
+        except VersionConflictError:
+            app.logger.info("Product with id [%s] changed during the update, reading it again", product_id)
+            continue
+        if not updated:
+            # deleted between the read and the UPDATE
+            abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
+        return product
+    abort(
+        status.HTTP_409_CONFLICT,
+        f"Product with id '{product_id}' kept changing during the update, try again",
+    )
+    return None
+
+
+######################################################################
+# PARTIALLY UPDATE AN EXISTING PRODUCT
+######################################################################
+@app.route("/products/<int:product_id>", methods=["PATCH"])
+def patch_product(product_id):
+    """
+    Partially update a Product
+    This endpoint will only change the attributes present in the body
+    """
+    app.logger.info("Request to patch product with id: %s", product_id)
+    check_content_type("application/json", negotiation.MSGPACK)
+
+    data = product_schema.validate(negotiation.request_data(), partial=True)
+    product = Product.patch(product_id, data, if_match_version())
     if not product:
         abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
 
-    product.deserialize(request.get_json())
-    product.id = product_id
-    product.update()
-
-    app.logger.info("Product with ID [%s] updated.", product.id)
-    return jsonify(product.serialize()), status.HTTP_200_OK
+    app.logger.info("Product with ID [%s] patched.", product_id)
+    return jsonify(product.serialize()), status.HTTP_200_OK, {"ETag": product_etag(product)}
 
 
 ######################################################################
@@ -183,14 +534,55 @@ def delete_product(product_id):
     """
     app.logger.info("Request to delete product with id: %s", product_id)
 
-    product = Product.find(product_id)
-    if product:
-        product.delete()
+    Product.delete_by_id(product_id)
 
     app.logger.info("Product with ID [%s] delete complete.", product_id)
     return "", status.HTTP_204_NO_CONTENT
 
 
+######################################################################
+# MOST LIKED PRODUCTS
+######################################################################
+@app.route("/products/top", methods=["GET"])
+def top_products():
+    """
+    Returns the most liked Products
+    The n query parameter (default 10) may not exceed LEADERBOARD_SIZE
+    """
+    count = parse_query_parameter(request.args.get("n") or "10", int, "Invalid value for n")
+    if not 1 <= count <= app.config["LEADERBOARD_SIZE"]:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"n must be between 1 and {app.config['LEADERBOARD_SIZE']}",
+        )
+    app.logger.info("Request for the %d most liked products", count)
+    results = app.extensions["leaderboard"].top(count)
+    return jsonify(results), status.HTTP_200_OK
+
+
+######################################################################
+# SUGGEST PRODUCT NAMES
+######################################################################
+@app.route("/products/suggest", methods=["GET"])
+def suggest_products():
+    """
+    Returns the Products whose name starts with a prefix, ignoring case
+    The limit query parameter (default 10) may not exceed SUGGEST_MAX_LIMIT
+    """
+    prefix = request.args.get("prefix", "")
+    if not prefix:
+        abort(status.HTTP_400_BAD_REQUEST, "prefix is required")
+    limit = parse_query_parameter(request.args.get("limit") or "10", int, "Invalid value for limit")
+    if not 1 <= limit <= app.config["SUGGEST_MAX_LIMIT"]:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"limit must be between 1 and {app.config['SUGGEST_MAX_LIMIT']}",
+        )
+    app.logger.info("Request for name suggestions for %s", prefix)
+    results = app.extensions["suggest"].suggest(prefix, limit)
+    return jsonify(results), status.HTTP_200_OK
+
+
 ######################################################################
 # LIKE A PRODUCT
 ######################################################################
@@ -202,17 +594,77 @@ def like_product(product_id):
     """
     app.logger.info("Request to like product with id: %s", product_id)
 
-    product = Product.find(product_id)
+    product = Product.like(product_id)
     if not product:
         abort(status.HTTP_404_NOT_FOUND, f"Product with id '{product_id}' was not found.")
 
-    product.likes += 1
-    product.update()
-
     app.logger.info("Product with ID [%s] liked.", product.id)
     return jsonify(product.serialize()), status.HTTP_200_OK
 
 
+######################################################################
+# BACKGROUND JOBS
+######################################################################
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    """
+    Queues a long-running operation for a job worker
+    The body names the kind of job and its params, e.g.
+    {"kind": "reprice", "params": {"percent": 10}}
+    """
+    from service.common import jobs  # pylint: disable=import-outside-toplevel
+
+    app.logger.info("Request to create a job")
+    check_content_type("application/json", negotiation.MSGPACK)
+    body = negotiation.request_data()
+    if not isinstance(body, dict):
+        abort(status.HTTP_400_BAD_REQUEST, "Body must be a JSON object")
+    kind, params = body.get("kind"), body.get("params", {})
+    jobs.check(kind, params)
+    if Job.count_queued() >= app.config["JOB_MAX_QUEUED"]:
+        raise ServiceUnavailable("Too many jobs are waiting, please retry later", retry_after=60)
+
+    job = Job.enqueue(kind, *jobs.split(kind, params))
+    location_url = url_for("get_job", job_id=job.id, _external=True)
+    app.logger.info("Job with ID [%s] queued.", job.id)
+    return jsonify(job.serialize()), status.HTTP_202_ACCEPTED, {"Location": location_url}
+
+
+@app.route("/jobs/<int:job_id>", methods=["GET"])
+def get_job(job_id):
+    """Returns the status, progress and result of a job"""
+    job = Job.find(job_id)
+    if not job:
+        abort(status.HTTP_404_NOT_FOUND, f"Job with id '{job_id}' was not found.")
+    return jsonify(job.serialize()), status.HTTP_200_OK
+
+
+@app.route("/jobs/<int:job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    """
+    Cancels a job
+    A queued job is cancelled at once and a running one at its next
+    progress report, so the job may still be running in the response
+    """
+    app.logger.info("Request to cancel job with id: %s", job_id)
+    job = Job.cancel(job_id)
+    if not job:
+        abort(status.HTTP_404_NOT_FOUND, f"Job with id '{job_id}' was not found.")
+    if job.status not in (Job.CANCELLED, Job.RUNNING):
+        abort(status.HTTP_409_CONFLICT, f"Job with id '{job_id}' has already {job.status}.")
+    return jsonify(job.serialize()), status.HTTP_202_ACCEPTED
+
+
+@app.route("/jobs/<int:job_id>/result", methods=["GET"])
+def get_job_result(job_id):
+    """Downloads the file written by a finished job, such as an export"""
+    job = Job.find(job_id)
+    result = job.serialize()["result"] if job else None
+    if not result or "file" not in result:
+        abort(status.HTTP_404_NOT_FOUND, f"Job with id '{job_id}' has no result file.")
+    return send_from_directory(app.config["JOB_DIR"], result["file"], as_attachment=True)
+
+
 ######################################################################
 # HEALTH ENDPOINT
 ######################################################################
@@ -222,16 +674,110 @@ def health():
     return jsonify({"status": "OK"}), status.HTTP_200_OK
 
 
+######################################################################
+# METRICS ENDPOINT
+######################################################################
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Returns the counters and gauges of this worker"""
+    return jsonify(metrics.snapshot()), status.HTTP_200_OK
+
+
+######################################################################
+# PROFILES
+######################################################################
+@app.route("/profiles", methods=["GET"])
+def list_profiles():
+    """Returns the request profiles stored by this worker, newest first"""
+    check_admin()
+    return jsonify(profiling.list_profiles(app.config["PROFILE_DIR"])), status.HTTP_200_OK
+
+
+@app.route("/profiles/<route>/<name>", methods=["GET"])
+def get_profile(route, name):
+    """Downloads one request profile as a pstats dump"""
+    check_admin()
+    return send_from_directory(
+        app.config["PROFILE_DIR"], f"{route}/{name}", mimetype="application/octet-stream", as_attachment=True
+    )
+
+
+######################################################################
+# MEMORY
+######################################################################
+@app.route("/memory", methods=["GET"])
+def get_memory():
+    """Returns the RSS of this worker and, with tracemalloc on, its top allocation sites"""
+    check_admin()
+    top = parse_query_parameter(request.args.get("top"), int, "Invalid value for top") or 10
+    return jsonify(memory.report(top)), status.HTTP_200_OK
+
+
 ######################################################################
 # UTILITY FUNCTIONS
 ######################################################################
-def check_content_type(content_type):
-    """Checks that the media type is correct"""
+def check_content_type(*content_types):
+    """Checks that the media type is one of content_types, ignoring parameters such as charset"""
     if "Content-Type" not in request.headers:
         abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "Content-Type must be set")
 
-    if request.headers["Content-Type"] != content_type:
+    mimetype = negotiation.MSGPACK if request.mimetype in negotiation.MSGPACK_TYPES else request.mimetype
+    if mimetype not in content_types:
         abort(
             status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-            f"Content-Type must be {content_type}",
+            f"Content-Type must be {' or '.join(content_types)}",
+        )
+
+
+def product_etag(product):
+    """Returns the strong entity tag for the current version of a Product"""
+    return quote_etag(negotiation.representation_tag(str(product.version)))
+
+
+def shared_read(flight, key, load):
+    """Runs load() once for all concurrent requests with the same key"""
+    # a request being explained must run its own queries
+    if not app.config["SINGLE_FLIGHT"] or g.get("explain"):
+        return load()
+    return flight.do(key, load)
+
+
+def cache_headers(tag):
+    """Returns the validator and caching headers for the negotiated representation of tag"""
+    # the same entity is sent as JSON or MessagePack depending on Accept
+    etag = quote_etag(negotiation.representation_tag(tag))
+    return {"ETag": etag, "Cache-Control": app.config["CACHE_CONTROL"], "Vary": "Accept"}
+
+
+def is_not_modified(etag):
+    """Returns True if If-None-Match shows the client already has this entity"""
+    tag, _ = unquote_etag(etag)
+    return request.if_none_match.contains_weak(tag)
+
+
+def check_if_match(product):
+    """Aborts with 412 if the If-Match header does not name the current version"""
+    if request.if_match and not request.if_match.star_tag and str(product.version) not in if_match_tags():
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            f"Product with id '{product.id}' has been modified; "
+            f"current version is {product.version}",
+        )
+
+
+def if_match_tags():
+    """Returns the versions named by If-Match, from the ETag of either representation"""
+    return {negotiation.base_tag(tag) for tag in request.if_match.as_set()}
+
+
+def if_match_version():
+    """Returns the Product version required by If-Match, or None for any version"""
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    tags = if_match_tags()
+    if len(tags) != 1 or not next(iter(tags)).isdigit():
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            "If-Match must name a single Product version",
         )
+    return int(tags.pop())
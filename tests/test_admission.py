@@ -0,0 +1,171 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for Admission Control
+"""
+
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+from werkzeug.exceptions import TooManyRequests, ServiceUnavailable
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from wsgi import app
+from service.common import status, metrics
+from service.common.admission import AdmissionController, TokenBucket, pool_usage
+
+CONFIG = {
+    "ADMISSION_MAX_IN_FLIGHT": 4,
+    "ADMISSION_WRITE_SHARE": 0.5,
+    "ADMISSION_POOL_THRESHOLD": 0.9,
+    "ADMISSION_RETRY_AFTER": 2,
+    "RATE_LIMIT_PER_SECOND": 0,
+    "RATE_LIMIT_BURST": 2,
+}
+
+
+class TestAdmissionController(TestCase):
+    """Admission Controller Tests"""
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_sheds_writes_before_reads(self):
+        """It should shed writes at a lower concurrency than reads"""
+        controller = AdmissionController(CONFIG)
+        controller.admit("a", is_write=True)
+        controller.admit("a", is_write=True)
+        self.assertRaises(ServiceUnavailable, controller.admit, "a", True)
+        controller.admit("a", is_write=False)
+        controller.admit("a", is_write=False)
+        with self.assertRaises(ServiceUnavailable) as context:
+            controller.admit("a", is_write=False)
+        self.assertEqual(context.exception.retry_after, 2)
+        self.assertEqual(metrics.counter("admission.shed.writes"), 1)
+        self.assertEqual(metrics.counter("admission.shed.reads"), 1)
+        controller.release()
+        controller.admit("a", is_write=False)
+        self.assertEqual(controller.in_flight, 4)
+
+    def test_sheds_on_pool_saturation(self):
+        """It should shed writes when the pool is nearly exhausted"""
+        controller = AdmissionController(CONFIG, lambda: 0.95)
+        self.assertRaises(ServiceUnavailable, controller.admit, "a", True)
+        controller.admit("a", is_write=False)
+
+    def test_rate_limit_per_client(self):
+        """It should rate limit each client with its own token bucket"""
+        controller = AdmissionController(dict(CONFIG, RATE_LIMIT_PER_SECOND=0.5))
+        controller.admit("a", is_write=False)
+        controller.admit("a", is_write=False)
+        with self.assertRaises(TooManyRequests) as context:
+            controller.admit("a", is_write=False)
+        self.assertEqual(context.exception.retry_after, 2)
+        controller.admit("b", is_write=False)
+        self.assertEqual(metrics.counter("admission.rate_limited"), 1)
+
+    @patch("service.common.admission.MAX_BUCKETS", 1)
+    def test_rate_limit_buckets_are_bounded(self):
+        """It should forget the least recently seen client"""
+        controller = AdmissionController(dict(CONFIG, RATE_LIMIT_PER_SECOND=1))
+        controller.admit("a", is_write=False)
+        controller.admit("b", is_write=False)
+        self.assertEqual(list(controller._buckets), ["b"])
+
+    def test_token_bucket_refills(self):
+        """It should refill tokens over time up to the burst size"""
+        bucket = TokenBucket(rate=1, burst=1, now=0)
+        self.assertEqual(bucket.take(0), 0)
+        self.assertAlmostEqual(bucket.take(0.5), 0.5)
+        self.assertEqual(bucket.take(10), 0)
+
+    def test_pool_usage(self):
+        """It should report the checked out share of a sized pool"""
+        engine = MagicMock()
+        engine.pool.size.return_value = 5
+        engine.pool._max_overflow = 5
+        engine.pool.checkedout.return_value = 5
+        self.assertEqual(pool_usage(engine), 0.5)
+        engine.pool._max_overflow = -1
+        self.assertEqual(pool_usage(engine), 0.0)
+        engine.pool = object()
+        self.assertEqual(pool_usage(engine), 0.0)
+
+
+class TestAdmissionRequests(TestCase):
+    """Admission Control Request Tests"""
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.controller = app.extensions["admission"]
+
+    def test_overloaded_request(self):
+        """It should answer 503 with Retry-After when overloaded"""
+        with patch.object(self.controller, "max_in_flight", 1), patch.object(
+            self.controller, "in_flight", 1
+        ):
+            response = self.client.get("/products")
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(response.headers["Retry-After"], "1")
+            self.assertEqual(response.get_json()["error"], "Service Unavailable")
+            # the health check is never shed
+            response = self.client.get("/health")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_rate_limited_request(self):
+        """It should answer 429 with Retry-After when over the rate limit"""
+        with patch.object(self.controller, "rate", 0.001), patch.object(
+            self.controller, "burst", 1
+        ):
+            self.client.get("/products", environ_base={"REMOTE_ADDR": "10.0.0.9"})
+            response = self.client.get("/products", environ_base={"REMOTE_ADDR": "10.0.0.9"})
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn("Retry-After", response.headers)
+
+    def test_forwarded_for_is_not_trusted(self):
+        """It should not let a client dodge the rate limit with X-Forwarded-For"""
+        with patch.object(self.controller, "rate", 0.001), patch.object(
+            self.controller, "burst", 1
+        ):
+            for address in ("1.1.1.1", "2.2.2.2"):
+                response = self.client.get(
+                    "/products", headers={"X-Forwarded-For": address}, environ_base={"REMOTE_ADDR": "10.0.0.8"}
+                )
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_trusted_proxy(self):
+        """It should rate limit the clients behind a trusted proxy one by one"""
+        with patch.object(self.controller, "rate", 0.001), patch.object(
+            self.controller, "burst", 1
+        ), patch.object(app, "wsgi_app", ProxyFix(app.wsgi_app, x_for=1)):
+            for address in ("3.3.3.3", "4.4.4.4"):
+                response = self.client.get(
+                    "/products", headers={"X-Forwarded-For": address}, environ_base={"REMOTE_ADDR": "10.0.0.7"}
+                )
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_in_flight_is_released(self):
+        """It should release the slot when the request finishes"""
+        before = self.controller.in_flight
+        self.client.get("/products")
+        self.assertEqual(self.controller.in_flight, before)
+
+    def test_metrics(self):
+        """It should expose the worker metrics"""
+        self.client.get("/products")
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreaterEqual(response.get_json()["counters"]["admission.admitted"], 1)
@@ -0,0 +1,264 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the Server-Sent Events change feed
+"""
+
+# pylint: disable=duplicate-code
+import json
+import logging
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+from werkzeug.exceptions import ServiceUnavailable
+
+from wsgi import app
+from service.common import status, metrics
+from service.common.changefeed import ChangeFeed, Subscription, stream
+from service.models import db, Product, ProductEvent, ChangeCounter
+from tests.factories import ProductFactory
+
+CONFIG = {
+    "EVENT_POLL_INTERVAL": 0.01,
+    "EVENT_HEARTBEAT": 0.01,
+    "EVENT_STREAM_TIMEOUT": 0.05,
+    "EVENT_RETRY_MS": 3000,
+    "EVENT_MAX_SUBSCRIBERS": 2,
+    "EVENT_QUEUE_SIZE": 2,
+}
+
+
+######################################################################
+#  C H A N G E   F E E D   T E S T   C A S E S
+######################################################################
+class TestChangeFeed(TestCase):
+    """Change Feed Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+
+    def setUp(self):
+        """This runs before each test"""
+        metrics.reset()
+        db.session.query(Product).delete()
+        db.session.commit()
+        self.feed = ChangeFeed(db.engine, CONFIG)
+        # never start a real listener thread against the test database
+        patcher = patch.object(self.feed, "run")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def test_writes_are_logged(self):
+        """It should log an event for every Product write"""
+        start = ProductEvent.latest_seq()
+        product = ProductFactory()
+        product.create()
+        product.likes += 1
+        product.update()
+        product.delete()
+        events = ProductEvent.since(start)
+        self.assertEqual([event["action"] for event in events], ["created", "updated", "deleted"])
+        self.assertEqual([event["seq"] for event in events], [start + 1, start + 2, start + 3])
+        self.assertEqual(json.loads(events[1]["data"])["likes"], 1)
+        self.assertEqual(json.loads(events[2]["data"]), {"id": events[0]["product_id"]})
+
+    def test_dispatch_fans_out(self):
+        """It should read new events once and give them to every subscriber"""
+        first = self.feed.subscribe()
+        second = self.feed.subscribe()
+        self.assertRaises(ServiceUnavailable, self.feed.subscribe)
+        self.feed.last_seq = ProductEvent.latest_seq()
+        ProductFactory().create()
+        self.assertEqual(self.feed.dispatch(), 1)
+        self.assertEqual(first.get(0)["action"], "created")
+        self.assertEqual(second.get(0)["action"], "created")
+        self.assertEqual(self.feed.dispatch(), 0)
+        self.feed.unsubscribe(first)
+        self.feed.unsubscribe(second)
+        self.assertEqual(metrics.snapshot()["gauges"]["changefeed.subscribers"], 0)
+
+    @patch("service.common.changefeed.BATCH_SIZE", 1)
+    def test_dispatch_reads_every_batch(self):
+        """It should keep reading until the backlog is drained"""
+        self.feed.last_seq = ProductEvent.latest_seq()
+        ProductFactory().create()
+        ProductFactory().create()
+        self.assertEqual(self.feed.dispatch(), 2)
+
+    def test_slow_subscriber_lags(self):
+        """It should flag a subscriber whose queue overflowed"""
+        subscription = Subscription(1)
+        subscription.offer({"seq": 1})
+        self.assertFalse(subscription.lagged)
+        subscription.offer({"seq": 2})
+        self.assertTrue(subscription.lagged)
+        self.assertEqual(subscription.get(0), {"seq": 1})
+        self.assertIsNone(subscription.get(0))
+
+    def test_stream_replays_and_follows(self):
+        """It should replay missed events, then push new ones as they arrive"""
+        start = ProductEvent.latest_seq()
+        ProductFactory().create()
+        events = stream(self.feed, start, dict(CONFIG, EVENT_STREAM_TIMEOUT=5))
+        self.assertEqual(next(events), "retry: 3000\n\n")
+        self.assertIn(f"id: {start + 1}\nevent: created\n", next(events))
+        self.assertEqual(next(events), ": keep-alive\n\n")
+
+        ProductFactory().create()
+        self.feed.dispatch()
+        self.assertIn(f"id: {start + 2}\nevent: created\n", next(events))
+        events.close()
+        self.assertEqual(self.feed.subscribers, set())
+
+    def test_stream_catches_up_after_gap(self):
+        """It should read missed events from the table after a gap or overflow"""
+        start = ProductEvent.latest_seq()
+        events = stream(self.feed, start, dict(CONFIG, EVENT_STREAM_TIMEOUT=5))
+        next(events)
+        ProductFactory().create()
+        ProductFactory().create()
+        subscription = next(iter(self.feed.subscribers))
+        subscription.offer(ProductEvent.since(start + 1)[0])
+        self.assertIn(f"id: {start + 1}\n", next(events))
+        self.assertIn(f"id: {start + 2}\n", next(events))
+
+        ProductFactory().create()
+        subscription.lagged = True
+        self.assertIn(f"id: {start + 3}\n", next(events))
+        events.close()
+
+    def test_stream_ends_when_closed(self):
+        """It should end the stream when the listener gives up so the client reconnects"""
+        start = ProductEvent.latest_seq()
+        events = stream(self.feed, start, dict(CONFIG, EVENT_STREAM_TIMEOUT=5))
+        next(events)
+        subscription = next(iter(self.feed.subscribers))
+        for _ in range(3):
+            subscription.offer({"seq": start + 1})
+        subscription.close()
+        self.assertEqual(list(events), [])
+        self.assertEqual(self.feed.subscribers, set())
+
+    def test_stream_ends_after_timeout(self):
+        """It should close the stream so the client resumes elsewhere"""
+        chunks = list(stream(self.feed, ProductEvent.latest_seq(), CONFIG))
+        self.assertEqual(chunks[0], "retry: 3000\n\n")
+        self.assertEqual(self.feed.subscribers, set())
+
+
+class TestChangeFeedListener(TestCase):
+    """Change Feed Listener Tests"""
+
+    def setUp(self):
+        self.feed = ChangeFeed(db.engine, CONFIG)
+
+    def test_run_polls_until_unsubscribed(self):
+        """It should poll and dispatch until the last subscriber leaves"""
+        subscription = Subscription(10)
+        self.feed.subscribers.add(subscription)
+        self.feed._thread = "running"
+
+        with patch("service.common.changefeed.time.sleep") as sleep_mock, patch.object(
+            self.feed, "dispatch"
+        ) as dispatch_mock:
+            sleep_mock.side_effect = lambda _: self.feed.subscribers.clear()
+            self.feed.run()
+        dispatch_mock.assert_called_once()
+        self.assertIsNone(self.feed._thread)
+
+    def test_run_survives_errors(self):
+        """It should close every stream when the listener fails and allow it to be restarted"""
+        subscription = Subscription(10)
+        self.feed.subscribers.add(subscription)
+        self.feed._thread = "running"
+        with patch("service.common.changefeed.time.sleep"), patch.object(
+            self.feed, "dispatch", side_effect=RuntimeError("database went away")
+        ):
+            self.feed.run()
+        self.assertIsNone(self.feed._thread)
+        self.assertTrue(subscription.closed)
+        self.assertEqual(self.feed.subscribers, set())
+
+    def test_postgres_listens(self):
+        """It should LISTEN on a dedicated connection with PostgreSQL"""
+        engine = MagicMock()
+        engine.dialect.name = "postgresql"
+        conn = engine.raw_connection.return_value.driver_connection
+        conn.notifies.return_value = iter(["notification"])
+        feed = ChangeFeed(engine, CONFIG)
+        wait, close = feed._waiter()
+        engine.raw_connection.return_value.detach.assert_called_once()
+        conn.execute.assert_called_once_with("LISTEN product_events")
+        wait()
+        conn.notifies.assert_called_once_with(timeout=0.01, stop_after=1)
+        close()
+        conn.close.assert_called_once()
+
+
+class TestChangeFeedEndpoint(TestCase):
+    """Change Feed Endpoint Tests"""
+
+    def setUp(self):
+        self.client = app.test_client()
+        feed = app.extensions["changefeed"]
+        patcher = patch.object(feed, "run")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, feed, "_thread", None)
+        app.config["EVENT_STREAM_TIMEOUT"] = 0.05
+        self.addCleanup(app.config.update, EVENT_STREAM_TIMEOUT=300)
+
+    def test_stream_with_last_event_id(self):
+        """It should stream events after the Last-Event-ID"""
+        start = ChangeCounter.current()
+        product = ProductFactory()
+        self.client.post("/products", json=product.serialize())
+        response = self.client.get("/products/events", headers={"Last-Event-ID": str(start)})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "text/event-stream")
+        body = response.get_data(as_text=True)
+        self.assertIn(f"id: {start + 1}\nevent: created\n", body)
+        self.assertIn(product.name, body)
+
+    def test_stream_from_now(self):
+        """It should only stream new events without a Last-Event-ID"""
+        self.client.post("/products", json=ProductFactory().serialize())
+        response = self.client.get("/products/events")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("event: created", response.get_data(as_text=True))
+
+    def test_stream_pruned_last_event_id(self):
+        """It should answer 410 Gone when events after the Last-Event-ID were pruned"""
+        start = ChangeCounter.current()
+        self.client.post("/products", json=ProductFactory().serialize())
+        ProductEvent.prune(-1)
+        response = self.client.get("/products/events", headers={"Last-Event-ID": str(start)})
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+        response = self.client.get("/products/events", headers={"Last-Event-ID": str(ChangeCounter.current())})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_stream_bad_last_event_id(self):
+        """It should reject a Last-Event-ID that is not a number"""
+        response = self.client.get("/products/events", query_string={"last_event_id": "abc"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
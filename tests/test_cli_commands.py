@@ -24,8 +24,8 @@ from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
 
-# pylint: disable=unused-import
-from wsgi import app  # noqa: F401
+from wsgi import app
+from service.common import export
 from service.common.cli_commands import db_create  # noqa: E402
 
 
@@ -42,3 +42,63 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    @patch("service.common.cli_commands.Product")
+    def test_products_export(self, product_mock):
+        """It should stream the products-export command to stdout"""
+        product_mock.export_rows.return_value = iter(
+            [dict.fromkeys(export.EXPORT_COLUMNS, None) | {"id": 1, "name": "Shoe", "description": "Red", "price": "9.99"}]
+        )
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["products-export", "--format", "jsonl", "--name", "Sh"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('"name": "Shoe"', result.output)
+        product_mock.export_rows.assert_called_once_with(
+            name="Sh", description=None, price_lt=None
+        )
+
+    @patch("service.common.cli_commands.IdempotencyKey")
+    def test_idempotency_purge(self, key_mock):
+        """It should purge expired idempotency keys"""
+        key_mock.purge_expired.return_value = 3
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["idempotency-purge"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Purged 3", result.output)
+        key_mock.purge_expired.assert_called_once_with(app.config["IDEMPOTENCY_TTL"])
+
+    @patch("service.common.cli_commands.ProductEvent")
+    def test_events_prune(self, event_mock):
+        """It should prune old change events"""
+        event_mock.prune.return_value = 4
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["events-prune"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Pruned 4", result.output)
+        event_mock.prune.assert_called_once_with(app.config["EVENT_RETENTION"])
+
+    @patch("service.common.cli_commands.profiling")
+    def test_profiles_list(self, profiling_mock):
+        """It should list the stored request profiles"""
+        profiling_mock.list_profiles.return_value = [
+            {"id": "health/a.prof", "created_at": "2025-01-01T00:00:00+00:00", "duration_ms": 12}
+        ]
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["profiles-list"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("health/a.prof", result.output)
+        profiling_mock.list_profiles.assert_called_once_with(app.config["PROFILE_DIR"])
+
+    @patch("service.common.cli_commands.memory.report")
+    def test_memory_report(self, report_mock):
+        """It should print the RSS and the top allocation sites"""
+        report_mock.return_value = {
+            "rss_bytes": 30 * 1024 * 1024,
+            "tracemalloc": {"tracing": True, "top": [{"site": "a.py:1", "size_bytes": 2048, "count": 3}]},
+        }
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["memory-report", "--top", "1"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("RSS: 30.0 MB", result.output)
+        self.assertIn("a.py:1", result.output)
+        report_mock.assert_called_once_with(1)
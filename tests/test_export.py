@@ -0,0 +1,72 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the bulk export formatters
+"""
+
+from datetime import datetime, timezone
+from decimal import Decimal
+from unittest import TestCase
+from unittest.mock import patch
+
+from service.common import export
+
+CREATED = datetime(2025, 3, 1, 12, 30)
+UPDATED = datetime(2025, 3, 2, 8, 0, tzinfo=timezone.utc)
+ROW = {
+    "id": 7,
+    "name": "Lamp",
+    "description": None,
+    "price": Decimal("12.50"),
+    "likes": 0,
+    "created_at": CREATED,
+    "updated_at": UPDATED,
+}
+
+
+class TestExport(TestCase):
+    """Export Formatter Tests"""
+
+    def test_csv_without_rows(self):
+        """It should only write the header when there are no rows"""
+        output = "".join(export.generate("csv", []))
+        self.assertEqual(output, "id,name,description,price,likes,created_at,updated_at\r\n")
+
+    def test_csv_encodes_like_the_api(self):
+        """It should write prices and timestamps the way the JSON API renders them"""
+        output = "".join(export.generate("csv", [ROW]))
+        self.assertEqual(output.splitlines()[1], "7,Lamp,,12.50,0,2025-03-01T12:30:00+00:00,2025-03-02T08:00:00+00:00")
+
+    def test_jsonl_encodes_decimals(self):
+        """It should render prices as strings like the JSON API"""
+        output = "".join(export.generate("jsonl", [ROW]))
+        self.assertEqual(
+            output,
+            '{"id": 7, "name": "Lamp", "description": null, "price": "12.50", "likes": 0, '
+            '"created_at": "2025-03-01T12:30:00+00:00", "updated_at": "2025-03-02T08:00:00+00:00"}\n',
+        )
+
+    @patch("service.common.export.CHUNK_SIZE", 10)
+    def test_chunks_are_coalesced(self):
+        """It should emit a chunk whenever the buffer fills"""
+        chunks = list(export.generate("jsonl", [ROW, ROW, ROW]))
+        self.assertEqual(len(chunks), 3)
+
+    def test_unsupported_format(self):
+        """It should reject an unknown export format"""
+        with self.assertRaises(ValueError):
+            list(export.generate("xml", [ROW]))
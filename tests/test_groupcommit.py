@@ -0,0 +1,195 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for committing concurrent writes together
+"""
+
+# pylint: disable=duplicate-code
+import logging
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from sqlalchemy.exc import OperationalError
+
+from wsgi import app
+from service.common import metrics
+from service.common.groupcommit import GroupCommit
+from service.common.retries import RetryPolicy
+from service.models import db, Product, ProductEvent, ChangeCounter
+from tests.factories import ProductFactory
+
+RETRIES = {"DB_RETRY_TRIES": 3, "DB_RETRY_DELAY": 0, "DB_RETRY_MAX_DELAY": 0, "DB_RETRY_BUDGET": 10}
+CONFIG = {"GROUP_COMMIT_WINDOW_MS": 5000, "GROUP_COMMIT_MAX_BATCH": 8, "GROUP_COMMIT_WAIT_MS": 5000}
+
+
+def submit_all(group, works):
+    """Submits each work from its own thread and returns (results, errors)"""
+    results = [None] * len(works)
+    errors = [None] * len(works)
+
+    def submit(index, work):
+        try:
+            results[index] = group.submit("test", work)
+        except Exception as error:  # pylint: disable=broad-except
+            errors[index] = error
+
+    threads = [threading.Thread(target=submit, args=item) for item in enumerate(works)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    return results, errors
+
+
+######################################################################
+#  G R O U P   C O M M I T   T E S T   C A S E S
+######################################################################
+class TestGroupCommit(TestCase):
+    """Group Commit Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+
+    def setUp(self):
+        """This runs before each test"""
+        metrics.reset()
+        self.session = MagicMock()
+        self.group = GroupCommit(
+            RetryPolicy(RETRIES), self.session, dict(CONFIG, GROUP_COMMIT_MAX_BATCH=3)
+        )
+        db.session.query(Product).delete()
+        db.session.commit()
+
+    def tearDown(self):
+        """This runs after each test"""
+        app.extensions["group_commit"] = None
+        db.session.remove()
+
+    def test_commits_concurrent_writes_together(self):
+        """It should commit a full batch of concurrent writes once"""
+        results, errors = submit_all(self.group, [lambda: "a", lambda: "b", lambda: "c"])
+        self.assertEqual(results, ["a", "b", "c"])
+        self.assertEqual(errors, [None, None, None])
+        self.session.commit.assert_called_once()
+        self.assertEqual(metrics.counter("groupcommit.batches"), 1)
+        self.assertEqual(metrics.counter("groupcommit.writes"), 3)
+
+    def test_failed_write_is_dropped(self):
+        """It should fail only the write that raised and commit the rest"""
+        bad = MagicMock(side_effect=ValueError("bad write"))
+        good = MagicMock(return_value="good")
+        results, errors = submit_all(self.group, [good, bad, good])
+        self.assertEqual(results, ["good", None, "good"])
+        self.assertIsInstance(errors[1], ValueError)
+        self.session.rollback.assert_called_once()
+        self.session.commit.assert_called_once()
+        bad.assert_called_once()
+        self.assertEqual(metrics.counter("groupcommit.reruns"), 1)
+
+    def test_failed_commit_fails_every_write(self):
+        """It should give every write of a batch the error of its COMMIT"""
+        self.session.commit.side_effect = OperationalError("COMMIT", {}, Exception("gone"), True)
+        results, errors = submit_all(self.group, [lambda: "a", lambda: "b", lambda: "c"])
+        self.assertEqual(results, [None, None, None])
+        for error in errors:
+            self.assertIsInstance(error, OperationalError)
+
+    def test_window_closes_a_partial_batch(self):
+        """It should commit a lone write once the window has passed"""
+        group = GroupCommit(
+            RetryPolicy(RETRIES), self.session, dict(CONFIG, GROUP_COMMIT_WINDOW_MS=1, GROUP_COMMIT_MAX_BATCH=3)
+        )
+        self.assertEqual(group.submit("test", lambda: "alone"), "alone")
+        self.assertEqual(metrics.counter("groupcommit.writes"), 1)
+
+    def test_stalled_leader_is_left_behind(self):
+        """It should commit a write alone when its batch never started committing"""
+        group = GroupCommit(RetryPolicy(RETRIES), self.session, dict(CONFIG, GROUP_COMMIT_WAIT_MS=10))
+        group._leading = True  # pylint: disable=protected-access
+        self.assertEqual(group.submit("test", lambda: "alone"), "alone")
+        self.assertEqual(group._pending, [])  # pylint: disable=protected-access
+        self.session.commit.assert_called_once()
+        self.assertEqual(metrics.counter("groupcommit.withdrawn"), 1)
+
+    def test_withdrawn_write_is_dropped(self):
+        """It should drop a write from a running batch once its thread committed it alone"""
+        group = GroupCommit(
+            RetryPolicy(RETRIES), self.session, dict(CONFIG, GROUP_COMMIT_MAX_BATCH=2, GROUP_COMMIT_WAIT_MS=200)
+        )
+        released = threading.Event()
+        follower = MagicMock(side_effect=lambda: released.set() or "follower")
+        leading = threading.Thread(target=lambda: group.submit("test", lambda: released.wait(10) and "leader"))
+        leading.start()
+        while not group._leading:  # pylint: disable=protected-access
+            time.sleep(0.001)
+        self.assertEqual(group.submit("test", follower), "follower")
+        leading.join(timeout=10)
+        # run once alone and once in the batch, which was rolled back and run again without it
+        self.assertEqual(follower.call_count, 2)
+        self.assertEqual(self.session.commit.call_count, 2)
+        self.session.rollback.assert_called_once()
+        self.assertEqual(metrics.counter("groupcommit.reruns"), 1)
+
+    def test_product_writes_use_group_commit(self):
+        """It should send Product writes through the worker's GroupCommit"""
+        app.extensions["group_commit"] = GroupCommit(
+            app.extensions["db_retry"], db.session, dict(CONFIG, GROUP_COMMIT_WINDOW_MS=0)
+        )
+        product = ProductFactory(likes=0)
+        product.create()
+        self.assertIsNotNone(product.id)
+        liked = Product.like(product.id)
+        self.assertEqual(liked.likes, 1)
+        patched = Product.patch(product.id, {"price": "9.99"})
+        self.assertEqual(str(patched.price), "9.99")
+        self.assertEqual(Product.delete_by_id(product.id), 1)
+        self.assertEqual(metrics.counter("groupcommit.writes"), 4)
+        actions = [event["action"] for event in ProductEvent.since(0)]
+        self.assertEqual(actions[-4:], ["created", "updated", "updated", "deleted"])
+
+    def test_begin_runs_first_in_every_transaction(self):
+        """It should run begin before the writes of a batch and of a withdrawn write"""
+        calls = []
+        group = GroupCommit(
+            RetryPolicy(RETRIES), self.session, dict(CONFIG, GROUP_COMMIT_MAX_BATCH=2), begin=calls.append
+        )
+        results, _ = submit_all(group, [lambda: calls.append("a"), lambda: calls.append("b")])
+        self.assertEqual(results, [None, None])
+        self.assertIs(calls[0], self.session)
+        self.assertEqual(sorted(calls[1:]), ["a", "b"])
+        calls.clear()
+        group._leading = True  # pylint: disable=protected-access
+        group.wait = 0.01
+        group.submit("test", lambda: calls.append("alone"))
+        self.assertEqual(calls, [self.session, "alone"])
+
+    def test_batches_lock_the_change_counter_first(self):
+        """It should lock the change counter before the first Product write of a batch"""
+        app.extensions["group_commit"] = GroupCommit(
+            app.extensions["db_retry"], db.session, dict(CONFIG, GROUP_COMMIT_WINDOW_MS=0), begin=ChangeCounter.lock
+        )
+        before = ChangeCounter.current()
+        with patch.object(db.session, "execute", wraps=db.session.execute) as execute:
+            ProductFactory().create()
+            statements = [str(call.args[0]).split()[0] for call in execute.call_args_list]
+        self.assertEqual(statements[:2], ["UPDATE", "INSERT"])
+        self.assertEqual(ChangeCounter.current(), before + 1)
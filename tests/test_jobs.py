@@ -0,0 +1,260 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+
+"""
+Test cases for background jobs
+"""
+
+# pylint: disable=duplicate-code
+import logging
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from wsgi import app
+from service.common import status, metrics, jobs
+from service.models import db, Job, Product, utcnow
+from tests.factories import ProductFactory
+
+BASE_URL = "/jobs"
+
+
+######################################################################
+#  B A C K G R O U N D   J O B   T E S T   C A S E S
+######################################################################
+class TestJobs(TestCase):
+    """Background Job Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+
+    def setUp(self):
+        """This runs before each test"""
+        metrics.reset()
+        self.client = app.test_client()
+        directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(directory.cleanup)
+        saved = {key: app.config[key] for key in ("JOB_DIR", "JOB_PROGRESS_INTERVAL", "JOB_MAX_QUEUED")}
+        self.addCleanup(app.config.update, saved)
+        app.config.update(JOB_DIR=directory.name, JOB_PROGRESS_INTERVAL=0)
+        db.session.query(Job).delete()
+        db.session.query(Product).delete()
+        db.session.commit()
+        self.worker = jobs.JobWorker(app)
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def _run(self, kind, params=None):
+        """Queues a job through the API, runs it and returns it as a dictionary"""
+        response = self.client.post(BASE_URL, json={"kind": kind, "params": params or {}})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.get_json()["status"], Job.QUEUED)
+        self.assertTrue(self.worker.run_next())
+        response = self.client.get(response.headers["Location"])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.get_json()
+
+    def _create(self, *prices):
+        """Creates one Product per price"""
+        products = []
+        for price in prices:
+            product = ProductFactory(price=price)
+            product.create()
+            products.append(product)
+        return products
+
+    def test_export_job(self):
+        """It should export the Products to a file that can be downloaded"""
+        self._create("1.00", "2.00")
+        job = self._run("export", {"format": "jsonl"})
+        self.assertEqual(job["status"], Job.SUCCEEDED)
+        self.assertEqual(job["result"]["rows"], 2)
+        self.assertEqual(job["done"], 2)
+        response = self.client.get(f"{BASE_URL}/{job['id']}/result")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_data(as_text=True).splitlines()), 2)
+        response.close()
+
+        job = self._run("reindex")
+        response = self.client.get(f"{BASE_URL}/{job['id']}/result")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_reprice_job(self):
+        """It should change every price by a percentage"""
+        products = self._create("10.00", "25.50")
+        job = self._run("reprice", {"percent": 10})
+        self.assertEqual(job["status"], Job.SUCCEEDED)
+        self.assertEqual(job["result"], {"updated": 2, "conflicts": 0, "failed": 0})
+        self.assertEqual([job["done"], job["total"]], [2, 2])
+        prices = [str(Product.find(product.id).price) for product in products]
+        self.assertEqual(prices, ["11.00", "28.05"])
+
+    @patch("service.common.jobs.PAGE_SIZE", 2)
+    def test_reprice_pages(self):
+        """It should walk the Products a page at a time and skip prices that no longer fit"""
+        products = self._create("10.00", "99999999.00", "1.00", "2.00", "3.00")
+        with patch.object(Product, "page", wraps=Product.page) as page:
+            job = self._run("reprice", {"percent": "100"})
+        self.assertEqual(page.call_count, 3)
+        self.assertEqual(page.call_args.args[0], products[3].id)
+        self.assertEqual(job["result"], {"updated": 4, "conflicts": 0, "failed": 1})
+        self.assertEqual([job["done"], job["total"]], [5, 5])
+        self.assertEqual(str(Product.find(products[1].id).price), "99999999.00")
+
+    def test_import_job(self):
+        """It should create the valid Products of an import and report the others"""
+        good = {"name": "Hat", "description": "Warm", "price": "5.00"}
+        job = self._run("import", {"products": [good, {"name": "No price"}, good]})
+        self.assertEqual(job["status"], Job.SUCCEEDED)
+        self.assertEqual(job["result"]["created"], 2)
+        self.assertEqual(job["result"]["failed"], 1)
+        self.assertEqual(job["result"]["errors"][0]["index"], 1)
+        self.assertEqual(len(Product.all()), 2)
+        # the items are kept out of the job clients poll
+        self.assertNotIn("products", job["params"])
+
+    def test_reindex_job(self):
+        """It should rebuild the product indexes"""
+        self._create("1.00")
+        job = self._run("reindex")
+        self.assertEqual(job["status"], Job.SUCCEEDED)
+        self.assertEqual(job["result"], {"databases": 1})
+
+    def test_bad_job_requests(self):
+        """It should reject unknown kinds, missing params and a full queue"""
+        response = self.client.post(BASE_URL, json={"kind": "unknown"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("kind", response.get_json()["errors"])
+        response = self.client.post(BASE_URL, json={"kind": "reprice", "params": {}})
+        self.assertIn("percent", response.get_json()["errors"])
+        response = self.client.post(BASE_URL, json={"kind": "export", "params": []})
+        self.assertIn("params", response.get_json()["errors"])
+        for kind, params, field in (
+            ("reprice", {"percent": "ten"}, "percent"),
+            ("reprice", {"percent": -101}, "percent"),
+            ("reprice", {"percent": True}, "percent"),
+            ("reprice", {"percent": 5, "price_lt": "cheap"}, "price_lt"),
+            ("export", {"format": "xml"}, "format"),
+            ("export", {"name": 5}, "name"),
+            ("import", {"products": {"name": "Hat"}}, "products"),
+        ):
+            response = self.client.post(BASE_URL, json={"kind": kind, "params": params})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(list(response.get_json()["errors"]), [field])
+        self.assertEqual(db.session.query(Job).count(), 0)
+        response = self.client.post(BASE_URL, json=["export"])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        app.config["JOB_MAX_QUEUED"] = 1
+        self.assertEqual(self.client.post(BASE_URL, json={"kind": "reindex"}).status_code, status.HTTP_202_ACCEPTED)
+        response = self.client.post(BASE_URL, json={"kind": "reindex"})
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIn("Retry-After", response.headers)
+
+        self.assertEqual(self.client.get(f"{BASE_URL}/0").status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.post(f"{BASE_URL}/0/cancel").status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cancel_queued_job(self):
+        """It should cancel a queued job at once and refuse to cancel a finished one"""
+        job = Job.enqueue("reindex", {})
+        response = self.client.post(f"{BASE_URL}/{job.id}/cancel")
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.get_json()["status"], Job.CANCELLED)
+        self.assertFalse(self.worker.run_next())
+
+        finished = self._run("reindex")
+        response = self.client.post(f"{BASE_URL}/{finished['id']}/cancel")
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_cancel_running_job(self):
+        """It should stop a running job at its next progress report"""
+        self._create("1.00", "2.00")
+        job = Job.enqueue("reprice", {"percent": 50})
+        claimed = Job.claim("test", lease=60, max_attempts=3)
+        self.assertEqual(claimed.id, job.id)
+        response = self.client.post(f"{BASE_URL}/{job.id}/cancel")
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.get_json()["status"], Job.RUNNING)
+        self.assertTrue(response.get_json()["cancel_requested"])
+
+        jobs.execute(claimed, app.config)
+        self.assertEqual(Job.find(job.id).status, Job.CANCELLED)
+        self.assertEqual(Job.find(job.id).done, 1)
+
+    def test_abandoned_jobs(self):
+        """It should hand a job whose worker stopped to another, a few times at most"""
+        job = Job.enqueue("reindex", {})
+        self.assertEqual(Job.claim("first", lease=60, max_attempts=2).id, job.id)
+        self.assertIsNone(Job.claim("second", lease=60, max_attempts=2))
+        stale = utcnow() - timedelta(seconds=120)
+        db.session.query(Job).filter(Job.id == job.id).update({"heartbeat_at": stale})
+        db.session.commit()
+        claimed = Job.claim("second", lease=60, max_attempts=2)
+        self.assertEqual((claimed.worker, claimed.attempts), ("second", 2))
+
+        db.session.query(Job).filter(Job.id == job.id).update({"heartbeat_at": stale})
+        db.session.commit()
+        self.assertIsNone(Job.claim("third", lease=60, max_attempts=2))
+        self.assertEqual(Job.find(job.id).status, Job.FAILED)
+
+    def test_lost_lease(self):
+        """It should stop a job another worker took over without recording its outcome"""
+        products = self._create("1.00", "2.00")
+        job = Job.enqueue("reprice", {"percent": 50})
+        claimed = Job.claim("first", lease=60, max_attempts=3)
+        db.session.query(Job).filter(Job.id == job.id).update({"worker": "second"})
+        db.session.commit()
+        self.assertIsNone(Job.heartbeat(job.id, "first", 1))
+        self.assertFalse(Job.finish(job.id, "first", Job.SUCCEEDED))
+        jobs.execute(claimed, app.config)
+        found = Job.find(job.id)
+        self.assertEqual((found.status, found.done), (Job.RUNNING, 0))
+        # it stopped at its first progress report
+        self.assertEqual(str(Product.find(products[1].id).price), "2.00")
+
+    def test_keepalive(self):
+        """It should renew the lease while a step that cannot report runs"""
+        job = Job.enqueue("reindex", {})
+        claimed = Job.claim("test", lease=60, max_attempts=3)
+        context = jobs.JobContext(claimed, dict(app.config, JOB_LEASE=0.03))
+        context.done = 7
+        with context.keepalive():
+            time.sleep(0.2)
+        self.assertEqual(Job.find(job.id).done, 7)
+        self.assertFalse(any(thread.name.endswith("keepalive") for thread in threading.enumerate()))
+
+    def test_worker_threads(self):
+        """It should run jobs on its own threads until stopped"""
+        ran = threading.Event()
+        job = Job(id=1, kind="reindex")
+        with patch.object(Job, "claim", side_effect=[job, RuntimeError("database down")] + [None] * 100), \
+                patch("service.common.jobs.execute", MagicMock(side_effect=lambda *_: ran.set())):
+            worker = jobs.JobWorker(app, concurrency=1)
+            worker.poll_interval = 0.01
+            worker.start()
+            self.assertTrue(ran.wait(5))
+            worker.stop(5)
+        self.assertFalse(any(thread.is_alive() for thread in worker._threads))  # pylint: disable=protected-access
@@ -0,0 +1,147 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the most liked Products leaderboard
+"""
+
+# pylint: disable=duplicate-code
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+
+from wsgi import app
+from service.common import metrics
+from service.common.leaderboard import Leaderboard
+from service.models import db, Product, ProductEvent
+from tests.factories import ProductFactory
+
+
+######################################################################
+#  L E A D E R B O A R D   T E S T   C A S E S
+######################################################################
+class TestLeaderboard(TestCase):
+    """Leaderboard Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+
+    def setUp(self):
+        """This runs before each test"""
+        metrics.reset()
+        db.session.query(Product).delete()
+        db.session.commit()
+        self.board = Leaderboard(db.engine, 3)
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def _create(self, *likes):
+        """Creates one Product per like count"""
+        products = []
+        for count in likes:
+            product = ProductFactory(likes=count)
+            product.create()
+            products.append(product)
+        return products
+
+    def _ids(self, count):
+        """Returns the ids of the top count Products"""
+        return [product["id"] for product in self.board.top(count)]
+
+    def test_cold_start_loads_from_database(self):
+        """It should load the most liked Products on first use"""
+        products = self._create(1, 9, 5)
+        self.assertEqual(self._ids(3), [products[1].id, products[2].id, products[0].id])
+        self.assertEqual(self._ids(1), [products[1].id])
+        self.assertEqual(metrics.counter("leaderboard.loads"), 1)
+        self.assertEqual(metrics.counter("leaderboard.hits"), 2)
+
+    def test_ties_are_ordered_by_id(self):
+        """It should rank Products with the same likes by id"""
+        products = self._create(4, 4)
+        self.assertEqual(self._ids(2), [products[0].id, products[1].id])
+
+    def test_likes_move_products(self):
+        """It should re-rank a Product when it is liked"""
+        products = self._create(2, 1)
+        first, second = products[0], products[1]
+        self.assertEqual(self._ids(2), [first.id, second.id])
+        second.likes = 3
+        second.update()
+        self.assertEqual(self._ids(2), [second.id, first.id])
+        self.assertEqual(self.board.top(1)[0]["likes"], 3)
+        # replayed entries keep the price type of loaded ones
+        self.assertEqual(self.board.top(2)[0]["price"], second.price)
+        self.assertIsInstance(self.board.top(2)[0]["price"], type(self.board.top(2)[1]["price"]))
+        self.assertEqual(metrics.counter("leaderboard.loads"), 1)
+
+    def test_new_and_deleted_products(self):
+        """It should add created Products and drop deleted ones"""
+        first = self._create(2)[0]
+        self.assertEqual(self._ids(3), [first.id])
+        second = self._create(7)[0]
+        self.assertEqual(self._ids(3), [second.id, first.id])
+        second.delete()
+        self.assertEqual(self._ids(3), [first.id])
+        self.assertEqual(metrics.counter("leaderboard.loads"), 1)
+
+    def test_full_board_ignores_low_ranks(self):
+        """It should only keep size Products and reload when it runs short"""
+        products = self._create(5, 4, 3, 2)
+        self.assertEqual(self._ids(3), [product.id for product in products[:3]])
+        self.assertFalse(self.board.complete)
+        # a Product below the last entry is not added
+        products[3].likes = 1
+        products[3].update()
+        self.assertEqual(len(self.board.top(3)), 3)
+        # one that falls out leaves the board short, and the next read reloads
+        products[0].delete()
+        self.assertEqual(self._ids(3), [products[1].id, products[2].id, products[3].id])
+        self.assertEqual(metrics.counter("leaderboard.loads"), 2)
+
+    def test_pushes_out_last_entry(self):
+        """It should drop the last entry when a Product overtakes it"""
+        products = self._create(5, 4, 3, 2)
+        self.board.top(3)
+        products[3].likes = 10
+        products[3].update()
+        self.assertEqual(self._ids(3), [products[3].id, products[0].id, products[1].id])
+        self.assertEqual(metrics.counter("leaderboard.loads"), 1)
+
+    def test_reloads_after_gap(self):
+        """It should reload when events were pruned or it is too far behind"""
+        self._create(1)
+        self.board.top(1)
+        self._create(2, 3)
+        db.session.query(ProductEvent).filter(ProductEvent.seq == self.board.last_seq + 1).delete()
+        db.session.commit()
+        self.assertEqual(len(self.board.top(3)), 3)
+        self.assertEqual(metrics.counter("leaderboard.loads"), 2)
+        self.assertEqual(self.board.last_seq, ProductEvent.latest_seq())
+
+    @patch("service.common.leaderboard.BATCH_SIZE", 1)
+    def test_reloads_when_far_behind(self):
+        """It should reload instead of replaying a long backlog"""
+        self.board.top(1)
+        self._create(1, 2)
+        self.assertEqual(len(self.board.top(2)), 2)
+        self.assertEqual(metrics.counter("leaderboard.loads"), 2)
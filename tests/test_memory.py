@@ -0,0 +1,104 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the memory budget
+"""
+
+# pylint: disable=duplicate-code
+import logging
+import signal
+import tracemalloc
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import Flask
+from wsgi import app
+from service.common import status, metrics, memory
+
+
+######################################################################
+#  M E M O R Y   T E S T   C A S E S
+######################################################################
+class TestMemory(TestCase):
+    """Memory Budget Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+
+    def setUp(self):
+        """This runs before each test"""
+        metrics.reset()
+
+    def _budget_app(self, limit_mb):
+        """Returns a bare app with the memory budget installed"""
+        budget_app = Flask(__name__)
+        budget_app.config["MEMORY_SOFT_LIMIT_MB"] = limit_mb
+        budget_app.add_url_rule("/", "index", lambda: "ok")
+        memory.init_memory_budget(budget_app)
+        return budget_app.test_client()
+
+    def test_rss(self):
+        """It should measure the resident set size, with or without /proc"""
+        self.assertGreater(memory.rss_bytes(), memory.MEGABYTE)
+        with patch("builtins.open", side_effect=OSError):
+            self.assertGreater(memory.rss_bytes(), memory.MEGABYTE)
+
+    def test_report(self):
+        """It should report allocation sites only while tracemalloc is on"""
+        usage = memory.report()
+        self.assertFalse(usage["tracemalloc"]["tracing"])
+        self.assertNotIn("top", usage["tracemalloc"])
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        kept = [bytearray(1024) for _ in range(100)]
+        usage = memory.report(top=3)
+        self.assertEqual(len(usage["tracemalloc"]["top"]), 3)
+        self.assertGreater(usage["tracemalloc"]["current_bytes"], 100 * 1024)
+        self.assertTrue(kept)
+
+    @patch("service.common.memory.os.kill")
+    def test_recycles_gunicorn_worker(self, kill_mock):
+        """It should ask a gunicorn worker over the soft limit to exit once"""
+        client = self._budget_app(1)
+        environ = {"SERVER_SOFTWARE": "gunicorn/23.0.0"}
+        client.get("/", environ_base=environ)
+        client.get("/", environ_base=environ)
+        kill_mock.assert_called_once()
+        self.assertEqual(kill_mock.call_args.args[1], signal.SIGTERM)
+        self.assertEqual(metrics.counter("memory.recycles"), 1)
+        self.assertGreater(metrics.snapshot()["gauges"]["memory.rss_bytes"], 0)
+
+    @patch("service.common.memory.os.kill")
+    def test_no_recycling(self, kill_mock):
+        """It should leave other servers and workers under the limit alone"""
+        self._budget_app(1).get("/")
+        self._budget_app(10**6).get("/", environ_base={"SERVER_SOFTWARE": "gunicorn/23.0.0"})
+        self._budget_app(0).get("/", environ_base={"SERVER_SOFTWARE": "gunicorn/23.0.0"})
+        kill_mock.assert_not_called()
+
+    def test_memory_endpoint(self):
+        """It should report the worker's memory to admins only"""
+        client = app.test_client()
+        self.assertEqual(client.get("/memory").status_code, status.HTTP_403_FORBIDDEN)
+        app.config["ADMIN_TOKEN"] = "secret"
+        self.addCleanup(app.config.update, ADMIN_TOKEN="")
+        response = client.get("/memory", query_string={"top": 5}, headers={"X-Admin-Token": "secret"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(response.get_json()["rss_bytes"], 0)
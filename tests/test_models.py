@@ -21,11 +21,24 @@ Test cases for product Model
 # pylint: disable=duplicate-code
 import os
 import logging
+from datetime import timedelta
 from unittest import TestCase
 from unittest.mock import patch
 
+from sqlalchemy import event
+
 from wsgi import app
-from service.models import Product, DataValidationError, db
+from service.models import (
+    Product,
+    ChangeCounter,
+    ProductEvent,
+    IdempotencyKey,
+    DataValidationError,
+    VersionConflictError,
+    db,
+    utcnow,
+    as_utc,
+)
 from tests.factories import ProductFactory
 
 
@@ -165,6 +178,39 @@ class TestProduct(TestCase):
         self.assertEqual(products[0].id, original_id)
         self.assertEqual(products[0].description, "Updated description")
 
+    def test_update_bumps_version(self):
+        """It should increment the version on every Update"""
+        product = ProductFactory()
+        product.create()
+        self.assertEqual(product.version, 1)
+        product.description = "Updated description"
+        product.update()
+        self.assertEqual(product.version, 2)
+
+    def test_update_stale_product(self):
+        """It should not Update a Product that changed since it was read"""
+        product = ProductFactory()
+        product.create()
+        # simulate a concurrent writer bumping the version behind our back
+        db.session.execute(
+            db.update(Product.__table__)
+            .where(Product.id == product.id)
+            .values(version=Product.version + 1)
+        )
+        product.description = "Lost update"
+        self.assertRaises(VersionConflictError, product.update)
+        self.assertNotEqual(Product.find(product.id).description, "Lost update")
+
+    def test_update_deleted_product(self):
+        """It should not Update a Product deleted since it was read"""
+        product = ProductFactory()
+        product.create()
+        product_id = product.id
+        Product.delete_by_id(product_id)
+        stale = ProductFactory(id=product_id, version=1, description="Too late")
+        self.assertFalse(stale.update())
+        self.assertIsNone(Product.find(product_id))
+
     @patch("service.models.db.session.commit")
     def test_update_product_failed(self, exception_mock):
         """It should not update a product on database error"""
@@ -192,6 +238,141 @@ class TestProduct(TestCase):
         products = Product.all()
         self.assertEqual(len(products), 5)
 
+    # Round-trips
+    def _capture_statements(self):
+        """Records every SQL statement sent to the database by the test"""
+        statements = []
+
+        def before_cursor_execute(*args):
+            statements.append(args[2].split()[0].upper())
+
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        self.addCleanup(
+            event.remove, db.engine, "before_cursor_execute", before_cursor_execute
+        )
+        return statements
+
+    def test_create_does_not_reload(self):
+        """It should Create and serialize a Product without a SELECT"""
+        product = ProductFactory(likes=None)
+        statements = self._capture_statements()
+        product.create()
+        data = product.serialize()
+        self.assertNotIn("SELECT", statements)
+        self.assertEqual(statements[0], "INSERT")
+        self.assertEqual(data["likes"], 0)
+        self.assertEqual(product.version, 1)
+        # the instance is attached so it can still be updated
+        product.name = "Renamed"
+        product.update()
+        self.assertEqual(Product.find(product.id).name, "Renamed")
+
+    def test_delete_by_id(self):
+        """It should Delete a Product by id without loading it"""
+        product = ProductFactory()
+        product.create()
+        product_id = product.id
+        statements = self._capture_statements()
+        self.assertEqual(Product.delete_by_id(product_id), 1)
+        self.assertNotIn("SELECT", statements)
+        self.assertEqual(statements[0], "DELETE")
+        self.assertEqual(Product.delete_by_id(product_id), 0)
+        self.assertIsNone(Product.find(product_id))
+
+    def test_find_many(self):
+        """It should find several Products by id in one query"""
+        products = ProductFactory.create_batch(3)
+        for product in products:
+            product.create()
+        found = Product.find_many([products[2].id, products[0].id, 0])
+        self.assertEqual(sorted(product.id for product in found), sorted([products[0].id, products[2].id]))
+        self.assertEqual(Product.find_many([]), [])
+
+    # Timestamps
+    def test_timestamps_are_maintained(self):
+        """It should set created_at and refresh updated_at on every write"""
+        product = ProductFactory()
+        product.create()
+        created_at = product.created_at
+        self.assertEqual(product.updated_at, created_at)
+        product.likes += 1
+        product.update()
+        self.assertGreater(as_utc(product.updated_at), as_utc(created_at))
+        self.assertEqual(as_utc(product.created_at), as_utc(created_at))
+        updated_at = product.updated_at
+        patched = Product.patch(product.id, {"name": "Patched"})
+        self.assertGreater(as_utc(patched.updated_at), as_utc(updated_at))
+
+    def test_changes_since(self):
+        """It should list the events after a seq and find the seq at a point in time"""
+        start = ChangeCounter.current()
+        product = ProductFactory()
+        product.create()
+        product_id = product.id
+        product.delete()
+        events = ProductEvent.changes_since(start, 10)
+        actions = [(event.action, event.product_id) for event in events]
+        self.assertEqual(actions, [("created", product_id), ("deleted", product_id)])
+        self.assertEqual([event.seq for event in ProductEvent.changes_since(start, 1)], [start + 1])
+        self.assertEqual(ProductEvent.seq_at(utcnow()), start + 2)
+        self.assertEqual(ProductEvent.seq_at(utcnow() - timedelta(days=1)), ProductEvent.oldest_seq() - 1)
+
+    def test_serialize_timestamps(self):
+        """It should serialize timestamps as ISO 8601 strings in UTC"""
+        product = ProductFactory()
+        self.assertIsNone(product.serialize()["updated_at"])
+        product.create()
+        self.assertTrue(product.serialize()["updated_at"].endswith("+00:00"))
+
+    # Change counter
+    def test_writes_bump_change_counter(self):
+        """It should bump the change counter on every write"""
+        start = ChangeCounter.current()
+        product = ProductFactory()
+        product.create()
+        self.assertEqual(ChangeCounter.current(), start + 1)
+        product.description = "changed"
+        product.update()
+        self.assertEqual(ChangeCounter.current(), start + 2)
+        product.delete()
+        self.assertEqual(ChangeCounter.current(), start + 3)
+
+    def test_change_counter_starts_at_zero(self):
+        """It should create the counter row on the first write"""
+        db.session.query(ProductEvent).delete()
+        db.session.query(ChangeCounter).delete()
+        db.session.commit()
+        self.assertEqual(ChangeCounter.current(), 0)
+        ProductFactory().create()
+        self.assertEqual(ChangeCounter.current(), 1)
+
+    def test_prune_events(self):
+        """It should prune only change events older than the retention"""
+        ProductFactory().create()
+        old = ProductEvent.record("deleted", 0)
+        db.session.execute(
+            db.update(ProductEvent)
+            .where(ProductEvent.seq == old)
+            .values(created_at=utcnow() - timedelta(days=30))
+        )
+        db.session.commit()
+        self.assertEqual(ProductEvent.prune(86400), 1)
+        self.assertNotIn(old, [event["seq"] for event in ProductEvent.since(0)])
+
+    # Idempotency keys
+    def test_purge_expired_idempotency_keys(self):
+        """It should purge only idempotency keys older than the TTL"""
+        db.session.query(IdempotencyKey).delete()
+        old = IdempotencyKey(scope="test", key="old", fingerprint="x", body="{}")
+        old.created_at = utcnow() - timedelta(hours=2)
+        db.session.add(old)
+        db.session.add(IdempotencyKey(scope="test", key="new", fingerprint="x", body="{}"))
+        db.session.commit()
+        self.assertEqual(IdempotencyKey.purge_expired(3600), 1)
+        self.assertIsNone(IdempotencyKey.find("test", "old", 3600))
+        self.assertIsNotNone(IdempotencyKey.find("test", "new", 3600))
+        self.assertEqual(repr(IdempotencyKey.find("test", "new", 3600)), "<IdempotencyKey test new>")
+
     # Serialization
     def test_serialize_a_product(self):
         """It should serialize a Product"""
@@ -248,7 +429,7 @@ class TestProduct(TestCase):
         """It should Find Products by name"""
         product = ProductFactory(name="AirPods")
         product.create()
-        results = Product.find_by_name("AirPods").all()
+        results = Product.find_by_name("AirPods")
         self.assertEqual(len(results), 1)
         self.assertEqual(results[0].name, "AirPods")
 
@@ -274,7 +455,7 @@ class TestProduct(TestCase):
         expensive_product = ProductFactory(price=499.99)
         cheap_product.create()
         expensive_product.create()
-        results = Product.find_by_price_less_than(100).all()
+        results = Product.find_by_price_less_than(100)
         self.assertEqual(len(results), 1)
         self.assertEqual(float(results[0].price), 49.99)
 
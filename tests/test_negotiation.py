@@ -0,0 +1,165 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+
+"""
+Test cases for JSON / MessagePack content negotiation
+"""
+
+# pylint: disable=duplicate-code
+import logging
+from decimal import Decimal
+from unittest import TestCase
+
+import msgpack
+from wsgi import app
+from service.common import status, negotiation
+from service.models import db, Product
+from tests.factories import ProductFactory
+
+MSGPACK = {"Accept": "application/msgpack"}
+
+
+######################################################################
+#  N E G O T I A T I O N   T E S T   C A S E S
+######################################################################
+class TestNegotiation(TestCase):
+    """Content Negotiation Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+
+    def setUp(self):
+        """This runs before each test"""
+        self.client = app.test_client()
+        app.extensions["list_cache"].clear()
+        db.session.query(Product).delete()
+        db.session.commit()
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def test_decimal_round_trip(self):
+        """It should encode Decimals losslessly as an extension type"""
+        data = negotiation.packb({"price": Decimal("12345678.90")})
+        self.assertEqual(negotiation.unpackb(data), {"price": Decimal("12345678.90")})
+        raw = msgpack.unpackb(data)
+        self.assertEqual(raw["price"], msgpack.ExtType(negotiation.DECIMAL_EXT, b"12345678.90"))
+        self.assertEqual(negotiation.unpackb(msgpack.packb(msgpack.ExtType(9, b"x"))), msgpack.ExtType(9, b"x"))
+        with self.assertRaises(TypeError):
+            negotiation.packb({"at": object()})
+
+    def test_json_is_the_default(self):
+        """It should answer in JSON unless the client prefers MessagePack"""
+        ProductFactory().create()
+        for accept in (None, "*/*", "application/json", "application/json, application/msgpack;q=0.5"):
+            resp = self.client.get("/products", headers={"Accept": accept} if accept else {})
+            self.assertEqual(resp.mimetype, "application/json")
+            self.assertEqual(len(resp.get_json()), 1)
+            self.assertEqual(resp.headers["Vary"], "Accept")
+
+    def test_json_body_matches_jsonify(self):
+        """It should lay out cached JSON bodies as jsonify() does"""
+        with app.test_request_context():
+            self.assertEqual(app.json.body({"a": [1, 2]}, negotiation.JSON), app.json.response({"a": [1, 2]}).data)
+            self.assertEqual(app.json.body({"a": 1}, negotiation.JSON), b'{"a":1}\n')
+        app.json.compact = False
+        self.addCleanup(setattr, app.json, "compact", None)
+        self.assertEqual(app.json.body({"a": 1}, negotiation.JSON), b'{\n  "a": 1\n}\n')
+
+    def test_list_as_msgpack(self):
+        """It should list Products as MessagePack, cached apart from JSON"""
+        product = ProductFactory(price=Decimal("19.99"))
+        product.create()
+        as_json = self.client.get("/products")
+        resp = self.client.get("/products", headers=MSGPACK)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/msgpack")
+        self.assertEqual(resp.headers["ETag"], as_json.headers["ETag"][:-1] + '-msgpack"')
+        not_modified = self.client.get("/products", headers=dict(MSGPACK, **{"If-None-Match": as_json.headers["ETag"]}))
+        self.assertEqual(not_modified.status_code, status.HTTP_200_OK)
+        products = negotiation.unpackb(resp.get_data())
+        self.assertEqual(products[0]["price"], Decimal("19.99"))
+        self.assertEqual(products[0]["name"], product.name)
+        again = self.client.get("/products", headers={"Accept": "application/x-msgpack"})
+        self.assertEqual(again.get_data(), resp.get_data())
+        self.assertEqual(self.client.get("/products").get_data(), as_json.get_data())
+
+    def test_create_from_msgpack(self):
+        """It should create and update a Product from a MessagePack body"""
+        body = negotiation.packb({"name": "Lamp", "description": "Bright", "price": Decimal("0.10")})
+        headers = dict(MSGPACK, **{"Content-Type": "application/msgpack"})
+        resp = self.client.post("/products", data=body, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        created = negotiation.unpackb(resp.get_data())
+        self.assertEqual(created["price"], Decimal("0.10"))
+
+        body = negotiation.packb({"price": Decimal("0.30")})
+        resp = self.client.patch(f"/products/{created['id']}", data=body, headers=headers)
+        self.assertEqual(negotiation.unpackb(resp.get_data())["price"], Decimal("0.30"))
+
+        body = negotiation.packb({"ids": [created["id"], 0]})
+        resp = self.client.post("/products/batch-get", data=body, headers=headers)
+        self.assertEqual(negotiation.unpackb(resp.get_data())["missing"], [0])
+
+    def test_bad_msgpack_body(self):
+        """It should reject a body that is not valid MessagePack"""
+        bad_decimal = msgpack.packb({"price": msgpack.ExtType(negotiation.DECIMAL_EXT, b"cheap")})
+        for body in (b"\xc1", bad_decimal):
+            resp = self.client.post(
+                "/products", data=body, headers=dict(MSGPACK, **{"Content-Type": "application/msgpack"})
+            )
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(resp.mimetype, "application/msgpack")
+            self.assertIn("Invalid MessagePack", negotiation.unpackb(resp.get_data())["message"])
+
+    def test_replayed_create(self):
+        """It should replay a create with its price still a Decimal"""
+        body = negotiation.packb({"name": "Lamp", "description": "Bright", "price": Decimal("2.50")})
+        headers = dict(MSGPACK, **{"Content-Type": "application/msgpack", "Idempotency-Key": "lamp"})
+        first = self.client.post("/products", data=body, headers=headers)
+        replay = self.client.post("/products", data=body, headers=headers)
+        self.assertEqual(replay.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(negotiation.unpackb(replay.get_data()), negotiation.unpackb(first.get_data()))
+
+    def test_if_match_either_representation(self):
+        """It should accept the ETag of either representation in If-Match"""
+        product = ProductFactory()
+        product.create()
+        etag = self.client.get(f"/products/{product.id}", headers=MSGPACK).headers["ETag"]
+        self.assertEqual(etag, '"1-msgpack"')
+        body = negotiation.packb({"price": Decimal("3.00")})
+        headers = dict(MSGPACK, **{"Content-Type": "application/msgpack", "If-Match": etag})
+        resp = self.client.patch(f"/products/{product.id}", data=body, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["ETag"], '"2-msgpack"')
+        resp = self.client.put(f"/products/{product.id}", json=dict(product.serialize(), price="4.00"),
+                               headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+    def test_content_type_parameters(self):
+        """It should ignore media type parameters but reject other types"""
+        body = {"name": "Lamp", "description": "Bright", "price": "1.00"}
+        resp = self.client.post("/products", json=body, headers={"Content-Type": "application/json; charset=utf-8"})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.client.post("/products", data="x", headers={"Content-Type": "text/plain"})
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        self.assertIn("application/json or application/msgpack", resp.get_json()["message"])
@@ -0,0 +1,126 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for on-demand request profiling
+"""
+
+# pylint: disable=duplicate-code
+import logging
+import os
+import pstats
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from wsgi import app
+from service.common import status, metrics, profiling
+from service.models import db
+
+ADMIN = {"X-Admin-Token": "secret"}
+
+
+######################################################################
+#  P R O F I L I N G   T E S T   C A S E S
+######################################################################
+class TestProfiling(TestCase):
+    """Request Profiling Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+
+    def setUp(self):
+        """This runs before each test"""
+        metrics.reset()
+        self.client = app.test_client()
+        directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(directory.cleanup)
+        saved = {key: app.config[key] for key in ("ADMIN_TOKEN", "PROFILE_DIR", "PROFILE_KEEP", "PROFILE_SAMPLE_RATE")}
+        self.addCleanup(app.config.update, saved)
+        app.config.update(ADMIN_TOKEN="secret", PROFILE_DIR=directory.name, PROFILE_KEEP=2, PROFILE_SAMPLE_RATE=0)
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def test_profile_on_request(self):
+        """It should profile an admin request with X-Profile: 1 and store the dump"""
+        response = self.client.get("/products", headers=dict(ADMIN, **{"X-Profile": "1"}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        profile_id = response.headers["X-Profile-Id"]
+        self.assertTrue(profile_id.startswith("list_products/"))
+        stats = pstats.Stats(os.path.join(app.config["PROFILE_DIR"], profile_id))
+        self.assertTrue(stats.total_calls)
+        self.assertEqual(metrics.counter("profiling.requests"), 1)
+
+        response = self.client.get("/profiles", headers=ADMIN)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([profile["id"] for profile in response.get_json()], [profile_id])
+
+        response = self.client.get(f"/profiles/{profile_id}", headers=ADMIN)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/octet-stream")
+        response.close()
+
+    def test_no_profile_without_admin(self):
+        """It should ignore X-Profile from anyone but an admin"""
+        response = self.client.get("/products", headers={"X-Profile": "1"})
+        self.assertNotIn("X-Profile-Id", response.headers)
+        self.assertEqual(profiling.list_profiles(app.config["PROFILE_DIR"]), [])
+        response = self.client.get("/profiles")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_sampling_and_retention(self):
+        """It should profile sampled requests and keep only the newest per route"""
+        app.config["PROFILE_SAMPLE_RATE"] = 1
+        for _ in range(3):
+            response = self.client.get("/health")
+            self.assertIn("X-Profile-Id", response.headers)
+        profiles = profiling.list_profiles(app.config["PROFILE_DIR"])
+        self.assertEqual(len(profiles), 2)
+        self.assertEqual({profile["route"] for profile in profiles}, {"health"})
+
+    def test_keep_none(self):
+        """It should not profile anything when no dumps are to be kept"""
+        app.config.update(PROFILE_KEEP=0, PROFILE_SAMPLE_RATE=1)
+        response = self.client.get("/health", headers=dict(ADMIN, **{"X-Profile": "1"}))
+        self.assertNotIn("X-Profile-Id", response.headers)
+        self.assertEqual(profiling.list_profiles(app.config["PROFILE_DIR"]), [])
+
+    def test_one_profile_at_a_time(self):
+        """It should skip profiling while another request is being profiled"""
+        app.config["PROFILE_SAMPLE_RATE"] = 1
+        with profiling._busy:  # pylint: disable=protected-access
+            response = self.client.get("/health")
+        self.assertNotIn("X-Profile-Id", response.headers)
+        self.assertEqual(metrics.counter("profiling.skipped"), 1)
+
+    def test_profile_stopped_on_error(self):
+        """It should stop the profiler when a request produced no response"""
+        app.config["PROFILE_SAMPLE_RATE"] = 1
+        app.extensions["list_cache"].clear()
+        with patch("service.routes.Product.all", side_effect=RuntimeError("boom")):
+            with self.assertRaises(RuntimeError):
+                self.client.get("/products")
+        self.assertFalse(profiling._busy.locked())  # pylint: disable=protected-access
+
+    def test_missing_directory(self):
+        """It should list no profiles before any were stored"""
+        self.assertEqual(profiling.list_profiles(os.path.join(app.config["PROFILE_DIR"], "none")), [])
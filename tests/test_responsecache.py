@@ -0,0 +1,178 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+
+"""
+Test cases for the listing response cache
+"""
+
+# pylint: disable=duplicate-code
+import logging
+import threading
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from wsgi import app
+from service.common import status, metrics
+from service.common.responsecache import ResponseCache
+from service.models import db, Product
+from tests.factories import ProductFactory
+
+CONFIG = {
+    "LIST_CACHE_SIZE": 2,
+    "LIST_CACHE_MAX_BYTES": 1000,
+    "LIST_CACHE_MAX_ENTRY_BYTES": 100,
+    "LIST_CACHE_STALE_SECONDS": 0,
+}
+
+
+######################################################################
+#  R E S P O N S E   C A C H E   T E S T   C A S E S
+######################################################################
+class TestResponseCache(TestCase):
+    """Response Cache Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+
+    def setUp(self):
+        """This runs before each test"""
+        metrics.reset()
+        self.cache = ResponseCache(app, CONFIG)
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def test_hits_until_generation_moves(self):
+        """It should serve a body until the change counter moves past it"""
+        load = MagicMock(return_value=(1, b"[1]"))
+        self.assertEqual(self.cache.get("a", 1, load), (1, b"[1]"))
+        self.assertEqual(self.cache.get("a", 1, load), (1, b"[1]"))
+        self.assertEqual(self.cache.get("a", 0, load), (1, b"[1]"))
+        load.assert_called_once()
+        load.return_value = (2, b"[2]")
+        self.assertEqual(self.cache.get("a", 2, load), (2, b"[2]"))
+        self.assertEqual(metrics.counter("listcache.hits"), 2)
+        self.assertEqual(metrics.counter("listcache.misses"), 2)
+
+    def test_least_recently_used_is_dropped(self):
+        """It should keep only the size most recently used listings"""
+        for key in ("a", "b", "a", "c"):
+            self.cache.get(key, 1, MagicMock(return_value=(1, key.encode())))
+        load = MagicMock(return_value=(1, b"b"))
+        self.cache.get("a", 1, load)
+        self.cache.get("b", 1, load)
+        load.assert_called_once()
+
+    def test_byte_budget(self):
+        """It should drop the least recently used bodies to stay within its byte budget"""
+        cache = ResponseCache(app, dict(CONFIG, LIST_CACHE_SIZE=10, LIST_CACHE_MAX_BYTES=200))
+        for key in ("a", "b", "c"):
+            cache.get(key, 1, MagicMock(return_value=(1, key.encode() * 90)))
+        self.assertEqual(cache.bytes, 180)
+        load = MagicMock(return_value=(1, b"a" * 90))
+        cache.get("a", 1, load)
+        cache.get("c", 1, load)
+        load.assert_called_once()
+        # a newer body replaces the old one in the count
+        cache.get("c", 2, MagicMock(return_value=(2, b"c")))
+        self.assertEqual(cache.bytes, 91)
+        cache.clear()
+        self.assertEqual(cache.bytes, 0)
+
+    def test_large_body_not_kept(self):
+        """It should serve but not keep a body over the per-entry cap"""
+        load = MagicMock(return_value=(1, b"x" * 101))
+        self.assertEqual(self.cache.get("a", 1, load), (1, b"x" * 101))
+        self.cache.get("a", 1, load)
+        self.assertEqual(load.call_count, 2)
+        self.assertEqual(self.cache.bytes, 0)
+        self.assertEqual(metrics.counter("listcache.too_large"), 2)
+
+    def test_disabled(self):
+        """It should always load when the size is 0"""
+        cache = ResponseCache(app, dict(CONFIG, LIST_CACHE_SIZE=0))
+        load = MagicMock(return_value=(1, b"[]"))
+        cache.get("a", 1, load)
+        cache.get("a", 1, load)
+        self.assertEqual(load.call_count, 2)
+
+    def test_stale_while_revalidate(self):
+        """It should serve an outdated body while one thread reloads it"""
+        cache = ResponseCache(app, dict(CONFIG, LIST_CACHE_STALE_SECONDS=60))
+        cache.get("a", 1, MagicMock(return_value=(1, b"old")))
+        release = threading.Event()
+
+        def slow_load():
+            release.wait(5)
+            return 2, b"new"
+
+        load = MagicMock(side_effect=slow_load)
+        with patch("service.common.responsecache.threading.Thread", wraps=threading.Thread) as thread:
+            self.assertEqual(cache.get("a", 2, load), (1, b"old"))
+            self.assertEqual(cache.get("a", 2, load), (1, b"old"))
+            thread.assert_called_once()
+        release.set()
+        for refresh in threading.enumerate():
+            if refresh.name == "listcache":
+                refresh.join(5)
+        self.assertEqual(cache.get("a", 2, load), (2, b"new"))
+        load.assert_called_once()
+        self.assertEqual(metrics.counter("listcache.stale"), 2)
+        self.assertEqual(metrics.counter("listcache.refreshes"), 1)
+
+    def test_stale_limit(self):
+        """It should stop serving an outdated body once it has been stale too long"""
+        cache = ResponseCache(app, dict(CONFIG, LIST_CACHE_STALE_SECONDS=60))
+        cache.get("a", 1, MagicMock(return_value=(1, b"old")))
+        with patch("service.common.responsecache.time.monotonic", side_effect=[0, 61]), \
+                patch("service.common.responsecache.threading.Thread"):
+            self.assertEqual(cache.get("a", 2, MagicMock()), (1, b"old"))
+            self.assertEqual(cache.get("a", 2, MagicMock(return_value=(2, b"new"))), (2, b"new"))
+
+    def test_failed_refresh(self):
+        """It should keep the old body and try again after a failed reload"""
+        cache = ResponseCache(app, dict(CONFIG, LIST_CACHE_STALE_SECONDS=60))
+        cache.get("a", 1, MagicMock(return_value=(1, b"old")))
+        cache._refresh("a", MagicMock(side_effect=RuntimeError("boom")))  # pylint: disable=protected-access
+        with patch("service.common.responsecache.threading.Thread") as thread:
+            self.assertEqual(cache.get("a", 2, MagicMock()), (1, b"old"))
+            thread.assert_called_once()
+
+    def test_listing_is_cached(self):
+        """It should answer a repeated listing from the cache until a Product changes"""
+        client = app.test_client()
+        app.extensions["list_cache"].clear()
+        db.session.query(Product).delete()
+        db.session.commit()
+        ProductFactory().create()
+        first = client.get("/products")
+        with patch("service.routes.Product.all", side_effect=RuntimeError("not cached")):
+            second = client.get("/products")
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.get_data(), first.get_data())
+        self.assertEqual(second.headers["ETag"], first.headers["ETag"])
+        self.assertEqual(metrics.counter("listcache.hits"), 1)
+
+        ProductFactory().create()
+        third = client.get("/products")
+        self.assertEqual(len(third.get_json()), 2)
+        self.assertNotEqual(third.headers["ETag"], first.headers["ETag"])
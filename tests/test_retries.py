@@ -0,0 +1,177 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for retrying transient database errors
+"""
+
+# pylint: disable=duplicate-code
+import logging
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from wsgi import app
+from service.common import metrics, status
+from service.common.retries import RetryPolicy, DatabaseUnavailable, classify
+from service.models import db, Product, ProductEvent, DataValidationError
+from tests.factories import ProductFactory
+
+CONFIG = {"DB_RETRY_TRIES": 3, "DB_RETRY_DELAY": 0, "DB_RETRY_MAX_DELAY": 0, "DB_RETRY_BUDGET": 10}
+
+
+class FakeDriverError(Exception):
+    """A driver error carrying a SQLSTATE like psycopg's"""
+
+    def __init__(self, sqlstate, message="driver error"):
+        super().__init__(message)
+        self.sqlstate = sqlstate
+
+
+def db_error(sqlstate=None, message="driver error", invalidated=False, kind=OperationalError):
+    """Returns a SQLAlchemy error wrapping a driver error"""
+    return kind("UPDATE product", {}, FakeDriverError(sqlstate, message), connection_invalidated=invalidated)
+
+
+######################################################################
+#  R E T R Y   T E S T   C A S E S
+######################################################################
+class TestRetries(TestCase):
+    """Database Retry Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+
+    def setUp(self):
+        """This runs before each test"""
+        metrics.reset()
+        self.session = MagicMock()
+        self.policy = RetryPolicy(CONFIG)
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def test_classify(self):
+        """It should tell transient errors from errors in the request"""
+        self.assertEqual(classify(db_error("40001")), "serialization")
+        self.assertEqual(classify(db_error("40P01")), "deadlock")
+        self.assertEqual(classify(db_error("08006")), "disconnect")
+        self.assertEqual(classify(db_error("57P01")), "disconnect")
+        self.assertEqual(classify(db_error(invalidated=True)), "disconnect")
+        self.assertEqual(classify(db_error(message="database is locked")), "locked")
+        self.assertIsNone(classify(db_error("23505", kind=IntegrityError)))
+        self.assertIsNone(classify(ValueError("bad")))
+
+    def test_retries_until_success(self):
+        """It should run the work again after transient failures"""
+        work = MagicMock(side_effect=[db_error("40P01"), db_error("40001"), "done"])
+        self.assertEqual(self.policy.run("test", self.session, work), "done")
+        self.assertEqual(work.call_count, 3)
+        self.assertEqual(self.session.rollback.call_count, 2)
+        self.session.commit.assert_called_once()
+        self.assertEqual(metrics.counter("db.retry.test.retries"), 2)
+        self.assertEqual(metrics.counter("db.retry.errors.deadlock"), 1)
+
+    def test_no_retry_for_request_errors(self):
+        """It should raise constraint violations and other errors at once"""
+        error = db_error("23505", kind=IntegrityError)
+        work = MagicMock(side_effect=error)
+        with self.assertRaises(IntegrityError):
+            self.policy.run("test", self.session, work)
+        work.assert_called_once()
+        self.session.rollback.assert_called_once()
+
+    def test_no_retry_for_lost_commit(self):
+        """It should not run the work again when the connection dropped during COMMIT"""
+        self.session.commit.side_effect = db_error("08006")
+        work = MagicMock(return_value="done")
+        with self.assertRaises(OperationalError):
+            self.policy.run("test", self.session, work)
+        work.assert_called_once()
+
+    def test_retries_serialization_failure_on_commit(self):
+        """It should retry a COMMIT the server rolled back"""
+        self.session.commit.side_effect = [db_error("40001"), None]
+        work = MagicMock(return_value="done")
+        self.assertEqual(self.policy.run("test", self.session, work), "done")
+        self.assertEqual(work.call_count, 2)
+
+    def test_gives_up(self):
+        """It should raise DatabaseUnavailable once the tries or the budget run out"""
+        error = db_error("40P01")
+        work = MagicMock(side_effect=error)
+        with self.assertRaises(DatabaseUnavailable) as context:
+            self.policy.run("test", self.session, work)
+        self.assertIs(context.exception.error, error)
+        self.assertEqual(context.exception.retry_after, 10)
+        self.assertEqual(work.call_count, 3)
+        self.assertEqual(metrics.counter("db.retry.test.exhausted"), 1)
+
+        policy = RetryPolicy(dict(CONFIG, DB_RETRY_BUDGET=0))
+        work = MagicMock(side_effect=error)
+        with self.assertRaises(DatabaseUnavailable) as context:
+            policy.run("test", self.session, work)
+        work.assert_called_once()
+        self.assertEqual(context.exception.retry_after, 1)
+        self.assertEqual(metrics.counter("db.retry.test.out_of_budget"), 1)
+
+    def test_budget_checked_after_sleep(self):
+        """It should not start an attempt once the sleep has used up the budget"""
+        policy = RetryPolicy(dict(CONFIG, DB_RETRY_BUDGET=5))
+        work = MagicMock(side_effect=db_error("40P01"))
+        with patch("service.common.retries.time.monotonic", side_effect=[0, 1, 6]):
+            with self.assertRaises(DatabaseUnavailable):
+                policy.run("test", self.session, work)
+        self.assertEqual(work.call_count, 2)
+        self.assertEqual(metrics.counter("db.retry.test.out_of_budget"), 1)
+
+    def test_model_writes_are_retried(self):
+        """It should retry a Product write that hit a deadlock"""
+        record = ProductEvent.record.__func__
+        failures = [db_error("40P01")]
+
+        def flaky(cls, *args, **kwargs):
+            if failures:
+                raise failures.pop()
+            return record(cls, *args, **kwargs)
+
+        product = ProductFactory()
+        with patch.object(ProductEvent, "record", classmethod(flaky)):
+            product.create()
+        self.assertIsNotNone(Product.find(product.id))
+        self.assertEqual(metrics.counter("db.retry.create.retries"), 1)
+
+        with patch.object(ProductEvent, "record", classmethod(flaky)):
+            failures.append(db_error("23505", kind=IntegrityError))
+            product.likes = 5
+            self.assertRaises(DataValidationError, product.update)
+
+    def test_exhausted_write_is_unavailable(self):
+        """It should answer 503 with Retry-After when a write outlasts its retries"""
+        policy = RetryPolicy(dict(CONFIG, DB_RETRY_TRIES=1))
+        data = ProductFactory().serialize()
+        with patch.dict(app.extensions, {"db_retry": policy}), patch.object(
+            ProductEvent, "record", MagicMock(side_effect=db_error("40P01"))
+        ):
+            response = app.test_client().post("/products", json=data)
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.headers["Retry-After"], "10")
+        self.assertEqual(response.get_json()["error"], "Service Unavailable")
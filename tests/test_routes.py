@@ -20,14 +20,18 @@ TestProduct API Service Test Suite
 
 # pylint: disable=duplicate-code
 import os
+import json
 import logging
 from decimal import Decimal
 from unittest import TestCase
+from unittest.mock import patch
 from urllib.parse import quote_plus
 
+
 from wsgi import app
 from service.common import status
-from service.models import db, Product
+from service import routes
+from service.models import db, Product, ProductEvent, ChangeCounter, IdempotencyKey, VersionConflictError
 from .factories import ProductFactory
 
 
@@ -63,6 +67,7 @@ class TestProductService(TestCase):
     def setUp(self):
         """Runs before each test"""
         self.client = app.test_client()
+        db.session.query(IdempotencyKey).delete()
         db.session.query(Product).delete()  # clean up the last tests
         db.session.commit()
 
@@ -274,6 +279,52 @@ class TestProductService(TestCase):
         self.assertEqual(new_product["description"], test_product.description)
         self.assertEqual(Decimal(new_product["price"]), test_product.price)
 
+    def test_create_product_idempotent(self):
+        """It should Create a Product only once for a repeated Idempotency-Key"""
+        test_product = ProductFactory()
+        headers = {"Idempotency-Key": "abc-123"}
+        first = self.client.post(BASE_URL, json=test_product.serialize(), headers=headers)
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        second = self.client.post(BASE_URL, json=test_product.serialize(), headers=headers)
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(second.get_json(), first.get_json())
+        self.assertEqual(second.headers["Location"], first.headers["Location"])
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 1)
+
+    def test_create_product_idempotency_key_reused(self):
+        """It should not accept an Idempotency-Key reused for another body"""
+        headers = {"Idempotency-Key": "abc-123"}
+        self.client.post(BASE_URL, json=ProductFactory().serialize(), headers=headers)
+        response = self.client.post(BASE_URL, json=ProductFactory().serialize(), headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_create_product_idempotency_key_race(self):
+        """It should replay the winner when a concurrent retry loses the race"""
+        test_product = ProductFactory()
+        headers = {"Idempotency-Key": "race"}
+        first = self.client.post(BASE_URL, json=test_product.serialize(), headers=headers)
+        record = IdempotencyKey.find("create_product", "race", 60)
+        db.session.expunge(record)
+        # the loser misses the key on its first look, then fails on insert
+        with patch("service.routes.IdempotencyKey.find", side_effect=[None, record]):
+            second = self.client.post(BASE_URL, json=test_product.serialize(), headers=headers)
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.get_json(), first.get_json())
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 1)
+
+    def test_create_product_idempotency_key_expired(self):
+        """It should Create again once the Idempotency-Key has expired"""
+        test_product = ProductFactory()
+        headers = {"Idempotency-Key": "old"}
+        self.client.post(BASE_URL, json=test_product.serialize(), headers=headers)
+        app.config["IDEMPOTENCY_TTL"] = -1
+        self.addCleanup(app.config.update, IDEMPOTENCY_TTL=86400)
+        response = self.client.post(BASE_URL, json=test_product.serialize(), headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn("Idempotent-Replayed", response.headers)
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 2)
+
     def test_create_with_bad_request(self):
         """It should not Create when sending the wrong data"""
         response = self.client.post(BASE_URL, json={"name": "not enough data"})
@@ -329,6 +380,80 @@ class TestProductService(TestCase):
         updated_product = response.get_json()
         self.assertEqual(updated_product["description"], "test description")
 
+    def test_update_product_with_if_match(self):
+        """It should Update a Product when If-Match names the current version"""
+        test_product = self._create_products(1)[0]
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        etag = response.headers["ETag"]
+        self.assertEqual(etag, '"1"')
+
+        data = response.get_json()
+        data["description"] = "conditional update"
+        response = self.client.put(
+            f"{BASE_URL}/{test_product.id}", json=data, headers={"If-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["ETag"], '"2"')
+
+        # a second writer still holding the old ETag must be rejected
+        data["description"] = "lost update"
+        response = self.client.put(
+            f"{BASE_URL}/{test_product.id}", json=data, headers={"If-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.get_json()["description"], "conditional update")
+
+    def test_update_product_version_conflict(self):
+        """It should redo an unconditional update when the row changes between read and write"""
+        test_product = self._create_products(1)[0]
+        data = test_product.serialize()
+        # the route reads this copy, then a concurrent writer bumps the row
+        stale = Product.find(test_product.id)
+        self.assertEqual(stale.version, 1)
+        table = Product.__table__
+        db.session.execute(
+            db.update(table).where(table.c.id == test_product.id).values(version=table.c.version + 1)
+        )
+        data["description"] = "last writer wins"
+        response = self.client.put(f"{BASE_URL}/{test_product.id}", json=data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["description"], "last writer wins")
+        self.assertEqual(response.headers["ETag"], '"3"')
+
+    def test_update_product_if_match_race(self):
+        """It should return 412 when a write lands between the If-Match check and the update"""
+        test_product = self._create_products(1)[0]
+        table = Product.__table__
+
+        def concurrent_write():
+            db.session.execute(
+                db.update(table).where(table.c.id == test_product.id).values(version=table.c.version + 1)
+            )
+            db.session.expire_all()
+            raise VersionConflictError("modified by another request")
+
+        with patch.object(Product, "update", side_effect=concurrent_write):
+            response = self.client.put(
+                f"{BASE_URL}/{test_product.id}", json=test_product.serialize(), headers={"If-Match": '"1"'}
+            )
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+    def test_update_product_deleted_meanwhile(self):
+        """It should return 404 when the Product is deleted between read and write"""
+        test_product = self._create_products(1)[0]
+        with patch.object(Product, "update", return_value=False):
+            response = self.client.put(f"{BASE_URL}/{test_product.id}", json=test_product.serialize())
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_update_product_keeps_changing(self):
+        """It should return 409 when the row changes on every attempt"""
+        test_product = self._create_products(1)[0]
+        with patch.object(Product, "update", side_effect=VersionConflictError("modified")) as update:
+            response = self.client.put(f"{BASE_URL}/{test_product.id}", json=test_product.serialize())
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(update.call_count, routes.PUT_ATTEMPTS)
+
     def test_update_product_with_invalid_data(self):
         """It should not Update a Product with invalid data"""
         test_product = self._create_products(1)[0]
@@ -338,6 +463,89 @@ class TestProductService(TestCase):
         response = self.client.put(f"{BASE_URL}/{test_product.id}", json=invalid_data)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_create_product_field_errors(self):
+        """It should report every invalid field without touching the database"""
+        data = ProductFactory().serialize()
+        data.update(name="x" * 64, price="-1.999")
+        with patch("service.models.db.session.execute") as execute:
+            response = self.client.post(BASE_URL, json=data)
+            execute.assert_not_called()
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = response.get_json()["errors"]
+        self.assertEqual(set(errors), {"name", "price"})
+        self.assertIn("63", errors["name"])
+
+    def test_update_product_field_errors(self):
+        """It should reject an invalid PUT or PATCH body before reading the Product"""
+        test_product = self._create_products(1)[0]
+        data = dict(test_product.serialize(), name="x" * 64)
+        with patch("service.routes.Product.find") as find, patch("service.routes.Product.patch") as patch_product:
+            response = self.client.put(f"{BASE_URL}/{test_product.id}", json=data)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(set(response.get_json()["errors"]), {"name"})
+            response = self.client.patch(f"{BASE_URL}/{test_product.id}", json={"price": "-1"})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(set(response.get_json()["errors"]), {"price"})
+            find.assert_not_called()
+            patch_product.assert_not_called()
+
+    # ----------------------------------------------------------
+    # TEST PATCH
+    # ----------------------------------------------------------
+    def test_patch_product(self):
+        """It should Patch only the given attributes of a Product"""
+        test_product = self._create_products(1)[0]
+        response = self.client.patch(
+            f"{BASE_URL}/{test_product.id}", json={"price": "12.34"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["ETag"], '"2"')
+        data = response.get_json()
+        self.assertEqual(Decimal(data["price"]), Decimal("12.34"))
+        self.assertEqual(data["name"], test_product.name)
+        self.assertEqual(data["description"], test_product.description)
+
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(Decimal(response.get_json()["price"]), Decimal("12.34"))
+
+    def test_patch_product_not_found(self):
+        """It should not Patch a Product that is not found"""
+        response = self.client.patch(f"{BASE_URL}/0", json={"name": "ghost"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_patch_product_without_fields(self):
+        """It should not Patch a Product without any updatable attributes"""
+        test_product = self._create_products(1)[0]
+        response = self.client.patch(f"{BASE_URL}/{test_product.id}", json={"likes": 5})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.patch(f"{BASE_URL}/{test_product.id}", json=["name"])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_patch_product_with_bad_data(self):
+        """It should not Patch a Product with a value the database rejects"""
+        test_product = self._create_products(1)[0]
+        response = self.client.patch(
+            f"{BASE_URL}/{test_product.id}", json={"price": "not a number"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_patch_product_with_if_match(self):
+        """It should only Patch a Product whose version matches If-Match"""
+        test_product = self._create_products(1)[0]
+        url = f"{BASE_URL}/{test_product.id}"
+        response = self.client.patch(url, json={"name": "v2"}, headers={"If-Match": '"1"'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.patch(url, json={"name": "v3"}, headers={"If-Match": '"1"'})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.patch(url, json={"name": "v3"}, headers={"If-Match": 'W/"2"'})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.patch(url, json={"name": "v3"}, headers={"If-Match": "*"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.patch(
+            f"{BASE_URL}/0", json={"name": "v3"}, headers={"If-Match": '"1"'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     # ----------------------------------------------------------
     # TEST READ
     # ----------------------------------------------------------
@@ -350,6 +558,49 @@ class TestProductService(TestCase):
         data = response.get_json()
         self.assertEqual(data["name"], test_product.name)
 
+    def test_get_product_not_modified(self):
+        """It should return 304 when the client already has the Product"""
+        test_product = self._create_products(1)[0]
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        etag = response.headers["ETag"]
+        self.assertEqual(response.headers["Cache-Control"], "no-cache")
+
+        response = self.client.get(
+            f"{BASE_URL}/{test_product.id}", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.headers["ETag"], etag)
+        self.assertEqual(len(response.data), 0)
+
+        # a like changes the version so the old ETag no longer matches
+        self.client.put(f"{BASE_URL}/{test_product.id}/like")
+        response = self.client.get(
+            f"{BASE_URL}/{test_product.id}", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_get_product_without_single_flight(self):
+        """It should Get a Product with request coalescing turned off"""
+        test_product = self._create_products(1)[0]
+        app.config["SINGLE_FLIGHT"] = False
+        self.addCleanup(app.config.update, SINGLE_FLIGHT=True)
+        response = self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["name"], test_product.name)
+
+    def test_get_product_single_flight_key(self):
+        """It should share Product reads by id and forget them on every write"""
+        test_product = self._create_products(1)[0]
+        reads = app.extensions["product_reads"]
+        with patch.object(reads, "do", wraps=reads.do) as do, \
+                patch.object(reads, "forget", wraps=reads.forget) as forget:
+            self.client.get(f"{BASE_URL}/{test_product.id}")
+            self.client.put(f"{BASE_URL}/{test_product.id}/like")
+            self.client.get(f"{BASE_URL}/{test_product.id}")
+        self.assertEqual([call.args[0] for call in do.call_args_list], [test_product.id] * 2)
+        forget.assert_called_once_with(test_product.id)
+
     def test_get_product_not_found(self):
         """It should not Get a Product thats not found"""
         response = self.client.get(f"{BASE_URL}/0")
@@ -395,6 +646,219 @@ class TestProductService(TestCase):
         data = response.get_json()
         self.assertEqual(len(data), 5)
 
+    def test_get_product_list_not_modified(self):
+        """It should return 304 for a list until any Product changes"""
+        products = self._create_products(2)
+        response = self.client.get(BASE_URL)
+        etag = response.headers["ETag"]
+
+        response = self.client.get(
+            BASE_URL, query_string={"name": "x"}, headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(response.data), 0)
+
+        self.client.delete(f"{BASE_URL}/{products[0].id}")
+        response = self.client.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 1)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_sync_products_updated_since(self):
+        """It should return only the changes and deletions since a timestamp"""
+        products = self._create_products(3)
+        kept, deleted, changed = products[0], products[1], products[2]
+        since = self.client.get(BASE_URL).get_json()[-1]["updated_at"]
+        self.client.put(f"{BASE_URL}/{changed.id}/like")
+        self.client.delete(f"{BASE_URL}/{deleted.id}")
+        created = self._create_products(1)[0]
+
+        response = self.client.get(BASE_URL, query_string={"updated_since": since})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([product["id"] for product in data["products"]], [changed.id, created.id])
+        self.assertEqual(data["deleted"], [deleted.id])
+        self.assertNotIn(kept.id, [product["id"] for product in data["products"]])
+        self.assertFalse(data["more"])
+
+        # syncing again from the cursor repeats nothing
+        response = self.client.get(BASE_URL, query_string={"since": data["cursor"]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), {"products": [], "deleted": [], "cursor": data["cursor"], "more": False})
+
+    def test_sync_products_since_cursor(self):
+        """It should page through the change events by sequence number"""
+        cursor = ChangeCounter.current()
+        products = self._create_products(3)
+        self.client.delete(f"{BASE_URL}/{products[0].id}")
+        app.config["SYNC_BATCH_SIZE"] = 2
+        self.addCleanup(app.config.update, SYNC_BATCH_SIZE=1000)
+        pages = []
+        more = True
+        while more:
+            data = self.client.get(BASE_URL, query_string={"since": cursor}).get_json()
+            pages.append(([product["id"] for product in data["products"]], data["deleted"]))
+            cursor, more = data["cursor"], data["more"]
+        # the Product deleted later is already a tombstone on the page that created it
+        self.assertEqual(
+            pages, [([products[1].id], [products[0].id]), ([products[2].id], [products[0].id]), ([], [])]
+        )
+        self.assertEqual(cursor, ChangeCounter.current())
+
+    def test_sync_products_pruned(self):
+        """It should ask for a full sync once the events after the cursor are gone"""
+        cursor = ChangeCounter.current()
+        self._create_products(2)
+        ProductEvent.prune(-1)
+        response = self.client.get(BASE_URL, query_string={"since": cursor})
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+        response = self.client.get(BASE_URL, query_string={"since": ChangeCounter.current()})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_sync_products_with_filters(self):
+        """It should combine updated_since with the other filters"""
+        self._create_products(2)
+        product = ProductFactory(name="Delta Sync")
+        self.client.post(BASE_URL, json=product.serialize())
+        response = self.client.get(
+            BASE_URL, query_string={"updated_since": "2000-01-01T00:00:00", "name": "Delta"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+        since = "2000-01-01T00:00:00"
+        app.config["EVENT_RETENTION"] = 10**10
+        self.addCleanup(app.config.update, EVENT_RETENTION=604800)
+        response = self.client.get(BASE_URL, query_string={"updated_since": since, "name": "Delta"})
+        data = response.get_json()
+        self.assertEqual(len(data["products"]), 1)
+        self.assertEqual(data["products"][0]["name"], "Delta Sync")
+
+    def test_sync_products_filtered_out(self):
+        """It should list a Product changed to no longer match the filters as deleted"""
+        product = self._create_products(1)[0]
+        cursor = ChangeCounter.current()
+        self.client.patch(f"{BASE_URL}/{product.id}", json={"name": "Renamed Away"})
+        response = self.client.get(BASE_URL, query_string={"since": cursor, "name": product.name})
+        data = response.get_json()
+        self.assertEqual(data["products"], [])
+        self.assertEqual(data["deleted"], [product.id])
+        response = self.client.get(BASE_URL, query_string={"since": cursor, "name": "Renamed Away"})
+        self.assertEqual([found["id"] for found in response.get_json()["products"]], [product.id])
+
+    def test_sync_products_unencoded_offset(self):
+        """It should read a timestamp whose + was sent unencoded"""
+        since = "2100-01-01T00:00:00 00:00"
+        response = self.client.get(f"{BASE_URL}?updated_since={since}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["cursor"], ChangeCounter.current())
+
+    def test_sync_products_bad_timestamp(self):
+        """It should reject an updated_since that is not a timestamp"""
+        response = self.client.get(BASE_URL, query_string={"updated_since": "yesterday"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string={"since": "yesterday"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_get_by_query(self):
+        """It should return Products for ?ids= in request order with the missing ids"""
+        products = self._create_products(3)
+        ids = f"{products[2].id},{products[0].id},0,{products[2].id}"
+        response = self.client.get(BASE_URL, query_string={"ids": ids})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([product["id"] for product in data["products"]], [products[2].id, products[0].id])
+        self.assertEqual(data["products"][0]["name"], products[2].name)
+        self.assertEqual(data["missing"], [0])
+
+    def test_batch_get_by_post(self):
+        """It should return Products for a POSTed list of ids"""
+        products = self._create_products(2)
+        body = {"ids": [products[1].id, 0, products[0].id]}
+        response = self.client.post(f"{BASE_URL}/batch-get", json=body)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([product["id"] for product in data["products"]], [products[1].id, products[0].id])
+        self.assertEqual(data["missing"], [0])
+
+    def test_batch_get_bad_requests(self):
+        """It should reject malformed or oversized batch gets"""
+        response = self.client.get(BASE_URL, query_string={"ids": "1,x"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(f"{BASE_URL}/batch-get", json={"ids": "1,2"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(f"{BASE_URL}/batch-get", data="ids", content_type="text/plain")
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        too_many = list(range(app.config["BATCH_GET_MAX_IDS"] + 1))
+        response = self.client.post(f"{BASE_URL}/batch-get", json={"ids": too_many})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_explain_list(self):
+        """It should return the query plans of a list request to an admin"""
+        self._create_products(2)
+        app.config["ADMIN_TOKEN"] = "secret"
+        self.addCleanup(app.config.update, ADMIN_TOKEN="")
+        response = self.client.get(
+            BASE_URL, query_string={"name": "x", "explain": "1"}, headers={"X-Admin-Token": "secret"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["status"], status.HTTP_200_OK)
+        self.assertIn("sql_ms", data["timing"])
+        selects = [query for query in data["queries"] if "FROM product " in query["sql"]]
+        self.assertEqual(len(selects), 1)
+        self.assertIn("product.name", selects[0]["sql"].split("WHERE")[1])
+        self.assertTrue(selects[0]["plan"])
+
+    def test_explain_requires_admin(self):
+        """It should refuse ?explain=1 without the admin token"""
+        response = self.client.get(BASE_URL, query_string={"explain": "1"})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        app.config["ADMIN_TOKEN"] = "secret"
+        self.addCleanup(app.config.update, ADMIN_TOKEN="")
+        response = self.client.get(BASE_URL, query_string={"explain": "1"}, headers={"X-Admin-Token": "wrong"})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_top_products(self):
+        """It should return the most liked Products"""
+        app.extensions["leaderboard"].last_seq = None
+        products = self._create_products(3)
+        self.client.put(f"{BASE_URL}/{products[2].id}/like")
+        self.client.put(f"{BASE_URL}/{products[2].id}/like")
+        self.client.put(f"{BASE_URL}/{products[1].id}/like")
+        response = self.client.get(f"{BASE_URL}/top", query_string={"n": 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual([product["id"] for product in data], [products[2].id, products[1].id])
+        self.assertEqual(data[0]["likes"], products[2].likes + 2)
+
+        response = self.client.get(f"{BASE_URL}/top")
+        self.assertEqual(len(response.get_json()), 3)
+
+    def test_top_products_bad_n(self):
+        """It should reject an n that is not a number or out of range"""
+        for value in ("abc", "0", str(app.config["LEADERBOARD_SIZE"] + 1)):
+            response = self.client.get(f"{BASE_URL}/top", query_string={"n": value})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_suggest_products(self):
+        """It should suggest Products whose name starts with a prefix"""
+        app.extensions["suggest"].last_seq = None
+        products = self._create_products(3)
+        prefix = products[0].name[:2].upper()
+        response = self.client.get(f"{BASE_URL}/suggest", query_string={"prefix": prefix})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertIn({"id": products[0].id, "name": products[0].name}, data)
+        for item in data:
+            self.assertTrue(item["name"].lower().startswith(prefix.lower()))
+
+    def test_suggest_products_bad_request(self):
+        """It should require a prefix and a limit in range"""
+        response = self.client.get(f"{BASE_URL}/suggest")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        for value in ("abc", "0", str(app.config["SUGGEST_MAX_LIMIT"] + 1)):
+            response = self.client.get(f"{BASE_URL}/suggest", query_string={"prefix": "a", "limit": value})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_product_list_by_name(self):
         """It should Get a list of Products by name"""
         products = self._create_products(5)
@@ -444,6 +908,44 @@ class TestProductService(TestCase):
         response = self.client.put("/products/99999/like")
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    # ----------------------------------------------------------
+    # TEST EXPORT
+    # ----------------------------------------------------------
+    def test_export_products_as_csv(self):
+        """It should Export all Products as CSV"""
+        products = self._create_products(3)
+        response = self.client.get(f"{BASE_URL}/export")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "text/csv")
+        self.assertIn("products.csv", response.headers["Content-Disposition"])
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], "id,name,description,price,likes,created_at,updated_at")
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[1].startswith(f"{products[0].id},"))
+        found = self.client.get(f"{BASE_URL}/{products[0].id}").get_json()
+        self.assertTrue(lines[1].endswith(f",{found['created_at']},{found['updated_at']}"))
+
+    def test_export_products_as_jsonl(self):
+        """It should Export filtered Products as JSON Lines"""
+        product = ProductFactory(name="Export Me")
+        self.client.post(BASE_URL, json=product.serialize())
+        self._create_products(2)
+        response = self.client.get(
+            f"{BASE_URL}/export", query_string={"format": "jsonl", "name": "Export"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 1)
+        record = json.loads(lines[0])
+        self.assertEqual(record["name"], "Export Me")
+        self.assertEqual(Decimal(record["price"]), product.price)
+
+    def test_export_products_bad_format(self):
+        """It should not Export Products in an unknown format"""
+        response = self.client.get(f"{BASE_URL}/export", query_string={"format": "xml"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     # ----------------------------------------------------------
     # TEST Health
     # ----------------------------------------------------------
@@ -0,0 +1,114 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for Single Flight request coalescing
+"""
+
+import threading
+import time
+from unittest import TestCase
+
+from service.common import metrics
+from service.common.singleflight import SingleFlight
+
+FOLLOWERS = 5
+
+
+class TestSingleFlight(TestCase):
+    """Single Flight Tests"""
+
+    def setUp(self):
+        metrics.reset()
+        self.flight = SingleFlight("test")
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+        self.outcomes = []
+
+    def _call(self):
+        """Counts the call and blocks until the test releases it"""
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if self.calls > 1:
+            raise ValueError("boom")
+        return {"calls": self.calls}
+
+    def _worker(self):
+        """Calls the flight and records the result or error"""
+        try:
+            self.outcomes.append(self.flight.do("key", self._call))
+        except ValueError as error:
+            self.outcomes.append(error)
+
+    def _run_together(self):
+        """Starts a leader, parks followers behind it, then releases it"""
+        leader = threading.Thread(target=self._worker)
+        leader.start()
+        self.started.wait(5)
+        waiters = self.flight._calls["key"].done._cond._waiters
+        followers = [threading.Thread(target=self._worker) for _ in range(FOLLOWERS)]
+        for follower in followers:
+            follower.start()
+        deadline = time.monotonic() + 5
+        while len(waiters) < FOLLOWERS and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+    def test_collapses_concurrent_calls(self):
+        """It should run one call and share its result with every waiter"""
+        self._run_together()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(self.outcomes), FOLLOWERS + 1)
+        self.assertTrue(all(outcome is self.outcomes[0] for outcome in self.outcomes))
+        self.assertEqual(metrics.counter("singleflight.test.leaders"), 1)
+        self.assertEqual(metrics.counter("singleflight.test.shared"), FOLLOWERS)
+        gauges = metrics.snapshot()["gauges"]
+        self.assertAlmostEqual(gauges["singleflight.test.collapse_ratio"], FOLLOWERS / (FOLLOWERS + 1))
+        self.assertEqual(self.flight._calls, {})
+
+    def test_shares_errors(self):
+        """It should raise the leader's error in every waiter"""
+        self.calls = 1
+        self._run_together()
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(len(self.outcomes), FOLLOWERS + 1)
+        self.assertTrue(all(isinstance(outcome, ValueError) for outcome in self.outcomes))
+        self.assertEqual(self.flight._calls, {})
+
+    def test_forget_starts_a_new_call(self):
+        """It should not let a caller join a call running from before the key was forgotten"""
+        leader = threading.Thread(target=self._worker)
+        leader.start()
+        self.started.wait(5)
+        self.flight.forget("key")
+        self.assertEqual(self.flight.do("key", lambda: "fresh"), "fresh")
+        self.release.set()
+        leader.join(5)
+        self.assertEqual(self.outcomes, [{"calls": 1}])
+        self.assertEqual(metrics.counter("singleflight.test.leaders"), 2)
+        self.assertEqual(self.flight._calls, {})
+
+    def test_sequential_calls_are_not_shared(self):
+        """It should run the call again once the previous one has finished"""
+        self.release.set()
+        self.assertEqual(self.flight.do("key", self._call), {"calls": 1})
+        self.assertRaises(ValueError, self.flight.do, "key", self._call)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(metrics.snapshot()["gauges"]["singleflight.test.collapse_ratio"], 0)
@@ -0,0 +1,168 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+
+"""
+Test cases for Product name suggestions
+"""
+
+# pylint: disable=duplicate-code
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+
+from wsgi import app
+from service.common import metrics
+from service.common.suggest import NameIndex
+from service.models import db, Product, ProductEvent
+from tests.factories import ProductFactory
+
+CONFIG = {"SUGGEST_MAX_NAMES": 10, "SUGGEST_REFRESH_SECONDS": 0}
+
+
+######################################################################
+#  N A M E   S U G G E S T I O N   T E S T   C A S E S
+######################################################################
+class TestNameIndex(TestCase):
+    """Name Suggestion Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+
+    def setUp(self):
+        """This runs before each test"""
+        metrics.reset()
+        db.session.query(Product).delete()
+        db.session.commit()
+        self.index = NameIndex(db.engine, CONFIG)
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def _create(self, *names):
+        """Creates one Product per name"""
+        products = []
+        for name in names:
+            product = ProductFactory(name=name)
+            product.create()
+            products.append(product)
+        return products
+
+    def _names(self, prefix, limit=10):
+        """Returns the names suggested for prefix"""
+        return [product["name"] for product in self.index.suggest(prefix, limit)]
+
+    def test_prefix_search(self):
+        """It should suggest names starting with a prefix, ignoring case"""
+        self._create("Shoes", "shirt", "Hat", "Shorts", "Sock")
+        self.assertEqual(self._names("sh"), ["shirt", "Shoes", "Shorts"])
+        self.assertEqual(self._names("SHO"), ["Shoes", "Shorts"])
+        self.assertEqual(self._names("sh", limit=1), ["shirt"])
+        self.assertEqual(self._names("z"), [])
+        self.assertEqual(metrics.counter("suggest.loads"), 1)
+        self.assertEqual(metrics.counter("suggest.memory"), 4)
+
+    def test_follows_changes(self):
+        """It should add created, rename updated and drop deleted Products"""
+        products = self._create("Shoes", "Hat")
+        self.assertEqual(self._names("s"), ["Shoes"])
+        self._create("Sandals")
+        products[1].name = "Scarf"
+        products[1].update()
+        products[0].delete()
+        self.assertEqual(self._names("s"), ["Sandals", "Scarf"])
+        self.assertEqual(self._names("h"), [])
+        self.assertEqual(metrics.counter("suggest.loads"), 1)
+
+    def test_waits_between_refreshes(self):
+        """It should not look for changes more than once per refresh interval"""
+        index = NameIndex(db.engine, dict(CONFIG, SUGGEST_REFRESH_SECONDS=3600))
+        index.suggest("s", 10)
+        self._create("Shoes")
+        self.assertEqual(index.suggest("s", 10), [])
+
+    def test_large_catalog_uses_database(self):
+        """It should search the database when there are too many names to hold"""
+        index = NameIndex(db.engine, dict(CONFIG, SUGGEST_MAX_NAMES=2))
+        self._create("Shoes", "Shirt", "Hat", "50%_off")
+        self.assertEqual([item["name"] for item in index.suggest("sh", 10)], ["Shirt", "Shoes"])
+        self.assertTrue(index.overflow)
+        self.assertEqual(metrics.counter("suggest.database"), 1)
+        # LIKE wildcards in the prefix are matched literally
+        self.assertEqual([item["name"] for item in index.suggest("50%_", 10)], ["50%_off"])
+        self.assertEqual(index.suggest("5%", 10), [])
+
+    def test_grows_past_limit(self):
+        """It should switch to the database once the catalog outgrows the index"""
+        index = NameIndex(db.engine, dict(CONFIG, SUGGEST_MAX_NAMES=2))
+        self._create("Shoes")
+        index.suggest("s", 10)
+        self._create("Shirt", "Sock")
+        self.assertEqual(len(index.suggest("s", 10)), 3)
+        self.assertTrue(index.overflow)
+
+    def test_shrinks_below_limit(self):
+        """It should go back to memory once deletions make the catalog fit"""
+        index = NameIndex(db.engine, dict(CONFIG, SUGGEST_MAX_NAMES=2))
+        products = self._create("Shoes", "Shirt", "Sock")
+        index.suggest("s", 10)
+        self.assertTrue(index.overflow)
+        self._create("Hat")
+        index.suggest("s", 10)
+        self.assertTrue(index.overflow)
+        self.assertEqual(metrics.counter("suggest.loads"), 1)
+        products[0].delete()
+        products[1].delete()
+        self.assertEqual([item["name"] for item in index.suggest("s", 10)], ["Sock"])
+        self.assertFalse(index.overflow)
+        self.assertEqual(metrics.counter("suggest.loads"), 2)
+
+    def test_nameless_products(self):
+        """It should never suggest a Product without a name"""
+        products = self._create(None, "Shoes")
+        self.assertEqual(self._names("s"), ["Shoes"])
+        self.assertEqual(self._names(""), ["Shoes"])
+        self._create(None)
+        products[1].name = None
+        products[1].update()
+        self.assertEqual(self._names(""), [])
+        products[0].name = "Sock"
+        products[0].update()
+        self.assertEqual(self._names("s"), ["Sock"])
+        self.assertEqual(metrics.counter("suggest.loads"), 1)
+
+    def test_reloads_after_gap(self):
+        """It should reload when events were pruned"""
+        self._create("Shoes")
+        self.index.suggest("s", 10)
+        self._create("Shirt", "Sock")
+        db.session.query(ProductEvent).filter(ProductEvent.seq == self.index.last_seq + 1).delete()
+        db.session.commit()
+        self.assertEqual(len(self.index.suggest("s", 10)), 3)
+        self.assertEqual(metrics.counter("suggest.loads"), 2)
+
+    @patch("service.common.suggest.BATCH_SIZE", 1)
+    def test_reloads_when_far_behind(self):
+        """It should reload instead of replaying a long backlog"""
+        self.index.suggest("s", 10)
+        self._create("Shoes", "Shirt")
+        self.assertEqual(len(self.index.suggest("s", 10)), 2)
+        self.assertEqual(metrics.counter("suggest.loads"), 2)
@@ -0,0 +1,149 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for request tracing
+"""
+
+# pylint: disable=duplicate-code
+import json
+import logging
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from wsgi import app
+from service.common import status, metrics, tracing
+from service.models import db, Product
+from tests.factories import ProductFactory
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+######################################################################
+#  T R A C I N G   T E S T   C A S E S
+######################################################################
+class TestTracing(TestCase):
+    """Request Tracing Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+
+    def setUp(self):
+        """This runs before each test"""
+        metrics.reset()
+        self.client = app.test_client()
+        directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "traces.jsonl")
+        saved = {key: app.config[key] for key in ("TRACE_FILE", "TRACE_SAMPLE_RATE", "TRACE_MAX_SPANS")}
+        self.addCleanup(app.config.update, saved)
+        app.config.update(TRACE_FILE=self.path, TRACE_SAMPLE_RATE=0, TRACE_MAX_SPANS=1000)
+        db.session.query(Product).delete()
+        db.session.commit()
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def _spans(self):
+        """Returns the spans of every exported trace"""
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding="utf-8") as traces:
+            return [
+                span
+                for line in traces
+                for span in json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+            ]
+
+    def test_sampled_traceparent(self):
+        """It should trace a request whose traceparent is sampled, down to SQL"""
+        product = ProductFactory()
+        product.create()
+        db.session.expunge_all()
+        response = self.client.get(
+            f"/products/{product.id}", headers={"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-01"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.headers["traceparent"].startswith(f"00-{TRACE_ID}-"))
+
+        spans = {span["name"]: span for span in self._spans()}
+        root = spans["GET /products/<int:product_id>"]
+        self.assertEqual(root["traceId"], TRACE_ID)
+        self.assertEqual(root["parentSpanId"], PARENT_ID)
+        self.assertEqual(root["kind"], 2)
+        self.assertIn({"key": "http.status_code", "value": {"stringValue": "200"}}, root["attributes"])
+        self.assertEqual(spans["Product.find"]["parentSpanId"], root["spanId"])
+        self.assertEqual(spans["Product.serialize"]["parentSpanId"], root["spanId"])
+        self.assertIn("SQL SELECT", spans)
+        self.assertEqual(metrics.counter("tracing.traces"), 1)
+
+    def test_not_sampled(self):
+        """It should not trace a request whose caller chose not to sample it"""
+        self.client.get("/products", headers={"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-00"})
+        self.client.get("/products")
+        self.assertEqual(self._spans(), [])
+
+    def test_sample_rate(self):
+        """It should start new traces for the sampled share of requests"""
+        app.config["TRACE_SAMPLE_RATE"] = 1
+        response = self.client.get("/products", headers={"traceparent": "garbage"})
+        spans = self._spans()
+        root = [span for span in spans if span["name"] == "GET /products"][0]
+        self.assertNotIn("parentSpanId", root)
+        self.assertNotEqual(root["traceId"], TRACE_ID)
+        self.assertIn(root["traceId"], response.headers["traceparent"])
+
+    def test_span_limit(self):
+        """It should drop spans past TRACE_MAX_SPANS"""
+        app.config.update(TRACE_SAMPLE_RATE=1, TRACE_MAX_SPANS=1)
+        self.client.get("/products")
+        self.assertEqual(len(self._spans()), 1)
+        self.assertGreater(metrics.counter("tracing.dropped_spans"), 0)
+
+    def test_errors_are_recorded(self):
+        """It should mark the spans of a failed operation"""
+        app.config["TRACE_SAMPLE_RATE"] = 1
+        with patch("service.routes.Product.all", side_effect=RuntimeError("boom")):
+            with self.assertRaises(RuntimeError):
+                self.client.get("/products")
+        root = [span for span in self._spans() if span["name"] == "GET /products"][0]
+        self.assertEqual(root["status"], {"code": 2, "message": "boom"})
+
+    def test_sql_errors_are_recorded(self):
+        """It should mark the span of a failed SQL statement"""
+        root = tracing.Span(tracing.Trace(TRACE_ID, 10), "test")
+        token = tracing._current.set(root)  # pylint: disable=protected-access
+        try:
+            with self.assertRaises(Exception):
+                db.session.execute(db.text("SELECT * FROM no_such_table"))
+        finally:
+            tracing._current.reset(token)  # pylint: disable=protected-access
+            db.session.rollback()
+        self.assertIn("no_such_table", root.trace.spans[0].error)
+
+    def test_no_trace_no_spans(self):
+        """It should do nothing outside a traced request"""
+        with tracing.span("idle") as span:
+            self.assertIsNone(span)
+        self.assertIsNone(tracing.parse_traceparent(f"00-{'0' * 32}-{PARENT_ID}-01"))
@@ -0,0 +1,92 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the compiled request validation
+"""
+from decimal import Decimal
+from unittest import TestCase
+
+from service.common.validation import Schema, ValidationError
+from service.models import Product
+
+VALID = {"name": "Shoes", "description": "Running shoes", "price": "12.50"}
+
+
+######################################################################
+#  V A L I D A T I O N   T E S T   C A S E S
+######################################################################
+class TestValidation(TestCase):
+    """Schema Validation Tests"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.schema = Schema(Product.__table__, Product.PATCHABLE_FIELDS, minimums={"price": 0})
+
+    def assertErrors(self, data, expected, partial=False):  # pylint: disable=invalid-name
+        """Checks that data fails with exactly the expected field errors"""
+        with self.assertRaises(ValidationError) as context:
+            self.schema.validate(data, partial=partial)
+        self.assertEqual(context.exception.errors, expected)
+
+    def test_valid_payloads(self):
+        """It should accept payloads that fit the columns"""
+        self.assertEqual(self.schema.validate(VALID), VALID)
+        for price in (0, 12, 12.5, "99999999.99", Decimal("1.10"), None):
+            self.schema.validate(dict(VALID, price=price))
+        self.schema.validate(dict(VALID, name="x" * 63, description="y" * 256, extra=True))
+
+    def test_lengths(self):
+        """It should enforce the VARCHAR lengths"""
+        self.assertErrors(
+            dict(VALID, name="x" * 64, description="y" * 257),
+            {"name": "must be at most 63 characters", "description": "must be at most 256 characters"},
+        )
+
+    def test_types(self):
+        """It should enforce the column types"""
+        self.assertErrors(dict(VALID, name=5, price="cheap"), {"name": "must be a string", "price": "must be a number"})
+        self.assertErrors(dict(VALID, price=True), {"price": "must be a number"})
+        self.assertErrors(dict(VALID, price=[1]), {"price": "must be a number"})
+        self.assertErrors(dict(VALID, price="NaN"), {"price": "must be a finite number"})
+
+    def test_numeric_precision(self):
+        """It should enforce the NUMERIC(10, 2) precision and the minimum"""
+        self.assertErrors(dict(VALID, price="1.005"), {"price": "must have at most 2 decimal places"})
+        self.assertErrors(dict(VALID, price=100000000), {"price": "must be less than 100000000"})
+        self.assertErrors(dict(VALID, price=-1), {"price": "must be at least 0"})
+
+    def test_required_fields(self):
+        """It should require every field unless the payload is partial"""
+        self.assertErrors({"name": "Shoes"}, {"description": "is required", "price": "is required"})
+        self.assertEqual(self.schema.validate({"price": 3}, partial=True), {"price": 3})
+        self.assertErrors({"price": -3}, {"price": "must be at least 0"}, partial=True)
+
+    def test_not_an_object(self):
+        """It should reject a body that is not a JSON object"""
+        self.assertErrors(["name"], {})
+        self.assertRaises(ValidationError, self.schema.validate, None)
+
+    def test_integer_and_not_null_columns(self):
+        """It should check INTEGER columns and NOT NULL"""
+        schema = Schema(Product.__table__, ("likes",))
+        schema.validate({"likes": 3})
+        with self.assertRaises(ValidationError) as context:
+            schema.validate({"likes": "3"})
+        self.assertEqual(context.exception.errors, {"likes": "must be an integer"})
+        with self.assertRaises(ValidationError) as context:
+            schema.validate({"likes": None})
+        self.assertEqual(context.exception.errors, {"likes": "may not be null"})